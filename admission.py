@@ -0,0 +1,141 @@
+import time
+import threading
+from metrics import throttle_seconds
+
+# Допуск задач загрузки. Число одновременно выполняемых задач (всего и на
+# пользователя) ограничивает выдача задач воркерам (claim_job); здесь —
+# место в очереди ожидания при постановке задачи и скорость загрузок и
+# отправки, общая для всех воркеров
+
+# Корзины пользователей, не получавших данных дольше этого времени (в секундах), удаляются
+USER_BUCKET_TTL = 300
+
+class QueueFull(Exception):
+    """Очередь ожидания заполнена, задача не принимается.
+
+    reason — 'queue', если заполнена общая очередь, или 'user', если
+    пользователь достиг своего лимита задач в ожидании.
+    """
+
+    def __init__(self, reason):
+        super().__init__(f"Очередь задач заполнена ({reason})")
+        self.reason = reason
+
+def check_queue(pending, user_pending, count, max_pending, max_pending_per_user, speculative=False):
+    """Проверка места в очереди для count новых задач; при нехватке — QueueFull.
+
+    pending и user_pending — задачи в ожидании всего и у пользователя,
+    лимит 0 — без ограничения. Упреждающие задачи принимаются, только пока
+    общая очередь заполнена меньше чем наполовину: при росте нагрузки они
+    отбрасываются первыми.
+    """
+    if speculative and max_pending:
+        max_pending = max(1, max_pending // 2)
+    if max_pending and pending + count > max_pending:
+        raise QueueFull('queue')
+    if max_pending_per_user and user_pending + count > max_pending_per_user:
+        raise QueueFull('user')
+
+class TokenBucket:
+    """Ограничение скорости (единиц в секунду) по принципу маркерной корзины.
+
+    Маркеры берутся в долг: порция любого размера списывается сразу, а
+    следующий вызов ждет, пока долг не будет погашен. Запас корзины —
+    burst маркеров (по умолчанию rate, то есть секунда работы без
+    ожидания). rate 0 — без ограничения.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.fixed_burst = burst
+        self.burst = rate if burst is None else burst
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """Изменение скорости; накопленный долг сохраняется"""
+        with self.lock:
+            now = time.monotonic()
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+            self.burst = rate if self.fixed_burst is None else self.fixed_burst
+            self.tokens = min(self.tokens, self.burst)
+
+    def reserve(self, count):
+        """Списание count маркеров; возвращает время в секундах до погашения долга"""
+        if not self.rate:
+            return 0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            return max(0, -self.tokens / self.rate)
+
+    def consume(self, count):
+        """Списание count маркеров с ожиданием; вызывается из потоков загрузки"""
+        wait = self.reserve(count)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class BandwidthLimiter:
+    """Скорость загрузок и отправки: общая и для каждого пользователя.
+
+    consume вызывается из потоков загрузки на каждый полученный или
+    отправленный блок и приостанавливает поток, пока не будут погашены
+    долги обеих корзин: так задачи одного пользователя не занимают весь
+    канал, а все вместе не превышают rate.
+
+    rate и user_rate — лимиты на все воркеры. Процесс получает долю лимита
+    через set_shares: общий лимит делится поровну между воркерами, которые
+    выполняют задачи, а лимит пользователя — между воркерами с его задачами.
+    Пока доли не известны, процесс считает себя единственным воркером.
+    """
+
+    def __init__(self, rate, user_rate):
+        self.rate = rate
+        self.total = TokenBucket(rate)
+        self.user_rate = user_rate
+        self.user_workers = {}
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def set_shares(self, workers, user_workers):
+        """Доли лимитов: workers — воркеров с задачами, user_workers — пользователь -> воркеров с его задачами"""
+        self.total.set_rate(self.rate / max(1, workers))
+        with self.lock:
+            self.user_workers = user_workers
+            for user_id, bucket in self.users.items():
+                bucket.set_rate(self._user_share(user_id))
+
+    def _user_share(self, user_id):
+        # Вызывается под self.lock
+        return self.user_rate / max(1, self.user_workers.get(user_id, 1))
+
+    def user_bucket(self, user_id):
+        with self.lock:
+            bucket = self.users.get(user_id)
+            if bucket is None:
+                self._prune()
+                bucket = self.users[user_id] = TokenBucket(self._user_share(user_id))
+            return bucket
+
+    def _prune(self):
+        threshold = time.monotonic() - USER_BUCKET_TTL
+        for user_id in [user_id for user_id, bucket in self.users.items() if bucket.updated < threshold]:
+            del self.users[user_id]
+
+    def consume(self, user_id, count):
+        user_wait = self.user_bucket(user_id).reserve(count) if self.user_rate and user_id is not None else 0
+        total_wait = self.total.reserve(count)
+
+        wait = max(user_wait, total_wait)
+        if wait > 0:
+            throttle_seconds.inc(wait, scope='user' if user_wait > total_wait else 'global')
+            time.sleep(wait)
+        return wait
@@ -0,0 +1,144 @@
+"""Время холодного запуска бота: от старта процесса до первого getUpdates.
+
+Запускает bot.py в отдельном процессе так же, как run_polling: импорт
+модулей, startup (проверка схемы базы), создание приложения,
+initialize, post_init и начало опроса. Запросы к Telegram (getMe,
+deleteWebhook, getUpdates) заменены ответами без сети, поэтому
+измеряется только собственное время запуска. База должна быть уже
+создана миграцией; без --database-url используется SQLite во временном
+каталоге, которая создается через migrate.py до измерения.
+
+Примеры:
+    python benchmarks/cold_start.py
+    python benchmarks/cold_start.py --database-url postgresql://localhost/youtubesaver --runs 5
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3, help='число запусков')
+    parser.add_argument('--database-url', help='база данных (по умолчанию SQLite во временном каталоге)')
+    parser.add_argument('--json', help='файл для сохранения результата')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+async def measure_child(started):
+    """Запуск бота в текущем процессе; возвращает моменты этапов (time.monotonic)"""
+    import asyncio
+    marks = {'started': started}
+
+    import bot as bot_module
+    from telegram import Bot, User
+    marks['imported'] = time.monotonic()
+
+    bot_module.startup()
+    marks['startup'] = time.monotonic()
+
+    first_poll = asyncio.get_running_loop().create_future()
+
+    class ColdStartBot(Bot):
+        """Бот без обращений к Telegram; первый getUpdates отмечает окончание запуска"""
+
+        async def get_me(self, *args, **kwargs):
+            self._bot_user = User(id=1, first_name='Cold start', is_bot=True, username='cold_start_bot')
+            return self._bot_user
+
+        async def delete_webhook(self, *args, **kwargs):
+            return True
+
+        async def get_updates(self, *args, **kwargs):
+            if not first_poll.done():
+                first_poll.set_result(time.monotonic())
+            await asyncio.sleep(0.05)
+            return ()
+
+    application = bot_module.build_application(ColdStartBot('123456:cold-start'))
+    marks['built'] = time.monotonic()
+
+    # Порядок как в Application.run_polling
+    await application.initialize()
+    await bot_module.post_init(application)
+    await application.updater.start_polling()
+    await application.start()
+    marks['initialized'] = time.monotonic()
+    marks['first_get_updates'] = await first_poll
+
+    await application.updater.stop()
+    await application.stop()
+    await bot_module.post_stop(application)
+    await application.shutdown()
+    await bot_module.post_shutdown(application)
+    marks['stopped'] = time.monotonic()
+    return marks
+
+def child_main():
+    started = time.monotonic()
+    sys.path.insert(0, ROOT)
+    import asyncio
+    marks = asyncio.run(measure_child(started))
+    print(json.dumps(marks))
+
+def run_once():
+    """Один запуск в новом процессе; время отсчитывается от его создания"""
+    spawned = time.monotonic()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child'],
+        cwd=ROOT, check=True, stdout=subprocess.PIPE
+    ).stdout
+    marks = json.loads(output.decode().strip().splitlines()[-1])
+
+    return {
+        'interpreter': marks['started'] - spawned,
+        'import': marks['imported'] - marks['started'],
+        'startup': marks['startup'] - marks['imported'],
+        'build': marks['built'] - marks['startup'],
+        'initialize': marks['initialized'] - marks['built'],
+        'first_get_updates': marks['first_get_updates'] - spawned,
+        'shutdown': marks['stopped'] - marks['first_get_updates']
+    }
+
+def measure(runs):
+    """Время запуска для настроек из окружения; в качестве итога берется медиана"""
+    results = [run_once() for _ in range(runs)]
+    return {name: sorted(result[name] for result in results)[len(results) // 2] for name in results[0]}
+
+def format_report(result):
+    return (
+        f"Холодный запуск до первого getUpdates: {result['first_get_updates'] * 1000:.0f} мс "
+        f"(интерпретатор {result['interpreter'] * 1000:.0f}, импорт {result['import'] * 1000:.0f}, "
+        f"проверка схемы {result['startup'] * 1000:.0f}, создание приложения {result['build'] * 1000:.0f}, "
+        f"инициализация {result['initialize'] * 1000:.0f} мс); остановка {result['shutdown'] * 1000:.0f} мс"
+    )
+
+def main():
+    args = parse_args()
+    if args.child:
+        child_main()
+        return
+
+    workdir = tempfile.mkdtemp(prefix='youtubesaver-cold-start-')
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:cold-start')
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}?timeout=30"
+
+    try:
+        subprocess.run([sys.executable, os.path.join(ROOT, 'migrate.py')], cwd=ROOT, check=True)
+        result = measure(args.runs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(format_report(result))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+import re
+import time
+import random
+import asyncio
+import itertools
+import threading
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from mega import Mega
+
+# Блок синтетических данных, из которого собираются потоки
+BLOCK = bytes(range(256)) * 256  # 64 КБ
+
+class Throttle:
+    """Ограничение скорости одного соединения (байт в секунду, 0 — без ограничения)"""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.started = time.monotonic()
+        self.transferred = 0
+
+    def wait(self, count):
+        self.transferred += count
+        if not self.bytes_per_second:
+            return
+        delay = self.transferred / self.bytes_per_second - (time.monotonic() - self.started)
+        if delay > 0:
+            time.sleep(delay)
+
+class LocalServer:
+    """HTTP-сервер на свободном порту localhost в отдельном потоке"""
+
+    def __init__(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                server.handle_get(self, head=True)
+
+            def do_GET(self):
+                server.handle_get(self)
+
+            def do_POST(self):
+                server.handle_post(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle_get(self, request, head=False):
+        request.send_error(405)
+
+    def handle_post(self, request):
+        request.send_error(405)
+
+class FakeYouTubeServer(LocalServer):
+    """Замена видеосерверов YouTube: синтетические потоки с поддержкой Range.
+
+    Размер потока передается в ссылке (size), скорость каждого соединения
+    ограничена bandwidth байт в секунду.
+    """
+
+    def __init__(self, bandwidth=0):
+        super().__init__()
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def stream_url(self, video_id, itag, size):
+        expire = int(time.time()) + 6 * 3600
+        return f"{self.url}/videoplayback?v={video_id}&itag={itag}&size={size}&expire={expire}"
+
+    def handle_get(self, request, head=False):
+        query = parse_qs(urlsplit(request.path).query)
+        size = int(query['size'][0])
+        start, end, status = 0, size - 1, 200
+
+        match = re.match(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        if match:
+            start = int(match[1])
+            end = min(int(match[2]) if match[2] else size - 1, size - 1)
+            status = 206
+
+        if start >= size:
+            request.send_response(416)
+            request.send_header('Content-Range', f'bytes */{size}')
+            request.send_header('Content-Length', '0')
+            request.end_headers()
+            return
+
+        length = end - start + 1
+        request.send_response(status)
+        request.send_header('Content-Type', 'video/mp4')
+        request.send_header('Accept-Ranges', 'bytes')
+        request.send_header('Content-Length', str(length))
+        if status == 206:
+            request.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        request.end_headers()
+
+        with self.lock:
+            self.requests += 1
+        if head:
+            return
+
+        throttle = Throttle(self.bandwidth)
+        sent = 0
+        try:
+            while sent < length:
+                chunk = BLOCK[:min(len(BLOCK), length - sent)]
+                request.wfile.write(chunk)
+                sent += len(chunk)
+                throttle.wait(len(chunk))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self.lock:
+                self.bytes_sent += sent
+
+class FakeMegaServer(LocalServer):
+    """Замена MEGA: API и прием зашифрованных фрагментов.
+
+    Фрагменты принимаются по HTTP так же, как сервером загрузки MEGA
+    (POST ul_url/offset), со скоростью не выше bandwidth байт в секунду.
+    Команды API выполняет FakeMega.
+    """
+
+    def __init__(self, bandwidth=0):
+        super().__init__()
+        self.bandwidth = bandwidth
+        self.handles = (f"{n:08d}" for n in itertools.count(1))
+        self.nodes = {}
+        self.logins = 0
+        self.uploads = 0
+        self.bytes_received = 0
+
+    def new_handle(self):
+        with self.lock:
+            return next(self.handles)
+
+    def handle_post(self, request):
+        length = int(request.headers.get('Content-Length', 0))
+        throttle = Throttle(self.bandwidth)
+        received = 0
+        while received < length:
+            data = request.rfile.read(min(len(BLOCK), length - received))
+            if not data:
+                break
+            received += len(data)
+            throttle.wait(len(data))
+
+        with self.lock:
+            self.bytes_received += received
+
+        body = f"completion{self.new_handle()}".encode()
+        request.send_response(200)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def api(self, command):
+        action = command['a']
+
+        if action == 'u':
+            return {'p': f"{self.url}/ul/{self.new_handle()}"}
+
+        if action == 'p':
+            node = command['n'][0]
+            handle = self.new_handle()
+            with self.lock:
+                self.nodes[handle] = {'t': node['t'], 'p': command['t'], 'a': node['a']}
+                self.uploads += 1
+            return {'f': [{'h': handle, 't': node['t'], 'a': node['a'], 'k': f"owner:{node['k']}"}]}
+
+        if action == 'l':
+            return f"public{command['n']}"
+
+        if action == 'd':
+            with self.lock:
+                return 0 if self.nodes.pop(command['n'], None) else -9
+
+        raise ValueError(f"Команда MEGA не поддерживается: {action}")
+
+class FakeMega(Mega):
+    """Клиент MEGA без сети для API: вход и команды выполняются на FakeMegaServer.
+
+    Шифрование фрагментов и ключей остается настоящим, поэтому
+    mega_handler.upload_chunks и Mega.get_upload_link работают без изменений.
+    """
+
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+        self.folders = {}
+
+    def login(self, email=None, password=None):
+        self.master_key = [random.randint(0, 0xFFFFFFFF) for _ in range(4)]
+        self.sid = 'benchmark'
+        with self.server.lock:
+            self.server.logins += 1
+        return self
+
+    def _api_request(self, data):
+        command = data[0] if isinstance(data, list) else data
+        return self.server.api(command)
+
+    def get_files(self):
+        return {handle: {'t': 1, 'a': {'n': name}} for name, handle in self.server_folders().items()}
+
+    def create_folder(self, name, dest=None):
+        handle = self.server.new_handle()
+        with self.server.lock:
+            self.server.nodes[handle] = {'t': 1, 'p': dest, 'a': {'n': name}}
+        return {name: handle}
+
+    def server_folders(self):
+        with self.server.lock:
+            return {node['a']['n']: handle for handle, node in self.server.nodes.items() if node['t'] == 1}
+
+# Начало сообщений об отказе при заполненной очереди задач (bot.format_queue_full)
+REJECTED_PREFIXES = ('Сейчас слишком много загрузок', 'У вас уже')
+
+def is_rejected_text(text):
+    return text.startswith(REJECTED_PREFIXES)
+
+def is_final_text(text):
+    """Итоговое сообщение о задаче: результат, ошибка или отказ"""
+    return text.startswith('✅') or text.startswith('Произошла ошибка') or is_rejected_text(text)
+
+class FakeBot:
+    """Замена Telegram Bot API: запоминает изменения сообщений и принимает файлы.
+
+    Отправка файлов занимает время в соответствии с upload_bandwidth.
+    wait_final возвращает future, которое завершается временем получения
+    итогового текста сообщения.
+    """
+
+    def __init__(self, upload_bandwidth=0):
+        self.upload_bandwidth = upload_bandwidth
+        self.message_ids = itertools.count(1)
+        self.waiters = {}
+        self.texts = {}
+        self.edits = 0
+        self.files_sent = 0
+        # Отправки с содержимым файла, а не по file_id
+        self.uploads = 0
+        self.bytes_sent = 0
+
+    def next_message_id(self):
+        return next(self.message_ids)
+
+    def wait_final(self, chat_id, message_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[(chat_id, message_id)] = future
+        return future
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edits += 1
+        key = (chat_id, message_id)
+        self.texts[key] = text
+
+        future = self.waiters.get(key)
+        if future and not future.done() and is_final_text(text):
+            del self.waiters[key]
+            future.set_result((time.monotonic(), text))
+
+    async def send_file(self, file):
+        if hasattr(file, 'read'):
+            # Как InputFile в python-telegram-bot: содержимое файла читается целиком
+            file = file.read()
+        size = len(file) if isinstance(file, bytes) else 0
+        if size and self.upload_bandwidth:
+            await asyncio.sleep(size / self.upload_bandwidth)
+        self.files_sent += 1
+        if size:
+            self.uploads += 1
+        self.bytes_sent += size
+        return SimpleNamespace(file_id=f"file{self.files_sent}")
+
+    async def send_video(self, chat_id, video=None, **kwargs):
+        return SimpleNamespace(video=await self.send_file(video), document=None)
+
+    async def send_audio(self, chat_id, audio=None, **kwargs):
+        return SimpleNamespace(audio=await self.send_file(audio))
+
+class FakeMessage:
+    """Сообщение чата с методами, которые используют обработчики bot.py"""
+
+    def __init__(self, bot, chat_id, text=''):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = bot.next_message_id()
+        self.text = text
+        self.reply_markup = None
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        reply = FakeMessage(self.bot, self.chat_id, text)
+        reply.reply_markup = kwargs.get('reply_markup')
+        self.replies.append(reply)
+        return reply
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        self.reply_markup = kwargs.get('reply_markup')
+        await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id, **kwargs)
+
+class FakeCallbackQuery:
+    def __init__(self, data, message):
+        self.data = data
+        self.message = message
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        await self.message.edit_text(text, **kwargs)
+
+class FakeUpdate:
+    """Обновление Telegram: сообщение пользователя или нажатие кнопки"""
+
+    def __init__(self, user, message=None, callback_query=None):
+        self.effective_user = user
+        self.message = message
+        self.callback_query = callback_query
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+
+class FakeApplication:
+    def __init__(self, bot):
+        self.bot = bot
+        self.bot_data = {}
@@ -0,0 +1,443 @@
+"""Нагрузочный тест бота на локальных заменах YouTube, MEGA и Telegram.
+
+Запускает настоящие обработчики bot.py, слоты воркера (download_video,
+upload_to_mega, прямую отправку в Telegram) и функции database.py в одном
+процессе. Видео отдает локальный HTTP-сервер с ограничением скорости,
+MEGA и Telegram заменены fakes.FakeMega и fakes.FakeBot, база — SQLite во
+временном каталоге или --database-url (например, локальный PostgreSQL).
+
+После прогона проверяется согласованность: каждая загрузка на MEGA и в
+Telegram записана в базу ровно одним результатом, а объем, скачанный с
+YouTube, не больше размера потоков, которые задачи действительно
+выполняли. При расхождении (например, одну задачу выполнили несколько
+слотов) тест завершается с ошибкой. Сценарии с очередью стоит
+прогонять и на PostgreSQL, который используется в работе.
+
+Примеры:
+    python benchmarks/run.py --scenario smoke
+    python benchmarks/run.py --scenario many-users --users 100 --json result.json
+    python benchmarks/run.py --scenario hot-video --workdir /dev/shm/bench
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+from types import SimpleNamespace
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cold_start
+
+MB = 1024 * 1024
+
+# Сценарии: число пользователей, запросов на пользователя, различных видео
+# (чем их меньше, тем больше попаданий в кэш), размер видео, скорость
+# источника и число слотов воркера
+SCENARIOS = {
+    'smoke': dict(users=2, requests=2, videos=2, size_mb=2, bandwidth_mbps=0, concurrency=2),
+    'many-users': dict(users=50, requests=2, videos=25, size_mb=5, bandwidth_mbps=40, concurrency=8),
+    'hot-video': dict(users=100, requests=1, videos=1, size_mb=20, bandwidth_mbps=40, concurrency=8),
+    'large-files': dict(users=4, requests=1, videos=4, size_mb=200, bandwidth_mbps=200, concurrency=4, direct=False),
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS, default='smoke')
+    parser.add_argument('--users', type=int, help='одновременных пользователей')
+    parser.add_argument('--requests', type=int, help='запросов на пользователя')
+    parser.add_argument('--videos', type=int, help='различных видео')
+    parser.add_argument('--size-mb', type=float, help='размер видео в 720p, МБ')
+    parser.add_argument('--bandwidth-mbps', type=float, help='скорость одного соединения с YouTube, Мбит/с (0 — без ограничения)')
+    parser.add_argument('--mega-bandwidth-mbps', type=float, default=0, help='скорость загрузки на MEGA, Мбит/с')
+    parser.add_argument('--mega-accounts', type=int, default=1, help='аккаунтов MEGA, у каждого своя скорость загрузки')
+    parser.add_argument('--telegram-bandwidth-mbps', type=float, default=0, help='скорость отправки в Telegram, Мбит/с')
+    parser.add_argument('--concurrency', type=int, help='слотов воркера')
+    parser.add_argument('--qualities', default='720,480', help='качества, которые выбирают пользователи')
+    parser.add_argument('--direct', dest='direct', action='store_true', default=None, help='отправлять небольшие файлы в Telegram')
+    parser.add_argument('--no-direct', dest='direct', action='store_false', help='всегда загружать на MEGA')
+    parser.add_argument('--streaming', dest='streaming', action='store_true', default=None, help='потоковая загрузка на MEGA')
+    parser.add_argument('--no-streaming', dest='streaming', action='store_false', help='загрузка через диск')
+    parser.add_argument('--think-time', type=float, default=0, help='пауза пользователя между запросами, с')
+    parser.add_argument('--choice-time', type=float, default=0, help='время выбора качества после получения кнопок, с')
+    parser.add_argument('--prefetch', action='store_true', help='упреждающая загрузка вероятного качества')
+    parser.add_argument('--timeout', type=float, default=600, help='предельное время одного запроса, с')
+    parser.add_argument('--database-url', help='база данных (по умолчанию SQLite в рабочем каталоге)')
+    parser.add_argument('--workdir', help='рабочий каталог для загрузок (например, на tmpfs)')
+    parser.add_argument('--keep', action='store_true', help='не удалять рабочий каталог')
+    parser.add_argument('--cold-start-runs', type=int, default=1, help='запусков бота для измерения холодного старта (0 — не измерять)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='файл для сохранения результата')
+    args = parser.parse_args()
+
+    for name, value in SCENARIOS[args.scenario].items():
+        if getattr(args, name, None) is None:
+            setattr(args, name, value)
+    if args.direct is None:
+        args.direct = True
+    if args.streaming is None:
+        args.streaming = True
+    args.qualities = args.qualities.split(',')
+    return args
+
+def configure_environment(args, workdir):
+    """Настройки проекта задаются до импорта config"""
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123456:benchmark',
+        'DATABASE_URL': args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}?timeout=30",
+        'DOWNLOAD_DIR': os.path.join(workdir, 'downloads'),
+        'TEMP_DIR': os.path.join(workdir, 'temp'),
+        'WORKER_CONCURRENCY': str(args.concurrency),
+        'STREAMING_UPLOAD': str(args.streaming).lower(),
+        'TELEGRAM_DIRECT_DELIVERY': str(args.direct).lower(),
+        'SPECULATIVE_PREFETCH': str(args.prefetch).lower(),
+        'MEGA_ACCOUNTS': ','.join(f"{email}:benchmark" for email in mega_emails(args)),
+    })
+    # Интервалы опроса уменьшены, чтобы они не преобладали в задержке;
+    # их и остальные настройки можно переопределить переменными окружения
+    os.environ.setdefault('QUEUE_MAX_RUNNING', str(args.concurrency))
+    os.environ.setdefault('WORKER_POLL_INTERVAL', '0.1')
+    os.environ.setdefault('JOB_REPORT_INTERVAL', '0.2')
+    os.environ.setdefault('WRITE_BUFFER_FLUSH_INTERVAL', '0.5')
+
+def mega_emails(args):
+    return [f"bench{index}@example.com" for index in range(args.mega_accounts)]
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def directory_size(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                pass
+    return total
+
+async def sample_disk(path, stats, interval=0.2):
+    """Наибольший объем рабочего каталога за время теста"""
+    while True:
+        stats['peak_disk'] = max(stats['peak_disk'], directory_size(path))
+        await asyncio.sleep(interval)
+
+def build_manifest(youtube, video_id, index, args):
+    """Манифест видео со ссылками на локальный сервер вместо YouTube"""
+    streams = []
+    for itag, quality in enumerate(args.qualities, start=100):
+        size = int(args.size_mb * MB * int(quality) / 720)
+        streams.append({
+            'itag': itag,
+            'url': youtube.stream_url(video_id, itag, size),
+            'subtype': 'mp4',
+            'resolution': f"{quality}p",
+            'abr': 128,
+            'filesize': size,
+            'progressive': True,
+            'includes_audio': True,
+            'includes_video': True
+        })
+
+    return {
+        'video_id': video_id,
+        'title': f"Benchmark video {index}",
+        'author': 'benchmark',
+        'length': 300,
+        'thumbnail': '',
+        'streams': streams,
+        'expires_at': time.time() + 6 * 3600
+    }
+
+async def run_user(bot_module, fake_bot, user_id, videos, args, rng, results):
+    """Один пользователь: /start, затем запросы ссылка -> выбор качества -> результат"""
+    from fakes import FakeMessage, FakeCallbackQuery, FakeUpdate, FakeContext, is_rejected_text
+
+    user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name=f"User {user_id}")
+    context = FakeContext(fake_bot)
+
+    await bot_module.start(FakeUpdate(user, FakeMessage(fake_bot, user_id, '/start')), context)
+
+    for _ in range(args.requests):
+        video_id = rng.choice(videos)
+        quality = rng.choice(args.qualities)
+        message = FakeMessage(fake_bot, user_id, f"https://www.youtube.com/watch?v={video_id}")
+
+        started = time.monotonic()
+        await bot_module.handle_youtube_url(FakeUpdate(user, message), context)
+        info_latency = time.monotonic() - started
+
+        keyboard = message.replies[-1]
+        if is_rejected_text(keyboard.text):
+            # Очередь заполнена: запрос отклонен до получения информации о видео
+            results.append({'ok': False, 'rejected': True, 'latency': None, 'info_latency': info_latency})
+            continue
+        final = fake_bot.wait_final(user_id, keyboard.message_id)
+        if args.choice_time:
+            await asyncio.sleep(args.choice_time)
+
+        selected = time.monotonic()
+        await bot_module.handle_quality_selection(
+            FakeUpdate(user, callback_query=FakeCallbackQuery(f"res_{quality}_{video_id}", keyboard)), context
+        )
+
+        try:
+            finished, text = await asyncio.wait_for(final, args.timeout)
+            results.append({
+                'ok': text.startswith('✅'),
+                'rejected': is_rejected_text(text),
+                'latency': finished - selected,
+                'info_latency': info_latency
+            })
+        except asyncio.TimeoutError:
+            results.append({'ok': False, 'rejected': False, 'latency': None, 'info_latency': info_latency})
+
+        if args.think_time:
+            await asyncio.sleep(args.think_time)
+
+async def run(args, workdir):
+    from fakes import FakeYouTubeServer, FakeMegaServer, FakeMega, FakeBot, FakeApplication
+
+    youtube = FakeYouTubeServer(args.bandwidth_mbps * MB / 8).start()
+    # Отдельный сервер на каждый аккаунт: скорость ограничивается для аккаунта
+    megas = {email: FakeMegaServer(args.mega_bandwidth_mbps * MB / 8).start() for email in mega_emails(args)}
+    fake_bot = FakeBot(args.telegram_bandwidth_mbps * MB / 8)
+
+    # Модули проекта импортируются после настройки окружения
+    import bot as bot_module
+    import worker
+    import mega_handler
+    import youtube_downloader
+    from database import init_db, save_video_metadata, flush_writes, get_cache_stats
+    from file_store import file_store
+    from database_async import dispose_engine
+    from message_updater import MessageUpdater
+    from executor import shutdown_pools
+    from metrics import stage_seconds, speculative_total, speculative_wasted_bytes, throttle_seconds
+
+    # Схема создается так же, как при развертывании (migrate.py)
+    init_db()
+    file_store.prepare()
+
+    mega_handler.login_to_mega = lambda email, password: FakeMega(megas[email]).login(email, password)
+    worker.telegram_bot = fake_bot
+    worker.event_loop = asyncio.get_running_loop()
+
+    videos = [f"bench{index:06d}" for index in range(args.videos)]
+    for index, video_id in enumerate(videos):
+        manifest = build_manifest(youtube, video_id, index, args)
+        youtube_downloader.metadata_cache.set(video_id, manifest, ttl=manifest['expires_at'] - time.time())
+        save_video_metadata(video_id, manifest, datetime.fromtimestamp(manifest['expires_at']))
+
+    application = FakeApplication(fake_bot)
+    updater = MessageUpdater(fake_bot)
+    application.bot_data['message_updater'] = updater
+
+    stats = {'peak_disk': 0}
+    slots = [asyncio.create_task(worker.worker_slot(slot)) for slot in range(args.concurrency)]
+    background = [
+        asyncio.create_task(updater.run()),
+        asyncio.create_task(bot_module.report_jobs(application)),
+        asyncio.create_task(sample_disk(workdir, stats)),
+    ] + slots
+
+    rng = random.Random(args.seed)
+    results = []
+    started = time.monotonic()
+
+    try:
+        await asyncio.gather(*(
+            run_user(bot_module, fake_bot, 1000 + index, videos, args, random.Random(rng.random()), results)
+            for index in range(args.users)
+        ))
+    finally:
+        elapsed = time.monotonic() - started
+        # Оставшиеся упреждающие загрузки дописывают файлы в рабочий каталог
+        worker.stopping.set()
+        await worker.drain(slots, args.timeout)
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        flush_writes()
+        await dispose_engine()
+        youtube.stop()
+        for mega in megas.values():
+            mega.stop()
+
+    latencies = [result['latency'] for result in results if result['ok']]
+    info_latencies = [result['info_latency'] for result in results]
+    cache = get_cache_stats()
+    errors = check_consistency(args, youtube, megas, fake_bot)
+    shutdown_pools(wait=False)
+
+    # Суммарное время по этапам конвейера из метрик процесса
+    stages = {
+        stage: {'count': counts[-1], 'seconds': total}
+        for (stage,), (counts, total) in stage_seconds.values.items()
+    }
+
+    return {
+        'scenario': args.scenario,
+        'users': args.users,
+        'requests': len(results),
+        'completed': len(latencies),
+        'rejected': sum(1 for result in results if result['rejected']),
+        'failed': sum(1 for result in results if not result['ok'] and not result['rejected']),
+        'elapsed': elapsed,
+        'jobs_per_second': len(latencies) / elapsed if elapsed else 0,
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies, default=None)
+        },
+        'info_latency': {
+            'p50': percentile(info_latencies, 50),
+            'p95': percentile(info_latencies, 95)
+        },
+        # На Linux ru_maxrss в килобайтах
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_disk_mb': stats['peak_disk'] / MB,
+        'youtube_mb': youtube.bytes_sent / MB,
+        'youtube_requests': youtube.requests,
+        'mega_mb': sum(mega.bytes_received for mega in megas.values()) / MB,
+        'mega_uploads': sum(mega.uploads for mega in megas.values()),
+        'mega_logins': sum(mega.logins for mega in megas.values()),
+        'mega_account_uploads': [mega.uploads for mega in megas.values()],
+        'telegram_files': fake_bot.files_sent,
+        'telegram_mb': fake_bot.bytes_sent / MB,
+        'telegram_edits': fake_bot.edits,
+        'cache_hits': cache['hits'],
+        'cache_misses': cache['misses'],
+        'speculative': {result: count for (result,), count in speculative_total.values.items()},
+        'speculative_wasted_mb': speculative_wasted_bytes.values.get((), 0) / MB,
+        'throttle_seconds': {scope: seconds for (scope,), seconds in throttle_seconds.values.items()},
+        'stages': stages,
+        'consistency_errors': errors
+    }
+
+def stream_size(args, quality):
+    """Размер потока в качестве quality, как в build_manifest"""
+    return int(args.size_mb * MB * int(quality) / 720)
+
+def check_consistency(args, youtube, megas, fake_bot):
+    """Расхождения между внешними сервисами и базой; пустой список, если их нет"""
+    from sqlalchemy import func
+    from database import Session, Job, MegaFile, ResultCache, TelegramFile
+
+    session = Session()
+
+    try:
+        mega_files, mega_bytes = session.query(
+            func.count(MegaFile.id), func.coalesce(func.sum(MegaFile.file_size), 0)
+        ).one()
+        cache_entries = session.query(func.count(ResultCache.id)).scalar()
+        telegram_files = session.query(func.count(TelegramFile.id)).scalar()
+        # Задачи, которые брал воркер, и число их повторных попыток по видео и качеству
+        executed = session.query(
+            Job.video_id, Job.quality, func.sum(Job.attempts - 1)
+        ).filter(Job.attempts > 0).group_by(Job.video_id, Job.quality).all()
+    finally:
+        session.close()
+
+    errors = []
+    mega_uploads = sum(mega.uploads for mega in megas.values())
+    mega_received = sum(mega.bytes_received for mega in megas.values())
+
+    if mega_uploads != mega_files:
+        errors.append(f"загрузок на MEGA {mega_uploads}, а записей mega_files {mega_files}")
+    if mega_received != mega_bytes:
+        errors.append(f"на MEGA получено {mega_received} байт, а в mega_files записано {mega_bytes}")
+    if mega_files != cache_entries:
+        errors.append(f"записей mega_files {mega_files}, а записей кэша {cache_entries}: результат загружен повторно")
+    if fake_bot.uploads != telegram_files:
+        errors.append(f"файлов, отправленных в Telegram, {fake_bot.uploads}, а записей telegram_files {telegram_files}")
+
+    # Каждое видео в каждом качестве скачивается один раз, а повторно — только при повторной попытке задачи
+    allowed = sum(stream_size(args, quality) * (1 + (retries or 0)) for _, quality, retries in executed)
+    if youtube.bytes_sent > allowed:
+        errors.append(f"с YouTube скачано {youtube.bytes_sent} байт, а выполненным задачам нужно не больше {allowed}")
+
+    return errors
+
+def format_seconds(value):
+    return '—' if value is None else f"{value:.3f} с"
+
+def print_report(result):
+    print(f"\nСценарий: {result['scenario']}, пользователей: {result['users']}")
+    print(
+        f"Запросов: {result['requests']}, выполнено: {result['completed']}, "
+        f"отклонено при заполненной очереди: {result['rejected']}, ошибок: {result['failed']}"
+    )
+    print(f"Время: {result['elapsed']:.1f} с, задач в секунду: {result['jobs_per_second']:.2f}")
+    latency = result['latency']
+    print(
+        f"Задержка (выбор качества -> результат): p50 {format_seconds(latency['p50'])}, "
+        f"p95 {format_seconds(latency['p95'])}, p99 {format_seconds(latency['p99'])}, "
+        f"макс. {format_seconds(latency['max'])}"
+    )
+    print(
+        f"Информация о видео: p50 {format_seconds(result['info_latency']['p50'])}, "
+        f"p95 {format_seconds(result['info_latency']['p95'])}"
+    )
+    print(f"Пиковая память: {result['peak_rss_mb']:.0f} МБ, пиковый объем на диске: {result['peak_disk_mb']:.1f} МБ")
+    print(
+        f"YouTube: {result['youtube_mb']:.1f} МБ за {result['youtube_requests']} запросов; "
+        f"MEGA: {result['mega_uploads']} файлов, {result['mega_mb']:.1f} МБ, входов {result['mega_logins']}; "
+        f"Telegram: {result['telegram_files']} файлов, {result['telegram_mb']:.1f} МБ, изменений сообщений {result['telegram_edits']}"
+    )
+    if len(result['mega_account_uploads']) > 1:
+        print(f"Загрузки по аккаунтам MEGA: {', '.join(map(str, result['mega_account_uploads']))}")
+    print(f"Кэш ссылок: {result['cache_hits']} попаданий, {result['cache_misses']} промахов")
+    if result['speculative']:
+        print(
+            "Упреждающие загрузки: " + ', '.join(f"{name} {count}" for name, count in sorted(result['speculative'].items()))
+            + f", отменено после скачивания {result['speculative_wasted_mb']:.1f} МБ"
+        )
+    if result['throttle_seconds']:
+        print("Ожидание ограничения скорости: " + ', '.join(
+            f"{scope} {seconds:.1f} с" for scope, seconds in sorted(result['throttle_seconds'].items())
+        ))
+    if result['cold_start']:
+        print(cold_start.format_report(result['cold_start']))
+    for stage, stats in sorted(result['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print(f"  {stage}: {stats['count']} раз, всего {stats['seconds']:.2f} с")
+    for error in result['consistency_errors']:
+        print(f"Нарушена согласованность: {error}")
+
+def main():
+    args = parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='youtubesaver-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    configure_environment(args, workdir)
+
+    try:
+        result = asyncio.run(run(args, workdir))
+        # Запуск бота в новом процессе с той же базой, уже созданной тестом
+        result['cold_start'] = cold_start.measure(args.cold_start_runs) if args.cold_start_runs else None
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if result['consistency_errors']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
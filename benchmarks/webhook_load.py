@@ -0,0 +1,192 @@
+"""Нагрузочный тест приема обновлений через webhook.
+
+Запускает WebhookServer с настоящими очередью (IntakeQueue) и отсевом
+повторов (UpdateDeduplicator, SQLite во временном каталоге или
+--database-url) и отправляет ему обновления по нескольким постоянным
+соединениям, как это делает Telegram. Обработчик обновлений заменен
+паузой --handler-ms, число одновременно обрабатываемых обновлений задает
+--handlers.
+
+Показывает задержку ответа webhook, задержку приема (от отправки до
+начала обработки), наибольшую глубину очереди и число принятых,
+повторных и отклоненных обновлений.
+
+Примеры:
+    python benchmarks/webhook_load.py --updates 5000 --connections 40
+    python benchmarks/webhook_load.py --handlers 4 --handler-ms 50 --queue-size 100
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=2000, help='обновлений для отправки')
+    parser.add_argument('--connections', type=int, default=40, help='одновременных соединений (max_connections webhook)')
+    parser.add_argument('--rate', type=float, default=0, help='обновлений в секунду (0 — без ограничения)')
+    parser.add_argument('--duplicates', type=float, default=0.05, help='доля повторно отправляемых обновлений')
+    parser.add_argument('--queue-size', type=int, default=1000, help='размер очереди обновлений')
+    parser.add_argument('--handlers', type=int, default=64, help='одновременно обрабатываемых обновлений')
+    parser.add_argument('--handler-ms', type=float, default=5, help='время обработки одного обновления, мс')
+    parser.add_argument('--database-url', help='база данных (по умолчанию SQLite во временном каталоге)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='файл для сохранения результата')
+    return parser.parse_args()
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(len(values) * p / 100 + 0.999999) - 1)]
+
+def make_update(update_id):
+    user_id = 1000 + update_id % 500
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"},
+            'text': 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+        }
+    }
+
+async def post_updates(port, path, secret, payloads, sent_at, stats, rate):
+    """Одно постоянное соединение: обновления отправляются по очереди, как у Telegram"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        while payloads:
+            update_id, body = payloads.pop()
+            if rate:
+                # Равномерная отправка: время каждого обновления задано заранее
+                delay = stats['started'] + stats['scheduled'] / rate - time.monotonic()
+                stats['scheduled'] += 1
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            started = time.monotonic()
+            sent_at.setdefault(update_id, started)
+            writer.write(
+                f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+
+            status = int((await reader.readline()).split()[1])
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+
+            stats['ack'].append(time.monotonic() - started)
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            if status == 503:
+                # Telegram повторяет доставку после отказа
+                payloads.insert(0, (update_id, body))
+                await asyncio.sleep(0.05)
+    finally:
+        writer.close()
+
+async def consume(queue, sent_at, intake, handler_seconds):
+    """Замена приложения: берет обновления из очереди и «обрабатывает» их"""
+    while True:
+        update = await queue.get()
+        intake.append(time.monotonic() - sent_at[update.update_id])
+        await asyncio.sleep(handler_seconds)
+
+async def sample_depth(queue, stats):
+    while True:
+        stats['max_depth'] = max(stats['max_depth'], queue.qsize())
+        await asyncio.sleep(0.01)
+
+async def run(args):
+    from webhook import IntakeQueue, UpdateDeduplicator, WebhookServer
+    from executor import shutdown_pools
+    from database_async import dispose_engine
+    from database import init_db
+
+    init_db()
+
+    secret = 'benchmark'
+    queue = IntakeQueue(args.queue_size)
+    server = WebhookServer(None, queue, UpdateDeduplicator(), 'telegram', secret)
+    await server.start('127.0.0.1', 0)
+    port = server.server.sockets[0].getsockname()[1]
+
+    rng = random.Random(args.seed)
+    payloads = []
+    for update_id in range(1, args.updates + 1):
+        payloads.append((update_id, json.dumps(make_update(update_id)).encode()))
+        if update_id > 1 and rng.random() < args.duplicates:
+            duplicate = rng.randint(1, update_id - 1)
+            payloads.append((duplicate, json.dumps(make_update(duplicate)).encode()))
+    payloads.reverse()
+
+    sent_at, intake = {}, []
+    stats = {'ack': [], 'status': {}, 'max_depth': 0, 'started': time.monotonic(), 'scheduled': 0}
+    background = [asyncio.create_task(sample_depth(queue, stats))] + [
+        asyncio.create_task(consume(queue, sent_at, intake, args.handler_ms / 1000))
+        for _ in range(args.handlers)
+    ]
+
+    started = time.monotonic()
+    await asyncio.gather(*(
+        post_updates(port, '/telegram', secret, payloads, sent_at, stats, args.rate)
+        for _ in range(args.connections)
+    ))
+    while not queue.empty():
+        await asyncio.sleep(0.01)
+    elapsed = time.monotonic() - started
+
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+    await server.stop()
+    await dispose_engine()
+    shutdown_pools(wait=False)
+
+    return {
+        'updates': args.updates,
+        'processed': len(intake),
+        'elapsed': elapsed,
+        'updates_per_second': len(intake) / elapsed if elapsed else 0,
+        'responses': stats['status'],
+        'ack_latency': {p: percentile(stats['ack'], p) for p in (50, 95, 99)},
+        'intake_latency': {p: percentile(intake, p) for p in (50, 95, 99)},
+        'max_queue_depth': stats['max_depth']
+    }
+
+def format_ms(value):
+    return '—' if value is None else f"{value * 1000:.1f} мс"
+
+def main():
+    args = parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='youtubesaver-webhook-')
+    os.environ['DATABASE_URL'] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}?timeout=30"
+
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\nОтправлено обновлений: {result['updates']}, обработано: {result['processed']}")
+    print(f"Время: {result['elapsed']:.1f} с, обновлений в секунду: {result['updates_per_second']:.0f}")
+    print(f"Ответы webhook: {', '.join(f'{status}: {count}' for status, count in sorted(result['responses'].items()))}")
+    print("Ответ webhook: " + ', '.join(f"p{p} {format_ms(v)}" for p, v in result['ack_latency'].items()))
+    print("Прием (отправка -> начало обработки): " + ', '.join(f"p{p} {format_ms(v)}" for p, v in result['intake_latency'].items()))
+    print(f"Наибольшая глубина очереди: {result['max_queue_depth']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,51 @@
 import os
+import html
+import time
+import uuid
+import signal
+import asyncio
 import logging
 from datetime import datetime, timedelta
 import pytz
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from apscheduler.schedulers.background import BackgroundScheduler
-
-from config import TELEGRAM_BOT_TOKEN, ADMIN_USER_ID
-from database import register_user, update_user_activity, increment_download_count, log_download, get_stats
-from youtube_downloader import is_valid_youtube_url, get_video_info, download_video
-from mega_handler import upload_to_mega, cleanup_expired_files, cleanup_local_files
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, ContextTypes, filters
 
-# Инициализация планировщика для фоновых задач
-scheduler = BackgroundScheduler()
-scheduler.add_job(cleanup_expired_files, 'interval', minutes=10)
-scheduler.add_job(cleanup_local_files, 'interval', minutes=30)
-scheduler.start()
+from config import (
+    TELEGRAM_BOT_TOKEN, ADMIN_USER_ID, MAX_CONCURRENT_UPDATES, JOB_REPORT_INTERVAL, BOT_DRAIN_TIMEOUT,
+    BATCH_MAX_ITEMS, BATCH_METADATA_CONCURRENCY, CONVERSATION_STATE_TTL, METRICS_HOST, METRICS_PORT, BOT_MODE, WEBHOOK_LISTEN,
+    WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS, INTAKE_QUEUE_SIZE,
+    SPECULATIVE_PREFETCH, SPECULATIVE_MAX_MB, SPECULATIVE_HISTORY, QUEUE_MAX_PENDING, QUEUE_MAX_PENDING_PER_USER,
+    QUEUE_POSITION_INTERVAL
+)
+from database_async import (
+    register_user, update_user_activity, increment_download_count, log_download, get_stats,
+    get_telegram_file, delete_telegram_file, enqueue_job, enqueue_batch, get_batch_jobs, claim_job_reports, get_cached_result, get_cache_stats, get_processing_stats, flush_writes,
+    predict_quality, has_delivered_result, promote_speculative_job, cancel_speculative_job, get_speculative_stats,
+    get_queue_load, get_queue_positions, dispose_engine
+)
+from youtube_downloader import (
+    is_valid_youtube_url, is_playlist_url, extract_youtube_urls, extract_video_id, extract_clip, clip_bounds,
+    format_clip, result_quality, get_video_info, get_playlist_video_urls, estimate_file_size
+)
+from media import ffmpeg_available
+from expiry import expiry_engine
+from message_updater import MessageUpdater
+from delivery import send_file
+from database import check_schema, dispose_engine as dispose_sync_engine
+from executor import run_io, shutdown_pools
+from metrics import setup_logging, start_metrics_server, trace_id_var, current_trace_id, speculative_total, jobs_rejected
+from admission import QueueFull, check_queue
+from webhook import IntakeQueue, UpdateDeduplicator, WebhookServer
+from state_store import conversation_states, message_key
 
-# Словарь для хранения состояний пользователей
-user_states = {}
+logger = logging.getLogger(__name__)
 
 # Обработчик команды /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     
     # Регистрируем пользователя или обновляем информацию о нем
-    is_new_user = register_user(
+    is_new_user = await register_user(
         user.id, 
         user.username, 
         user.first_name
@@ -56,6 +69,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "1. Отправь мне ссылку на видео YouTube\n"
         "2. Выбери качество видео (480p, 720p, 1080p или MP3)\n"
         "3. Дождись завершения загрузки и получи временную ссылку на скачивание\n\n"
+        "Чтобы скачать только фрагмент, добавь после ссылки отрезок времени, "
+        "например: ссылка 1:30-2:00 (только для одной ссылки, не для плейлиста)\n\n"
         "Обрати внимание: ссылка действительна в течение 1 часа.\n\n"
         "Доступные команды:\n"
         "/start - Начать работу с ботом\n"
@@ -75,7 +90,14 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     # Получаем статистику
-    stats = get_stats()
+    stats = await get_stats()
+    cache = await get_cache_stats()
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    processing = await get_processing_stats(today)
+    speculative = await get_speculative_stats(today)
+    
+    lookups = cache['hits'] + cache['misses']
+    hit_rate = cache['hits'] / lookups * 100 if lookups else 0
     
     stats_text = (
         "📊 Статистика бота:\n\n"
@@ -83,9 +105,29 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         f"📥 Всего загрузок: {stats['total_downloads']}\n"
         f"📥 Загрузок сегодня: {stats['downloads_today']}\n"
         f"👤 Активных пользователей сегодня: {stats['active_users_today']}\n\n"
-        "🏆 Топ пользователей по загрузкам:\n"
+        f"🗄 Кэш ссылок: {cache['entries']} записей, всего выдано {cache['total_hits']} раз\n"
+        f"🎯 Поиск в кэше: {cache['hits']} попаданий, {cache['misses']} промахов ({hit_rate:.0f}%)\n\n"
     )
     
+    for name, title in [('today', 'Сегодня'), ('week', '7 дней'), ('month', '30 дней')]:
+        totals = stats['ranges'][name]
+        stats_text += (
+            f"📅 {title}: {totals['downloads']} загрузок, {totals['megabytes']:.0f} МБ, "
+            f"новых пользователей: {totals['new_users']}\n"
+        )
+    
+    if stats['qualities']:
+        stats_text += "\n📊 Качество за 30 дней: " + ", ".join(
+            f"{'MP3' if quality == 'audio' else f'{quality}p'} — {count}"
+            for quality, count in sorted(stats['qualities'].items(), key=lambda item: -item[1])
+        ) + "\n"
+    if stats['formats']:
+        stats_text += "📁 Форматы за 30 дней: " + ", ".join(
+            f"{file_format} — {count}" for file_format, count in sorted(stats['formats'].items(), key=lambda item: -item[1])
+        ) + "\n"
+    
+    stats_text += "\n🏆 Топ пользователей по загрузкам:\n"
+    
     for i, user in enumerate(stats['top_users']):
         username = user.get('username', 'Неизвестно')
         first_name = user.get('first_name', 'Неизвестно')
@@ -93,16 +135,93 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         
         stats_text += f"{i+1}. {first_name} (@{username}): {downloads} загрузок\n"
     
+    expiry = expiry_engine.stats()
+    stats_text += f"\n🗑 Удалено истекших файлов MEGA: {expiry['deleted']}"
+    if expiry['last_lag'] is not None:
+        stats_text += f", задержка {expiry['last_lag']:.0f} с (макс. {expiry['max_lag']:.0f} с)"
+    stats_text += "\n"
+    
+    if processing:
+        stats_text += "\n⚙️ Обработка ffmpeg сегодня:\n"
+        for stage, totals in processing.items():
+            stats_text += (
+                f"{stage}: {totals['jobs']} задач, {totals['wall_time']:.0f} с, "
+                f"процессор {totals['cpu_time']:.0f} с\n"
+            )
+    
+    chosen = speculative['hits'] + speculative['misses']
+    if chosen or speculative['unused']:
+        stats_text += (
+            f"\n🔮 Упреждающие загрузки сегодня: угадано {speculative['hits']} из {chosen} "
+            f"({speculative['hits'] / chosen * 100 if chosen else 0:.0f}%), без выбора {speculative['unused']}, "
+            f"впустую {speculative['wasted_bytes'] / (1024 * 1024):.0f} МБ\n"
+        )
+    
     await update.message.reply_text(stats_text)
 
-# Обработчик сообщений с URL
+# Сообщение об отказе при заполненной очереди задач
+def format_queue_full(reason):
+    if reason == 'user':
+        return (
+            f"У вас уже {QUEUE_MAX_PENDING_PER_USER} загрузок в очереди. "
+            "Дождитесь их выполнения и попробуйте снова."
+        )
+    return "Сейчас слишком много загрузок в очереди 😔 Пожалуйста, попробуйте через несколько минут."
+
+# Ранний отказ при заполненной очереди: до запроса информации о видео,
+# чтобы не тратить время на запросы, которые все равно не будут приняты
+async def reject_if_queue_full(message, user_id) -> bool:
+    pending, user_pending = await get_queue_load(user_id)
+    try:
+        check_queue(pending, user_pending, 1, QUEUE_MAX_PENDING, QUEUE_MAX_PENDING_PER_USER)
+    except QueueFull as e:
+        jobs_rejected.inc(reason=e.reason)
+        await message.reply_text(format_queue_full(e.reason))
+        return True
+    return False
+
+# Проверка фрагмента по информации о видео; конец обрезается по длительности.
+# Возвращает фрагмент или None, если его нельзя загрузить (пользователю уже ответили)
+async def check_clip(message, clip, video_info):
+    if not ffmpeg_available():
+        await message.edit_text(
+            "Загрузка фрагментов сейчас недоступна. Отправьте ссылку без отрезка времени, чтобы скачать видео целиком."
+        )
+        return None
+    
+    start, end = clip_bounds(clip)
+    if video_info['length']:
+        if start >= video_info['length']:
+            await message.edit_text(
+                "Начало фрагмента за пределами видео. Проверьте отрезок времени и отправьте ссылку снова."
+            )
+            return None
+        end = min(end, video_info['length'])
+    return f"{start}-{end}"
+
 async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     url = update.message.text.strip()
     user_id = update.effective_user.id
     
-    # Обновляем активность пользователя
+    # Обновляем активность пользователя (запись в базу выполняется в фоне)
     update_user_activity(user_id)
     
+    # Несколько ссылок или плейлист обрабатываются как пакет
+    urls = extract_youtube_urls(url)
+    clip = extract_clip(url)
+    if len(urls) > 1 or (urls and is_playlist_url(urls[0])):
+        # Фрагмент задается для одного видео: пакет не загружается целиком вместо фрагментов
+        if clip:
+            await update.message.reply_text(
+                "Фрагменты можно загружать только по одной ссылке на видео. Отправьте ссылки без отрезка "
+                "времени, чтобы скачать видео целиком, или каждую ссылку с отрезком отдельным сообщением."
+            )
+            return
+        await handle_batch(update, context, urls)
+        return
+    if urls:
+        url = urls[0]
+    
     # Проверяем, является ли URL действительной ссылкой YouTube
     if not is_valid_youtube_url(url):
         await update.message.reply_text(
@@ -110,13 +229,16 @@ async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
     
+    if await reject_if_queue_full(update.message, user_id):
+        return
+    
     # Отправляем сообщение о начале обработки
     processing_message = await update.message.reply_text(
         "Получаю информацию о видео... ⏳"
     )
     
     # Получаем информацию о видео
-    video_info = get_video_info(url)
+    video_info = await run_io(get_video_info, url)
     
     if not video_info:
         await processing_message.edit_text(
@@ -124,23 +246,35 @@ async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
     
-    # Сохраняем URL в контексте пользователя
-    if not context.user_data:
-        context.user_data = {}
-    
-    context.user_data['youtube_url'] = url
-    context.user_data['video_title'] = video_info['title']
+    if clip:
+        clip = await check_clip(processing_message, clip, video_info)
+        if not clip:
+            return
+    
+    # Сохраняем ссылку и название для кнопок этого сообщения
+    video_id = extract_video_id(url)
+    state = {'url': url, 'video_id': video_id, 'title': video_info['title'], 'clip': clip}
+    # Фрагмент заранее не загружается: вероятное качество угадывается по целым видео
+    if SPECULATIVE_PREFETCH and not clip:
+        state['prefetch'] = await start_prefetch(update, processing_message, url, video_id, video_info)
+    await conversation_states.put(
+        message_key(processing_message.chat_id, processing_message.message_id),
+        state
+    )
     
-    # Создаем клавиатуру с вариантами разрешения
+    # Создаем клавиатуру с вариантами разрешения; идентификатор видео и
+    # фрагмент передаются в данных кнопки, поэтому кнопки старого сообщения
+    # загружают свое видео, а не последнее отправленное
     keyboard = []
+    target = f"{video_id}_{clip}" if clip else video_id
     
     # Добавляем доступные разрешения видео
-    for res in sorted(video_info['resolutions']):
-        keyboard.append([InlineKeyboardButton(f"📹 {res}p", callback_data=f"res_{res}")])
+    for res in video_info['resolutions']:
+        keyboard.append([InlineKeyboardButton(f"📹 {res}p", callback_data=f"res_{res}_{target}")])
     
     # Добавляем опцию для аудио, если доступно
     if video_info['has_audio']:
-        keyboard.append([InlineKeyboardButton("🎵 MP3 (только аудио)", callback_data="res_audio")])
+        keyboard.append([InlineKeyboardButton("🎵 MP3 (только аудио)", callback_data=f"res_audio_{target}")])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -152,97 +286,606 @@ async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE)
         duration = f"{hours}:{minutes:02d}:{seconds:02d}"
     else:
         duration = f"{minutes:02d}:{seconds:02d}"
+    clip_line = f"✂️ Фрагмент: {format_clip(clip)}\n" if clip else ""
     
     # Отправляем сообщение с информацией о видео и клавиатурой
     await processing_message.edit_text(
-        f"📹 <b>{video_info['title']}</b>\n\n"
-        f"👤 Автор: {video_info['author']}\n"
-        f"⏱ Длительность: {duration}\n\n"
+        f"📹 <b>{html.escape(video_info['title'])}</b>\n\n"
+        f"👤 Автор: {html.escape(video_info['author'] or '')}\n"
+        f"⏱ Длительность: {duration}\n"
+        f"{clip_line}\n"
         "Выберите качество загрузки:",
         reply_markup=reply_markup,
         parse_mode='HTML'
     )
 
-# Обработчик выбора качества видео
-async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+# Упреждающая загрузка наиболее вероятного качества, пока пользователь выбирает.
+# Возвращает {'job_id', 'quality'} или None, если загружать заранее нечего
+async def start_prefetch(update, processing_message, url, video_id, video_info):
+    choices = [str(res) for res in video_info['resolutions']]
+    if video_info['has_audio']:
+        choices.append('audio')
+    
+    try:
+        quality = await predict_quality(update.effective_user.id, choices, SPECULATIVE_HISTORY)
+        if not quality or await has_delivered_result(video_id, quality):
+            return None
+        
+        # Большие файлы заранее не загружаем: промах обойдется слишком дорого
+        file_size = await run_io(estimate_file_size, url, quality)
+        if not file_size or file_size > SPECULATIVE_MAX_MB * 1024 * 1024:
+            return None
+        
+        job_id = await enqueue_job(
+            update.effective_user.id,
+            processing_message.chat_id,
+            processing_message.message_id,
+            url,
+            video_id,
+            video_info['title'],
+            quality,
+            current_trace_id(),
+            speculative=True,
+            max_pending=QUEUE_MAX_PENDING,
+            max_pending_per_user=QUEUE_MAX_PENDING_PER_USER
+        )
+        return {'job_id': job_id, 'quality': quality}
+    except QueueFull:
+        # Под нагрузкой упреждающие загрузки не ставятся первыми
+        return None
+    except Exception as e:
+        logger.warning(f"Не удалось начать упреждающую загрузку {video_id}: {e}")
+        return None
+
+# Обработчик пакета: плейлисты и несколько ссылок в одном сообщении
+async def handle_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, urls) -> None:
+    if await reject_if_queue_full(update.message, update.effective_user.id):
+        return
+    
+    processing_message = await update.message.reply_text("Получаю список видео... ⏳")
+    
+    # Раскрываем плейлисты и убираем повторы
+    video_urls = []
+    for url in urls:
+        if is_playlist_url(url):
+            video_urls += await run_io(get_playlist_video_urls, url, BATCH_MAX_ITEMS)
+        else:
+            video_urls.append(url)
+    
+    items, seen = [], set()
+    for url in video_urls:
+        video_id = extract_video_id(url)
+        if video_id and video_id not in seen:
+            seen.add(video_id)
+            items.append({'url': url, 'video_id': video_id})
+    
+    skipped = max(0, len(items) - BATCH_MAX_ITEMS)
+    items = items[:BATCH_MAX_ITEMS]
+    
+    if not items:
+        await processing_message.edit_text(
+            "Не удалось найти видео по этим ссылкам. Пожалуйста, проверьте ссылки и попробуйте снова."
+        )
+        return
+    
+    await processing_message.edit_text(f"Получаю информацию о {len(items)} видео... ⏳")
+    
+    # Информация о видео запрашивается параллельно, с ограничением числа одновременных запросов
+    semaphore = asyncio.Semaphore(BATCH_METADATA_CONCURRENCY)
+    
+    async def fetch_info(url):
+        async with semaphore:
+            return await run_io(get_video_info, url)
+    
+    infos = await asyncio.gather(*(fetch_info(item['url']) for item in items))
+    
+    batch, resolutions, has_audio = [], set(), False
+    for item, info in zip(items, infos):
+        if not info:
+            continue
+        item['title'] = info['title']
+        batch.append(item)
+        resolutions.update(info['resolutions'])
+        has_audio = has_audio or info['has_audio']
+    
+    unavailable = len(items) - len(batch)
+    
+    if not batch:
+        await processing_message.edit_text(
+            "Не удалось получить информацию ни об одном видео. Пожалуйста, проверьте ссылки и попробуйте снова."
+        )
+        return
+    
+    await conversation_states.put(
+        message_key(processing_message.chat_id, processing_message.message_id),
+        {'batch': batch}
+    )
+    
+    # Качество выбирается сразу для всех видео; если у видео нет выбранного
+    # разрешения, воркер загрузит ближайшее доступное
+    keyboard = [
+        [InlineKeyboardButton(f"📹 {res}p", callback_data=f"batch_{res}")]
+        for res in sorted(resolutions, key=int)
+    ]
+    if has_audio:
+        keyboard.append([InlineKeyboardButton("🎵 MP3 (только аудио)", callback_data="batch_audio")])
+    
+    text = f"📦 Найдено видео: {len(batch)}\n\n"
+    text += "\n".join(f"{i + 1}. {html.escape(item['title'])}" for i, item in enumerate(batch))
+    if unavailable:
+        text += f"\n\n⚠️ Недоступно видео: {unavailable}"
+    if skipped:
+        text += f"\n⚠️ В пакет входит не больше {BATCH_MAX_ITEMS} видео, остальные пропущены"
+    text += "\n\nВыберите качество загрузки для всех видео:"
+    
+    await processing_message.edit_text(
+        text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='HTML'
+    )
+
+# Обработчик выбора качества для пакета
+async def handle_batch_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     
-    # Получаем выбранное качество
     quality = query.data.split('_')[1]
     
-    # Получаем ссылку YouTube из контекста пользователя
-    youtube_url = context.user_data.get('youtube_url')
+    # Состояние удаляется при выборе, чтобы повторное нажатие не поставило пакет в очередь дважды
+    state = await conversation_states.take(message_key(query.message.chat_id, query.message.message_id))
+    batch = state['batch'] if state else None
     
-    if not youtube_url:
+    if not batch:
         await query.edit_message_text(
-            "Произошла ошибка. Пожалуйста, отправьте ссылку на видео заново."
+            "Произошла ошибка. Пожалуйста, отправьте ссылки заново."
         )
         return
     
-    # Отправляем сообщение о начале загрузки
     await query.edit_message_text(
-        f"Загружаю {'аудио' if quality == 'audio' else f'видео в качестве {quality}p'}... ⏳\n"
-        "Это может занять некоторое время в зависимости от размера видео."
+        f"Пакет из {len(batch)} видео поставлен в очередь... ⏳\n"
+        "Видео загружаются параллельно, в этом сообщении будет список ссылок."
     )
     
-    # Загружаем видео
-    download_result = download_video(youtube_url, quality)
+    # Задачи пакета выполняются воркерами как обычные, с соблюдением лимита на пользователя
+    try:
+        await enqueue_batch(
+            update.effective_user.id,
+            query.message.chat_id,
+            query.message.message_id,
+            batch,
+            quality,
+            current_trace_id(),
+            max_pending=QUEUE_MAX_PENDING,
+            max_pending_per_user=QUEUE_MAX_PENDING_PER_USER
+        )
+    except QueueFull as e:
+        # Пакет не принят: кнопки остаются, выбор можно повторить позже
+        jobs_rejected.inc(reason=e.reason)
+        await conversation_states.put(message_key(query.message.chat_id, query.message.message_id), state)
+        await query.edit_message_text(
+            f"{format_queue_full(e.reason)}\nПакет из {len(batch)} видео не поставлен в очередь.",
+            reply_markup=query.message.reply_markup
+        )
+
+# Обработчик выбора качества видео
+async def handle_quality_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    
+    # Получаем выбранное качество и идентификатор видео (в кнопках старого формата его нет);
+    # идентификатор всегда из 11 символов, после него может идти фрагмент
+    _, quality, *rest = query.data.split('_', 2)
+    video_id = rest[0][:11] if rest else None
+    clip = (rest[0][12:] or None) if rest else None
+    key = result_quality(quality, clip)
+    
+    # Ссылка и название видео сохранены для этого сообщения
+    state = await conversation_states.get(message_key(query.message.chat_id, query.message.message_id))
+    if state and video_id in (None, state['video_id']):
+        youtube_url, video_id, video_title = state['url'], state['video_id'], state['title']
+    elif video_id:
+        # Состояние истекло: ссылка восстанавливается по идентификатору видео
+        youtube_url = f"https://www.youtube.com/watch?v={video_id}"
+        video_info = await run_io(get_video_info, youtube_url)
+        video_title = video_info['title'] if video_info else None
+    else:
+        video_title = None
     
-    if not download_result:
+    if not video_title:
         await query.edit_message_text(
-            "Произошла ошибка при загрузке видео. Пожалуйста, попробуйте еще раз или выберите другое качество."
+            "Произошла ошибка. Пожалуйста, отправьте ссылку на видео заново."
         )
         return
     
-    # Отправляем сообщение о начале загрузки на MEGA
-    await query.edit_message_text(
-        f"Видео успешно загружено! 🎉\n"
-        f"Размер файла: {download_result['file_size']:.2f} МБ\n\n"
-        f"Загружаю на MEGA... ⏳"
-    )
-    
-    # Загружаем файл на MEGA
-    mega_result = upload_to_mega(download_result['file_path'], download_result['file_name'])
+    # Упреждающая загрузка другого качества больше не нужна
+    prefetch = state.get('prefetch') if state else None
+    if prefetch and prefetch['quality'] != quality:
+        if await cancel_speculative_job(prefetch['job_id']):
+            speculative_total.inc(result='miss')
+        prefetch = None
+    
+    # Если файл уже отправлялся в Telegram, отправляем его повторно по file_id
+    telegram_file = await get_telegram_file(video_id, key)
+    if telegram_file:
+        try:
+            await send_file(context.bot, query.message.chat_id, telegram_file['file_id'], telegram_file['file_format'], video_title)
+            
+            increment_download_count(update.effective_user.id)
+            log_download(update.effective_user.id, youtube_url, quality, telegram_file['file_size'], telegram_file['file_format'])
+            
+            await query.edit_message_text(
+                format_job_report({
+                    'status': 'done',
+                    'delivery': 'telegram',
+                    'quality': quality,
+                    'clip': clip,
+                    'video_title': video_title,
+                    'file_size': telegram_file['file_size']
+                }),
+                parse_mode='HTML'
+            )
+            return
+        except Exception as e:
+            logger.warning(f"Не удалось повторно отправить файл {video_id}: {e}")
+            await delete_telegram_file(video_id, key)
+    
+    # Если такое видео уже загружено на MEGA и ссылка действует, отдаем ее сразу
+    cached = await get_cached_result(video_id, key)
+    if cached:
+        increment_download_count(update.effective_user.id)
+        log_download(update.effective_user.id, youtube_url, quality, cached['file_size'], cached['file_format'])
+        
+        await query.edit_message_text(
+            format_job_report({
+                'status': 'done',
+                'quality': quality,
+                'clip': clip,
+                'video_title': video_title,
+                'link': cached['link'],
+                'file_size': cached['file_size'],
+                'expiration_time': cached['expiration_time']
+            }),
+            parse_mode='HTML',
+            disable_web_page_preview=True
+        )
+        return
     
-    if not mega_result:
+    # Выбрано качество упреждающей загрузки: задача уже в работе, о ее
+    # состоянии сообщит report_jobs
+    if prefetch and await promote_speculative_job(prefetch['job_id']):
+        speculative_total.inc(result='hit')
         await query.edit_message_text(
-            "Произошла ошибка при загрузке файла на MEGA. Пожалуйста, попробуйте еще раз."
+            f"Загрузка {'аудио' if quality == 'audio' else f'видео в качестве {quality}p'} уже началась... ⏳"
         )
         return
     
-    # Форматируем время истечения
-    expiration_time = mega_result['expiration_time']
-    expiration_formatted = expiration_time.strftime("%d.%m.%Y %H:%M:%S")
-    
-    # Увеличиваем счетчик загрузок пользователя
-    increment_download_count(update.effective_user.id)
-    
-    # Логируем загрузку
-    log_download(
-        update.effective_user.id,
-        youtube_url,
-        quality,
-        download_result['file_size'],
-        download_result['format']
+    # Сначала сообщаем о постановке в очередь: после этого статус сообщения
+    # обновляет только фоновая задача report_jobs
+    pending, _ = await get_queue_load(update.effective_user.id)
+    await query.edit_message_text(format_queued({'quality': quality, 'clip': clip, 'attempts': 0, 'position': pending + 1}))
+    
+    # Ставим задачу в очередь, загрузку выполнит воркер
+    try:
+        await enqueue_job(
+            update.effective_user.id,
+            query.message.chat_id,
+            query.message.message_id,
+            youtube_url,
+            video_id,
+            video_title,
+            quality,
+            current_trace_id(),
+            max_pending=QUEUE_MAX_PENDING,
+            max_pending_per_user=QUEUE_MAX_PENDING_PER_USER,
+            clip=clip
+        )
+    except QueueFull as e:
+        # Кнопки остаются: выбор можно повторить, когда очередь освободится
+        jobs_rejected.inc(reason=e.reason)
+        await query.edit_message_text(format_queue_full(e.reason), reply_markup=query.message.reply_markup)
+
+# Названия этапов выполнения задачи для сообщения о прогрессе
+STAGE_TITLES = {
+    'download': 'Скачиваю с YouTube',
+    'mux': 'Объединяю видео и звук',
+    'transcode': 'Конвертирую в MP3',
+    'cut': 'Вырезаю фрагмент',
+    'upload': 'Загружаю на MEGA',
+    'stream': 'Скачиваю и загружаю на MEGA',
+    'send': 'Отправляю файл в чат'
+}
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds} с"
+
+def format_progress(job):
+    """Строки о текущем этапе: процент, скорость и оставшееся время"""
+    text = f"{STAGE_TITLES.get(job['stage'], 'Обрабатываю')}..."
+    
+    done, total = job['bytes_done'] or 0, job['bytes_total']
+    if not total:
+        return text
+    
+    percent = min(100, done * 100 // total)
+    filled = percent // 10
+    text += (
+        f"\n{'▓' * filled}{'░' * (10 - filled)} {percent}%"
+        f" ({done / (1024 * 1024):.1f} из {total / (1024 * 1024):.1f} МБ)"
     )
     
-    # Отправляем сообщение с ссылкой
-    await query.edit_message_text(
+    elapsed = (job['progress_at'] - job['stage_started_at']).total_seconds() if job['stage_started_at'] else 0
+    if done and elapsed > 0:
+        speed = done / elapsed
+        text += f"\n🚀 {speed / (1024 * 1024):.1f} МБ/с, осталось ~{format_duration((total - done) / speed)}"
+    return text
+
+# Строка о фрагменте видео в сообщениях о задаче (пустая для целого видео)
+def format_clip_line(job):
+    return f"✂️ Фрагмент: {format_clip(job['clip'])}\n" if job.get('clip') else ""
+
+# Формирование текста сообщения о состоянии задачи
+# Сообщение о задаче в очереди; position — примерное место в очереди
+def format_queued(job):
+    quality = job['quality']
+    
+    if job['attempts']:
+        text = "Повторяю загрузку после ошибки... ⏳ Задача снова в очереди."
+    else:
+        text = (
+            f"Задача на загрузку {'аудио' if quality == 'audio' else f'видео в качестве {quality}p'} поставлена в очередь... ⏳\n"
+            f"{format_clip_line(job)}"
+            "Это может занять некоторое время в зависимости от размера видео."
+        )
+    if job.get('position'):
+        text += f"\n\nМесто в очереди: {job['position']}"
+    return text
+
+def format_job_report(job):
+    quality = job['quality']
+    
+    if job['status'] == 'pending':
+        return format_queued(job)
+    
+    if job['status'] == 'running':
+        text = f"Загружаю {'аудио' if quality == 'audio' else f'видео в качестве {quality}p'}... ⏳\n{format_clip_line(job)}"
+        if job['stage']:
+            return text + "\n" + format_progress(job)
+        return text + "Это может занять некоторое время в зависимости от размера видео."
+    
+    if job['status'] == 'failed':
+        return "Произошла ошибка при загрузке видео. Пожалуйста, попробуйте еще раз или выберите другое качество."
+    
+    if job.get('delivery') == 'telegram':
+        return (
+            f"✅ Файл отправлен в чат!\n\n"
+            f"📹 <b>{html.escape(job['video_title'] or '')}</b>\n"
+            f"📊 Качество: {'MP3 (аудио)' if quality == 'audio' else f'{quality}p'}\n"
+            f"{format_clip_line(job)}"
+            f"📦 Размер: {job['file_size']:.2f} МБ"
+        )
+    
+    # Форматируем время истечения
+    expiration_formatted = job['expiration_time'].strftime("%d.%m.%Y %H:%M:%S")
+    
+    return (
         f"✅ Загрузка завершена!\n\n"
-        f"📹 <b>{context.user_data.get('video_title')}</b>\n"
+        f"📹 <b>{html.escape(job['video_title'] or '')}</b>\n"
         f"📊 Качество: {'MP3 (аудио)' if quality == 'audio' else f'{quality}p'}\n"
-        f"📦 Размер: {download_result['file_size']:.2f} МБ\n\n"
-        f"🔗 <a href='{mega_result['link']}'>Скачать файл</a>\n\n"
-        f"⚠️ Ссылка действительна до: {expiration_formatted} (1 час)",
-        parse_mode='HTML',
-        disable_web_page_preview=True
+        f"{format_clip_line(job)}"
+        f"📦 Размер: {job['file_size']:.2f} МБ\n\n"
+        f"🔗 <a href='{job['link']}'>Скачать файл</a>\n\n"
+        f"⚠️ Ссылка действительна до: {expiration_formatted} (1 час)"
     )
 
-# Основная функция
-def main() -> None:
-    # Создаем приложение и добавляем обработчики
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+# Формирование общего сообщения о пакете задач
+def format_batch_report(jobs):
+    quality = jobs[0]['quality']
+    finished = [job for job in jobs if job['status'] in ('done', 'failed')]
+    done = [job for job in jobs if job['status'] == 'done']
+    
+    if len(finished) == len(jobs):
+        text = f"✅ Пакет загружен: {len(done)} из {len(jobs)} видео\n"
+    else:
+        text = f"📦 Загружено {len(done)} из {len(jobs)} видео... ⏳\n"
+    text += f"📊 Качество: {'MP3 (аудио)' if quality == 'audio' else f'{quality}p'}\n\n"
+    
+    for i, job in enumerate(jobs):
+        title = job['video_title'] or job['video_id']
+        title = html.escape(title if len(title) <= 40 else title[:39] + '…')
+        
+        if job['status'] == 'done' and job['delivery'] == 'telegram':
+            text += f"{i + 1}. ✅ {title} ({job['file_size']:.1f} МБ, отправлено в чат)\n"
+        elif job['status'] == 'done':
+            text += f"{i + 1}. ✅ <a href='{job['link']}'>{title}</a> ({job['file_size']:.1f} МБ)\n"
+        elif job['status'] == 'failed':
+            text += f"{i + 1}. ❌ {title}\n"
+        elif job['status'] == 'running':
+            percent = ''
+            if job['bytes_total']:
+                percent = f" — {min(100, (job['bytes_done'] or 0) * 100 // job['bytes_total'])}%"
+            text += f"{i + 1}. ⏳ {title}{percent}\n"
+        else:
+            text += f"{i + 1}. 🕓 {title}\n"
+    
+    links = [job for job in done if job['delivery'] != 'telegram']
+    if links:
+        expiration = min(job['expiration_time'] for job in links)
+        text += f"\n⚠️ Ссылки действительны до: {expiration.strftime('%d.%m.%Y %H:%M:%S')} (1 час)"
+    return text
+
+# Передача обновлений о задачах из очереди в MessageUpdater,
+# который объединяет их и изменяет сообщения с учетом лимитов Telegram
+async def submit_job_reports(updater: MessageUpdater) -> None:
+    jobs = await claim_job_reports()
+    
+    # Для пакета обновляется одно общее сообщение по всем его задачам
+    batch_ids = {job['batch_id'] for job in jobs if job['batch_id']}
+    if batch_ids:
+        batches = await get_batch_jobs(batch_ids)
+        for batch_jobs in batches.values():
+            updater.submit(
+                batch_jobs[0]['chat_id'],
+                batch_jobs[0]['message_id'],
+                format_batch_report(batch_jobs),
+                final=all(job['status'] in ('done', 'failed') for job in batch_jobs)
+            )
+    
+    for job in jobs:
+        if job['batch_id']:
+            continue
+        updater.submit(
+            job['chat_id'],
+            job['message_id'],
+            format_job_report(job),
+            final=job['status'] in ('done', 'failed')
+        )
+
+# Обновление места в очереди в сообщениях о задачах, которые еще ждут выполнения.
+# positions — места, показанные при прошлом обновлении (идентификатор задачи -> место)
+async def submit_queue_positions(updater: MessageUpdater, positions) -> None:
+    current = {}
+    for job in await get_queue_positions(QUEUE_MAX_PENDING or 500):
+        current[job['id']] = job['position']
+        if positions.get(job['id']) != job['position']:
+            updater.submit(job['chat_id'], job['message_id'], format_queued(job))
+    
+    positions.clear()
+    positions.update(current)
+
+# Фоновая задача: периодическая проверка статусов задач и мест в очереди
+async def report_jobs(application: Application) -> None:
+    updater = application.bot_data['message_updater']
+    positions, positions_at = {}, 0
+    
+    while True:
+        try:
+            await submit_job_reports(updater)
+            
+            if time.monotonic() - positions_at >= QUEUE_POSITION_INTERVAL:
+                positions_at = time.monotonic()
+                await submit_queue_positions(updater, positions)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке статусов задач: {e}")
+        
+        await asyncio.sleep(JOB_REPORT_INTERVAL)
+
+# Периодическое удаление истекших состояний диалогов
+async def cleanup_conversation_states() -> None:
+    while True:
+        await asyncio.sleep(CONVERSATION_STATE_TTL / 24)
+        
+        try:
+            deleted = await conversation_states.cleanup()
+            if deleted:
+                logger.info(f"Удалено истекших состояний диалогов: {deleted}")
+        except Exception as e:
+            logger.error(f"Ошибка при удалении состояний диалогов: {e}")
+
+# Каждому обновлению присваивается идентификатор трассировки: он попадает в
+# журналы бота, а через задачу в очереди — и в журналы воркера
+async def assign_trace_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    trace_id_var.set(uuid.uuid4().hex[:12])
+
+# Запуск фоновых задач после инициализации приложения
+async def post_init(application: Application) -> None:
+    updater = MessageUpdater(application.bot)
+    application.bot_data['message_updater'] = updater
+    application.bot_data['updater_task'] = asyncio.create_task(updater.run())
+    application.bot_data['report_task'] = asyncio.create_task(report_jobs(application))
+    application.bot_data['state_cleanup_task'] = asyncio.create_task(cleanup_conversation_states())
+    expiry_engine.start()
+
+# Остановка фоновых задач после обработки последних обновлений. Бот еще
+# не закрыт, поэтому итоговые сообщения о задачах успевают отправиться
+async def post_stop(application: Application) -> None:
+    for name in ('report_task', 'updater_task', 'state_cleanup_task'):
+        task = application.bot_data.get(name)
+        if task:
+            task.cancel()
+    
+    updater = application.bot_data.get('message_updater')
+    if updater:
+        try:
+            await submit_job_reports(updater)
+        except Exception as e:
+            logger.error(f"Ошибка при проверке статусов задач: {e}")
+        unsent = await updater.drain(BOT_DRAIN_TIMEOUT)
+        if unsent:
+            logger.warning(f"При остановке не отправлено итоговых сообщений: {unsent}")
+
+# Остановка пулов потоков и процессов и закрытие соединений с базой при завершении работы
+async def post_shutdown(application: Application) -> None:
+    expiry_engine.stop()
+    shutdown_pools(wait=True)
+    flush_writes()
+    await dispose_engine()
+    dispose_sync_engine()
+
+# Работа через webhook: обновления принимает WebhookServer и кладет в
+# очередь приложения, регистрация webhook выполняется, если задан WEBHOOK_URL
+async def run_webhook(application: Application) -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    server = WebhookServer(
+        application.bot,
+        application.update_queue,
+        UpdateDeduplicator(),
+        WEBHOOK_PATH,
+        WEBHOOK_SECRET_TOKEN
+    )
+    
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    
+    try:
+        await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH.strip('/')}",
+                secret_token=WEBHOOK_SECRET_TOKEN or None,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        await stop.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        await post_stop(application)
+        await application.shutdown()
+        await post_shutdown(application)
+
+# Создаем приложение и добавляем обработчики. bot заменяет бота,
+# создаваемого по токену (используется при измерении времени запуска).
+# Обновления обрабатываются параллельно, чтобы долгая загрузка одного
+# пользователя не задерживала ответы остальным
+def build_application(bot=None) -> Application:
+    builder = Application.builder()
+    if bot is None:
+        builder.token(TELEGRAM_BOT_TOKEN)
+    else:
+        builder.bot(bot)
+    
+    application = (
+        builder
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .update_queue(IntakeQueue(INTAKE_QUEUE_SIZE))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    
+    # Идентификатор трассировки назначается до остальных обработчиков
+    application.add_handler(TypeHandler(Update, assign_trace_id), group=-1)
     
     # Обработчики команд
     application.add_handler(CommandHandler("start", start))
@@ -257,9 +900,27 @@ def main() -> None:
     
     # Обработчик выбора качества
     application.add_handler(CallbackQueryHandler(handle_quality_selection, pattern="^res_"))
+    application.add_handler(CallbackQueryHandler(handle_batch_selection, pattern="^batch_"))
+    
+    return application
+
+# Запуск: проверка схемы базы и сервер метрик.
+# Подключения к базе и Telegram создаются при первом обращении
+def startup() -> None:
+    setup_logging()
+    check_schema()
+    start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+# Основная функция
+def main() -> None:
+    startup()
+    application = build_application()
     
     # Запускаем бота
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
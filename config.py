@@ -10,16 +10,145 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 # Учетные данные MEGA
 MEGA_EMAIL = os.getenv('MEGA_EMAIL')
 MEGA_PASSWORD = os.getenv('MEGA_PASSWORD')
+# Несколько аккаунтов MEGA, между которыми распределяются загрузки: «email:пароль» через запятую;
+# если не заданы, используется один аккаунт MEGA_EMAIL
+MEGA_ACCOUNTS = [
+    tuple(account.strip().split(':', 1))
+    for account in os.getenv('MEGA_ACCOUNTS', '').split(',')
+    if ':' in account
+] or [(MEGA_EMAIL, MEGA_PASSWORD)]
 
 # PostgreSQL подключение
 DATABASE_URL = os.getenv('DATABASE_URL')
 
+# Пул соединений с базой данных (отдельно в каждом процессе; у бота — для синхронного и асинхронного доступа)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))  # постоянных соединений
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))  # дополнительных соединений при пиковой нагрузке
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))  # секунды ожидания свободного соединения
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))  # секунды жизни соединения
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'  # проверка соединения перед выдачей из пула
+# Асинхронный драйвер для запросов бота: auto — только PostgreSQL (asyncpg), true — также SQLite (aiosqlite), false — пул потоков
+DB_ASYNC = os.getenv('DB_ASYNC', 'auto').lower()
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 500))  # подготовленных запросов на соединение asyncpg
+
 # ID администратора бота
 ADMIN_USER_ID = int(os.getenv('ADMIN_USER_ID', 0))
 
 # Временные каталоги
-DOWNLOAD_DIR = "downloads"
-TEMP_DIR = "temp"
+DOWNLOAD_DIR = os.getenv('DOWNLOAD_DIR', 'downloads')
+TEMP_DIR = os.getenv('TEMP_DIR', 'temp')
 
 # Время жизни ссылки и файла на MEGA (в секундах)
-LINK_EXPIRATION_TIME = 3600  # 1 час 
\ No newline at end of file
+LINK_EXPIRATION_TIME = 3600  # 1 час 
+
+# Размеры пулов для блокирующих операций
+IO_POOL_SIZE = int(os.getenv('IO_POOL_SIZE', 32))  # потоки для pytube, MEGA и базы данных
+CPU_POOL_SIZE = int(os.getenv('CPU_POOL_SIZE', os.cpu_count() or 2))  # процессы для тяжелых вычислений
+
+# Максимальное число одновременно обрабатываемых обновлений Telegram
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 256))
+
+# Очередь задач и воркеры
+QUEUE_MAX_RUNNING = int(os.getenv('QUEUE_MAX_RUNNING', 20))  # одновременно выполняемых задач на все воркеры
+QUEUE_MAX_RUNNING_PER_USER = int(os.getenv('QUEUE_MAX_RUNNING_PER_USER', 2))  # одновременно выполняемых задач одного пользователя
+QUEUE_MAX_PENDING = int(os.getenv('QUEUE_MAX_PENDING', 500))  # задач в ожидании на все воркеры; при заполнении новые запросы отклоняются (0 — без ограничения)
+QUEUE_MAX_PENDING_PER_USER = int(os.getenv('QUEUE_MAX_PENDING_PER_USER', 20))  # задач одного пользователя в ожидании (0 — без ограничения)
+QUEUE_POSITION_INTERVAL = float(os.getenv('QUEUE_POSITION_INTERVAL', 10))  # секунды между обновлениями места в очереди в сообщениях
+WORKER_CONCURRENCY = int(os.getenv('WORKER_CONCURRENCY', 4))  # задач на один процесс воркера
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', 2))  # секунды между опросами пустой очереди
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 2))
+JOB_STALE_TIMEOUT = int(os.getenv('JOB_STALE_TIMEOUT', 300))  # секунды без heartbeat до возврата задачи в очередь
+JOB_REPORT_INTERVAL = float(os.getenv('JOB_REPORT_INTERVAL', 1))  # секунды между проверками статусов задач в боте
+WORKER_DRAIN_TIMEOUT = float(os.getenv('WORKER_DRAIN_TIMEOUT', 25))  # секунды на завершение текущих задач при остановке воркера
+BOT_DRAIN_TIMEOUT = float(os.getenv('BOT_DRAIN_TIMEOUT', 5))  # секунды на отправку итоговых сообщений о задачах при остановке бота
+
+# Потоковая загрузка на MEGA без сохранения файла на диск
+STREAMING_UPLOAD = os.getenv('STREAMING_UPLOAD', 'true').lower() == 'true'
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 256 * 1024))  # байт в одном фрагменте буфера
+STREAM_RANGE_SIZE = int(os.getenv('STREAM_RANGE_SIZE', 9 * 1024 * 1024))  # байт в одном Range-запросе к YouTube
+STREAM_BUFFER_CHUNKS = int(os.getenv('STREAM_BUFFER_CHUNKS', 8))  # фрагментов в буфере между скачиванием и загрузкой
+
+# Пул сессий MEGA
+MEGA_POOL_SIZE = int(os.getenv('MEGA_POOL_SIZE', 4))  # одновременно открытых сессий на аккаунт
+MEGA_FILES_CACHE_TTL = int(os.getenv('MEGA_FILES_CACHE_TTL', 600))  # секунды хранения дерева файлов аккаунта
+MEGA_ACCOUNT_QUOTA_GB = float(os.getenv('MEGA_ACCOUNT_QUOTA_GB', 20))  # место на одном аккаунте (бесплатный — 20 ГБ)
+MEGA_USAGE_REFRESH = int(os.getenv('MEGA_USAGE_REFRESH', 60))  # секунды между пересчетами занятого места по базе
+
+# Объединение адаптивных потоков и перекодирование в MP3
+FFMPEG_PATH = os.getenv('FFMPEG_PATH', 'ffmpeg')
+MP3_BITRATE = os.getenv('MP3_BITRATE', '192k')
+
+# Параллельная загрузка частями с возобновлением
+DOWNLOAD_CONNECTIONS = int(os.getenv('DOWNLOAD_CONNECTIONS', 4))  # соединений на один файл
+DOWNLOAD_PART_SIZE = int(os.getenv('DOWNLOAD_PART_SIZE', 4 * 1024 * 1024))  # байт в одной части
+DOWNLOAD_RETRIES = int(os.getenv('DOWNLOAD_RETRIES', 3))  # повторов для одной части
+
+# Кэш метаданных видео (название, длительность, список потоков)
+METADATA_CACHE_SIZE = int(os.getenv('METADATA_CACHE_SIZE', 1000))  # записей в памяти процесса
+METADATA_CACHE_TTL = int(os.getenv('METADATA_CACHE_TTL', 3600))  # секунды; не дольше срока действия ссылок на потоки
+
+# Отложенная пакетная запись в базу данных
+WRITE_BUFFER_MAX_ITEMS = int(os.getenv('WRITE_BUFFER_MAX_ITEMS', 200))  # изменений до принудительной записи
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.getenv('WRITE_BUFFER_FLUSH_INTERVAL', 2))  # секунды между записями
+
+# Локальное хранилище загруженных файлов
+FILE_STORE_QUOTA_MB = int(os.getenv('FILE_STORE_QUOTA_MB', 2048))  # МБ на диске под загрузки и временные файлы
+FILE_STORE_TTL = int(os.getenv('FILE_STORE_TTL', 3600))  # секунды хранения неиспользуемого файла
+FILE_STORE_EVICT_INTERVAL = int(os.getenv('FILE_STORE_EVICT_INTERVAL', 60))  # секунды между проверками
+
+# Удаление истекших файлов с MEGA
+EXPIRY_BATCH_SIZE = int(os.getenv('EXPIRY_BATCH_SIZE', 100))  # файлов в одном запросе удаления
+EXPIRY_REFRESH_INTERVAL = float(os.getenv('EXPIRY_REFRESH_INTERVAL', 30))  # секунды между чтениями сроков из базы
+EXPIRY_RETRY_DELAY = int(os.getenv('EXPIRY_RETRY_DELAY', 300))  # секунды до повторного удаления файла после ошибки
+
+# Отображение прогресса задач
+PROGRESS_WRITE_INTERVAL = float(os.getenv('PROGRESS_WRITE_INTERVAL', 2))  # секунды между записями прогресса задачи в базу
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', 3))  # секунды между изменениями одного сообщения
+TELEGRAM_EDIT_RATE = float(os.getenv('TELEGRAM_EDIT_RATE', 20))  # изменений сообщений в секунду на весь бот
+
+# Пакетная загрузка (плейлисты и несколько ссылок в одном сообщении)
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 20))  # видео в одном пакете
+BATCH_METADATA_CONCURRENCY = int(os.getenv('BATCH_METADATA_CONCURRENCY', 8))  # одновременных запросов информации о видео
+
+# Отправка небольших файлов напрямую в Telegram вместо MEGA
+TELEGRAM_DIRECT_DELIVERY = os.getenv('TELEGRAM_DIRECT_DELIVERY', 'true').lower() == 'true'
+TELEGRAM_DIRECT_MAX_MB = float(os.getenv('TELEGRAM_DIRECT_MAX_MB', 49))  # Bot API принимает файлы до 50 МБ
+TELEGRAM_UPLOAD_TIMEOUT = float(os.getenv('TELEGRAM_UPLOAD_TIMEOUT', 300))  # секунды на отправку одного файла
+TELEGRAM_DIRECT_CONCURRENCY = int(os.getenv('TELEGRAM_DIRECT_CONCURRENCY', 2))  # файлов, одновременно отправляемых воркером (каждый читается в память)
+
+# Метрики и трассировка
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # порт HTTP-сервера /metrics; 0 — не запускать
+LOG_TRACE_IDS = os.getenv('LOG_TRACE_IDS', 'true').lower() == 'true'  # идентификатор задачи в каждой записи журнала
+
+# Режим получения обновлений: polling (getUpdates) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', 8443)))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # публичный адрес сервиса; если пуст, webhook не регистрируется при запуске
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')  # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))  # одновременных соединений от Telegram
+INTAKE_QUEUE_SIZE = int(os.getenv('INTAKE_QUEUE_SIZE', 1000))  # обновлений в очереди; при заполнении Telegram получает 503
+WEBHOOK_READ_TIMEOUT = float(os.getenv('WEBHOOK_READ_TIMEOUT', 10))  # секунды на получение заголовков и тела запроса
+WEBHOOK_IDLE_TIMEOUT = float(os.getenv('WEBHOOK_IDLE_TIMEOUT', 60))  # секунды ожидания следующего запроса в постоянном соединении
+UPDATE_DEDUP_TTL = int(os.getenv('UPDATE_DEDUP_TTL', 86400))  # секунды хранения отметок об обработанных обновлениях
+
+# Состояние диалогов (выбранное видео, список видео пакета)
+CONVERSATION_STATE_TTL = int(os.getenv('CONVERSATION_STATE_TTL', 86400))  # секунды, в течение которых работают кнопки сообщения
+CONVERSATION_STATE_CACHE_SIZE = int(os.getenv('CONVERSATION_STATE_CACHE_SIZE', 10000))  # записей в памяти процесса
+
+# Упреждающая загрузка наиболее вероятного качества, пока пользователь выбирает
+SPECULATIVE_PREFETCH = os.getenv('SPECULATIVE_PREFETCH', 'false').lower() == 'true'
+SPECULATIVE_MAX_RUNNING = int(os.getenv('SPECULATIVE_MAX_RUNNING', 2))  # одновременных упреждающих загрузок на все воркеры
+SPECULATIVE_BANDWIDTH_MB = float(os.getenv('SPECULATIVE_BANDWIDTH_MB', 5))  # МБ/с на упреждающие загрузки одного воркера
+SPECULATIVE_MAX_MB = float(os.getenv('SPECULATIVE_MAX_MB', 200))  # файлы больше заранее не загружаются
+SPECULATIVE_HISTORY = int(os.getenv('SPECULATIVE_HISTORY', 20))  # последних загрузок пользователя для выбора качества
+
+# Ограничение скорости загрузок и отправки на все воркеры (0 — без ограничения)
+ADMISSION_BANDWIDTH_MB = float(os.getenv('ADMISSION_BANDWIDTH_MB', 0))  # МБ/с на все задачи всех воркеров
+ADMISSION_USER_BANDWIDTH_MB = float(os.getenv('ADMISSION_USER_BANDWIDTH_MB', 0))  # МБ/с на задачи одного пользователя
+ADMISSION_SHARE_INTERVAL = float(os.getenv('ADMISSION_SHARE_INTERVAL', 5))  # секунды между пересчетами доли лимита воркера
+
+# Вырезка фрагмента видео по отрезку времени в сообщении (например, «ссылка 1:30-2:00»)
+CLIP_INDEX_PROBE_SIZE = int(os.getenv('CLIP_INDEX_PROBE_SIZE', 16 * 1024))  # байт, читаемых сначала при поиске индекса фрагментов в потоке
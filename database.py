@@ -1,14 +1,109 @@
 import os
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Text, BigInteger, func
+import json
+import time
+import uuid
+import atexit
+import logging
+import functools
+import threading
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine, select, Column, Integer, String, Float, Date, DateTime, ForeignKey, Text, BigInteger, Boolean, UniqueConstraint, func, text, exists, inspect, and_, or_, case
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from config import DATABASE_URL
+from sqlalchemy.orm import sessionmaker, relationship, aliased
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from config import (
+    DATABASE_URL, LINK_EXPIRATION_TIME, WRITE_BUFFER_MAX_ITEMS, WRITE_BUFFER_FLUSH_INTERVAL, EXPIRY_RETRY_DELAY,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING
+)
+from metrics import stage_seconds, db_writes, db_pool_wait_seconds, db_pool_in_use, cache_lookups
+from admission import check_queue
+
+logger = logging.getLogger(__name__)
+
+class PoolMetricsMixin:
+    """Учет времени ожидания соединения и числа выданных соединений пула"""
+    
+    pool_name = None
+    
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_wait_seconds.observe(time.monotonic() - started, pool=self.pool_name)
+            db_pool_in_use.set(self.checkedout(), pool=self.pool_name)
+    
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        db_pool_in_use.set(self.checkedout(), pool=self.pool_name)
+
+class MeteredQueuePool(PoolMetricsMixin, QueuePool):
+    pool_name = 'sync'
+
+def engine_options(url, pool_class):
+    """Настройки пула соединений; база SQLite в памяти остается с пулом по умолчанию"""
+    if url.startswith('sqlite') and (':memory:' in url or url.split('?')[0].rstrip('/').endswith(':')):
+        return {}
+    
+    return {
+        'poolclass': pool_class,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+# Соединение с базой создается при первом обращении, а не при импорте:
+# импорт модуля не подключается к базе и не меняет схему (см. migrate.py)
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker()
+
+def get_engine():
+    """Движок базы данных, создаваемый при первом обращении"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL, MeteredQueuePool))
+    return _engine
+
+def Session():
+    """Новая сессия, привязанная к движку базы данных"""
+    return _session_factory(bind=get_engine())
+
+def dispose_engine():
+    """Закрытие соединений пула при остановке процесса"""
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+
+def with_session(body):
+    """Функция базы данных, общая для синхронного и асинхронного доступа.
+    
+    body получает открытую сессию первым аргументом. Синхронный вызов
+    открывает и закрывает сессию сам, а database_async выполняет то же
+    тело (function.body) в асинхронной сессии через AsyncSession.run_sync,
+    поэтому запросы описаны только здесь.
+    """
+    @functools.wraps(body)
+    def function(*args, **kwargs):
+        session = Session()
+        
+        try:
+            return body(session, *args, **kwargs)
+        finally:
+            session.close()
+    
+    function.body = body
+    return function
 
-# Создаем соединение с базой данных
-engine = create_engine(DATABASE_URL)
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
 
 # Определяем модели данных
 class User(Base):
@@ -18,8 +113,8 @@ class User(Base):
     user_id = Column(BigInteger, unique=True, nullable=False)
     username = Column(String(255))
     first_name = Column(String(255))
-    last_active = Column(DateTime, default=datetime.now)
-    total_downloads = Column(Integer, default=0)
+    last_active = Column(DateTime, default=datetime.now, index=True)
+    total_downloads = Column(Integer, default=0, index=True)
     registered_at = Column(DateTime, default=datetime.now)
     
     # Отношения
@@ -29,12 +124,12 @@ class Download(Base):
     __tablename__ = 'downloads'
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(BigInteger, ForeignKey('users.user_id'))
+    user_id = Column(BigInteger, ForeignKey('users.user_id'), index=True)
     youtube_url = Column(String(255))
     quality = Column(String(50))
     file_size = Column(Float)
     file_format = Column(String(10))
-    timestamp = Column(DateTime, default=datetime.now)
+    timestamp = Column(DateTime, default=datetime.now, index=True)
     
     # Отношения
     user = relationship("User", back_populates="downloads")
@@ -46,163 +141,1557 @@ class MegaFile(Base):
     file_id = Column(String(255), unique=True)
     path = Column(String(255))
     link = Column(Text)
+    # Аккаунт MEGA (адрес), на который загружен файл; пусто — первый аккаунт из настроек
+    account = Column(String(255))
+    file_size = Column(BigInteger)
     uploaded_at = Column(DateTime, default=datetime.now)
+    expiration_time = Column(DateTime, index=True)
+
+class Job(Base):
+    __tablename__ = 'jobs'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, index=True)
+    chat_id = Column(BigInteger)
+    message_id = Column(BigInteger)
+    youtube_url = Column(String(255))
+    video_id = Column(String(32), index=True)
+    video_title = Column(String(255))
+    quality = Column(String(50))
+    # Фрагмент видео «начало-конец» в секундах; пусто — видео целиком
+    clip = Column(String(32))
+    # Пакетная загрузка (плейлист или список ссылок): у задач пакета общее сообщение
+    batch_id = Column(String(32), index=True)
+    # pending -> running -> done / failed; упреждающая задача: running -> prefetched / cancelled
+    status = Column(String(20), default='pending', index=True)
+    worker_id = Column(String(255))
+    attempts = Column(Integer, default=0)
+    error = Column(Text)
+    # Результат: ссылка MEGA или файл, отправленный в чат (delivery = mega / telegram)
+    delivery = Column(String(20))
+    link = Column(Text)
+    file_size = Column(Float)
+    file_format = Column(String(10))
     expiration_time = Column(DateTime)
+    # Обработка ffmpeg: этап, время и процессорное время в секундах
+    process_stage = Column(String(20))
+    process_time = Column(Float)
+    process_cpu_time = Column(Float)
+    # Прогресс выполнения: этап (download, mux, transcode, upload, stream) и байты
+    stage = Column(String(20))
+    bytes_done = Column(BigInteger)
+    bytes_total = Column(BigInteger)
+    stage_started_at = Column(DateTime)
+    progress_at = Column(DateTime)
+    # Идентификатор трассировки запроса пользователя для журналов бота и воркера
+    trace_id = Column(String(32))
+    # Упреждающая загрузка качества, которое пользователь еще не выбрал;
+    # confirmed — пользователь выбрал это качество, задача стала обычной
+    speculative = Column(Boolean, default=False)
+    confirmed = Column(Boolean, default=False)
+    # Флаг для бота: статус изменился и пользователю нужно отправить обновление
+    needs_report = Column(Boolean, default=False, index=True)
+    created_at = Column(DateTime, default=datetime.now)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime, index=True)
 
-# Создаем таблицы в базе данных
+class ResultCache(Base):
+    __tablename__ = 'result_cache'
+    __table_args__ = (UniqueConstraint('video_id', 'quality'),)
+    
+    id = Column(Integer, primary_key=True)
+    video_id = Column(String(32), nullable=False)
+    quality = Column(String(50), nullable=False)
+    mega_file_id = Column(String(255), ForeignKey('mega_files.file_id'), nullable=False)
+    file_size = Column(Float)
+    file_format = Column(String(10))
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+    last_hit_at = Column(DateTime)
+
+# Файлы, отправленные напрямую в Telegram: по file_id их можно отправить
+# повторно без загрузки, срок действия у file_id не ограничен
+class TelegramFile(Base):
+    __tablename__ = 'telegram_files'
+    __table_args__ = (UniqueConstraint('video_id', 'quality'),)
+    
+    id = Column(Integer, primary_key=True)
+    video_id = Column(String(32), nullable=False)
+    quality = Column(String(50), nullable=False)
+    file_id = Column(String(255), nullable=False)
+    file_size = Column(Float)
+    file_format = Column(String(10))
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+    last_hit_at = Column(DateTime)
+
+class VideoMetadata(Base):
+    __tablename__ = 'video_metadata'
+    
+    video_id = Column(String(32), primary_key=True)
+    data = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+# Состояние диалога, привязанное к сообщению с клавиатурой (например,
+# выбранное видео или список видео пакета). Хранится в базе, чтобы нажатие
+# кнопки обработал любой экземпляр бота, в том числе после перезапуска
+class ConversationState(Base):
+    __tablename__ = 'conversation_states'
+    
+    key = Column(String(64), primary_key=True)
+    data = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+# Обработанные обновления Telegram: при работе через webhook Telegram может
+# доставить одно обновление повторно, в том числе другому экземпляру бота
+class ProcessedUpdate(Base):
+    __tablename__ = 'processed_updates'
+    
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    received_at = Column(DateTime, nullable=False, index=True)
+
+# Агрегаты статистики, обновляемые при каждой записи, чтобы /stats
+# не сканировал таблицы users и downloads
+class StatsCounter(Base):
+    __tablename__ = 'stats_counters'
+    
+    name = Column(String(50), primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+class DailyStats(Base):
+    __tablename__ = 'daily_stats'
+    
+    date = Column(Date, primary_key=True)
+    downloads = Column(Integer, nullable=False, default=0)
+    megabytes = Column(Float, nullable=False, default=0)
+    active_users = Column(Integer, nullable=False, default=0)
+    new_users = Column(Integer, nullable=False, default=0)
+
+class DailyQualityStats(Base):
+    __tablename__ = 'daily_quality_stats'
+    
+    date = Column(Date, primary_key=True)
+    quality = Column(String(50), primary_key=True)
+    downloads = Column(Integer, nullable=False, default=0)
+
+class DailyFormatStats(Base):
+    __tablename__ = 'daily_format_stats'
+    
+    date = Column(Date, primary_key=True)
+    file_format = Column(String(10), primary_key=True)
+    downloads = Column(Integer, nullable=False, default=0)
+
+class DailyActiveUser(Base):
+    # Пользователи, уже учтенные в DailyStats.active_users за день
+    __tablename__ = 'daily_active_users'
+    
+    date = Column(Date, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+
+# Ключ advisory-блокировки PostgreSQL для выбора и постановки задач (lock_job_queue)
+JOB_CLAIM_LOCK_KEY = 7312001
+# Попыток захвата задачи, если выбранную задачу успел захватить другой воркер
+JOB_CLAIM_RETRIES = 5
+
+# Добавление в существующие таблицы столбцов, появившихся в моделях.
+# create_all создает только отсутствующие таблицы, а новые столбцы
+# (всегда допускающие NULL) нужно добавить вручную
+def add_missing_columns():
+    engine = get_engine()
+    inspector = inspect(engine)
+    
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+# Создание индексов, объявленных в моделях, для уже существующих таблиц
+def add_missing_indexes():
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=get_engine(), checkfirst=True)
+
+def missing_schema():
+    """Таблицы и столбцы моделей, которых еще нет в базе"""
+    inspector = inspect(get_engine())
+    missing = []
+    
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            missing.append(table.name)
+            continue
+        
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        missing.extend(f"{table.name}.{column.name}" for column in table.columns if column.name not in existing)
+    
+    return missing
+
+def check_schema():
+    """Проверка при запуске бота и воркера, что миграция уже выполнена"""
+    missing = missing_schema()
+    if missing:
+        raise RuntimeError(f"Схема базы данных устарела (нет {', '.join(missing)}), выполните python migrate.py")
+
+# Создаем таблицы в базе данных. Вызывается один раз при развертывании
+# (python migrate.py), а не при каждом запуске бота и воркера
 def init_db():
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(get_engine())
+    add_missing_columns()
+    add_missing_indexes()
+    
+    # Агрегаты появились в уже работающей базе: заполняем их один раз по истории
+    session = Session()
+    try:
+        has_counters = session.query(StatsCounter).first() is not None
+    finally:
+        session.close()
+    
+    if not has_counters:
+        rebuild_stats()
+
+@with_session
+def register_user(session, user_id, username, first_name):
+    """Регистрация нового пользователя или обновление информации о существующем.
+    
+    Возвращает True, если пользователь новый. Пользователь учитывается среди
+    активных за день так же, как при действиях через буфер записи.
+    """
+    now = datetime.now()
+    
+    # Строку пользователя мог одновременно создать буфер записи: новым
+    # считается пользователь, только если строку создала эта вставка
+    created = session.execute(upsert(User.__table__).values(
+        user_id=user_id,
+        username=username,
+        first_name=first_name,
+        last_active=now,
+        total_downloads=0,
+        registered_at=now
+    ).on_conflict_do_nothing()).rowcount > 0
+    
+    if not created:
+        session.query(User).filter_by(user_id=user_id).update({
+            'username': username,
+            'first_name': first_name,
+            'last_active': now
+        }, synchronize_session=False)
+    
+    active = mark_active_users(session, now.date(), [user_id])
+    increment_rows(session, DailyStats, ['date'], [{'date': now.date(), 'active_users': active, 'new_users': int(created)}])
+    increment_counters(session, {'total_users': int(created)})
+    session.commit()
+    return created
 
-# Инициализация базы данных при импорте
-init_db()
+def upsert(table):
+    """INSERT ... ON CONFLICT для текущей базы данных (PostgreSQL или SQLite)"""
+    if get_engine().dialect.name == 'postgresql':
+        return postgresql_insert(table)
+    return sqlite_insert(table)
 
-def register_user(user_id, username, first_name):
-    """Регистрация нового пользователя или обновление информации о существующем"""
+def increment_rows(session, model, key_columns, rows):
+    """Прибавление значений к строкам агрегата (строка создается при отсутствии)"""
+    if not rows:
+        return
+    
+    table = model.__table__
+    value_columns = [name for name in rows[0] if name not in key_columns]
+    
+    # Все строки одного INSERT должны иметь одинаковый набор столбцов
+    rows = [{name: row.get(name, 0) for name in key_columns + value_columns} for row in rows]
+    statement = upsert(table).values(rows)
+    session.execute(statement.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={name: table.c[name] + statement.excluded[name] for name in value_columns}
+    ))
+
+def increment_counters(session, increments):
+    """Увеличение глобальных счетчиков статистики"""
+    increment_rows(session, StatsCounter, ['name'], [
+        {'name': name, 'value': value} for name, value in increments.items() if value
+    ])
+
+def mark_active_users(session, day, user_ids):
+    """Учет активных за день пользователей; возвращает число впервые активных за этот день"""
+    if not user_ids:
+        return 0
+    
+    statement = upsert(DailyActiveUser.__table__).values([
+        {'date': day, 'user_id': user_id} for user_id in user_ids
+    ]).on_conflict_do_nothing()
+    return session.execute(statement).rowcount
+
+def update_download_stats(session, downloads):
+    """Обновление агрегатов по новым записям журнала загрузок"""
+    daily, qualities, formats = {}, {}, {}
+    
+    for row in downloads:
+        day = row['timestamp'].date()
+        totals = daily.setdefault(day, {'date': day, 'downloads': 0, 'megabytes': 0})
+        totals['downloads'] += 1
+        totals['megabytes'] += row['file_size'] or 0
+        
+        quality = qualities.setdefault((day, row['quality']), {'date': day, 'quality': row['quality'], 'downloads': 0})
+        quality['downloads'] += 1
+        
+        file_format = formats.setdefault((day, row['file_format']), {'date': day, 'file_format': row['file_format'], 'downloads': 0})
+        file_format['downloads'] += 1
+    
+    increment_rows(session, DailyStats, ['date'], list(daily.values()))
+    increment_rows(session, DailyQualityStats, ['date', 'quality'], list(qualities.values()))
+    increment_rows(session, DailyFormatStats, ['date', 'file_format'], list(formats.values()))
+    increment_counters(session, {'total_downloads': len(downloads)})
+
+def update_activity_stats(session, users, new_users):
+    """Обновление агрегатов по активности пользователей из пакета записи; new_users — созданных пользователей"""
+    by_day = {}
+    for user_id, entry in users.items():
+        by_day.setdefault(entry['last_active'].date(), []).append(user_id)
+    
+    rows = []
+    for day, user_ids in by_day.items():
+        rows.append({'date': day, 'active_users': mark_active_users(session, day, user_ids), 'new_users': 0})
+    
+    if new_users:
+        rows.append({'date': date.today(), 'active_users': 0, 'new_users': new_users})
+    
+    increment_rows(session, DailyStats, ['date'], rows)
+    increment_counters(session, {'total_users': new_users})
+    
+    # Отметки за прошедшие дни больше не нужны: число активных уже в DailyStats
+    session.query(DailyActiveUser).filter(DailyActiveUser.date < date.today() - timedelta(days=1)).delete()
+
+class WriteBehindBuffer:
+    """Отложенная пакетная запись в базу данных.
+    
+    Через буфер идут только статистика и активность, потеря которых при
+    сбое процесса некритична. Записи накапливаются в памяти и объединяются:
+    обновления пользователя сливаются в одну строку, журнал загрузок
+    вставляется многострочным INSERT, а приращения счетчиков статистики
+    суммируются.
+    Весь пакет пишется одной транзакцией при
+    накоплении max_items записей, раз в interval секунд и при завершении работы.
+    """
+    
+    def __init__(self, max_items, interval):
+        self.max_items = max_items
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self._reset()
+    
+    def _reset(self):
+        self.users = {}
+        self.downloads = []
+        self.counters = {}
+        self.size = 0
+    
+    def _added(self):
+        # Вызывается под self.lock
+        self.size += 1
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self.thread.start()
+        if self.size >= self.max_items:
+            self.wakeup.set()
+    
+    def touch_user(self, user_id, downloads=0):
+        with self.lock:
+            entry = self.users.setdefault(user_id, {'last_active': None, 'downloads': 0})
+            entry['last_active'] = datetime.now()
+            entry['downloads'] += downloads
+            self._added()
+    
+    def add_download(self, row):
+        with self.lock:
+            self.downloads.append(row)
+            self._added()
+    
+    def add_counters(self, increments):
+        with self.lock:
+            for name, value in increments.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self._added()
+    
+    def _write(self, session, users, downloads, counters):
+        if users:
+            # Пользователь создается, если он еще не нажимал /start. Новые
+            # пользователи считаются по созданным строкам, а не по проверке
+            # заранее: пользователя, одновременно созданного register_user,
+            # нельзя учесть дважды
+            created = session.execute(upsert(User.__table__).values([
+                {
+                    'user_id': user_id,
+                    'last_active': entry['last_active'],
+                    'total_downloads': 0,
+                    'registered_at': entry['last_active']
+                }
+                for user_id, entry in users.items()
+            ]).on_conflict_do_nothing()).rowcount
+            update_activity_stats(session, users, created)
+            
+            # Обновляются время активности и счетчик загрузок
+            statement = upsert(User.__table__).values([
+                {
+                    'user_id': user_id,
+                    'last_active': entry['last_active'],
+                    'total_downloads': entry['downloads'],
+                    'registered_at': entry['last_active']
+                }
+                for user_id, entry in users.items()
+            ])
+            session.execute(statement.on_conflict_do_update(
+                index_elements=['user_id'],
+                set_={
+                    'last_active': statement.excluded.last_active,
+                    'total_downloads': User.__table__.c.total_downloads + statement.excluded.total_downloads
+                }
+            ))
+        
+        if downloads:
+            session.execute(Download.__table__.insert().values(downloads))
+            update_download_stats(session, downloads)
+        
+        increment_counters(session, counters)
+    
+    def flush(self):
+        """Запись накопленных изменений одной транзакцией"""
+        with self.flush_lock:
+            with self.lock:
+                batch = (self.users, self.downloads, self.counters)
+                size = self.size
+                self._reset()
+            
+            if not size:
+                return
+            
+            session = Session()
+            
+            try:
+                with stage_seconds.time(stage='db_flush'):
+                    self._write(session, *batch)
+                    session.commit()
+                db_writes.inc(size)
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Ошибка при пакетной записи в базу данных: {e}")
+                self._restore(*batch, size=size)
+            finally:
+                session.close()
+    
+    def _restore(self, users, downloads, counters, size):
+        """Возврат неудачно записанного пакета в буфер для повторной попытки"""
+        with self.lock:
+            if self.size + size > self.max_items * 100:
+                logger.error(f"Буфер записи переполнен, отброшено изменений: {size}")
+                return
+            
+            for user_id, entry in users.items():
+                current = self.users.setdefault(user_id, {'last_active': None, 'downloads': 0})
+                current['last_active'] = max(filter(None, [current['last_active'], entry['last_active']]))
+                current['downloads'] += entry['downloads']
+            self.downloads[:0] = downloads
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.size += size
+    
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+# Общий буфер отложенной записи; сбрасывается и при выходе из процесса
+write_buffer = WriteBehindBuffer(WRITE_BUFFER_MAX_ITEMS, WRITE_BUFFER_FLUSH_INTERVAL)
+atexit.register(write_buffer.flush)
+
+def flush_writes():
+    """Немедленная запись накопленных изменений"""
+    write_buffer.flush()
+
+def update_user_activity(user_id):
+    """Обновление времени последней активности пользователя (отложенная запись)"""
+    write_buffer.touch_user(user_id)
+
+def increment_download_count(user_id):
+    """Увеличение счетчика загрузок для пользователя (отложенная запись)"""
+    write_buffer.touch_user(user_id, downloads=1)
+
+def log_download(user_id, youtube_url, quality, file_size, file_format):
+    """Логирование загрузки в базе данных (отложенная запись)"""
+    write_buffer.add_download({
+        'user_id': user_id,
+        'youtube_url': youtube_url,
+        'quality': quality,
+        'file_size': file_size,
+        'file_format': file_format,
+        'timestamp': datetime.now()
+    })
+
+def register_mega_file(file_id, path, link, expiration_time, account=None, file_size=None):
+    """Регистрация файла, загруженного на аккаунт MEGA account.
+    
+    Запись сразу фиксируется, а не откладывается в буфер: по ней файл
+    удаляется с MEGA, и без нее место на аккаунте было бы занято навсегда.
+    """
+    session = Session()
+    
+    try:
+        session.add(MegaFile(
+            file_id=file_id,
+            path=path,
+            link=link,
+            account=account,
+            file_size=file_size,
+            uploaded_at=datetime.now(),
+            expiration_time=expiration_time
+        ))
+        session.commit()
+    finally:
+        session.close()
+
+def get_mega_usage():
+    """Место, занятое еще не удаленными файлами на аккаунтах MEGA: аккаунт -> байты"""
+    session = Session()
+    
+    try:
+        return dict(
+            session.query(MegaFile.account, func.coalesce(func.sum(MegaFile.file_size), 0))
+            .group_by(MegaFile.account)
+            .all()
+        )
+    finally:
+        session.close()
+
+def get_upcoming_mega_expirations(limit):
+    """Ближайшие сроки истечения файлов на MEGA (по индексу expiration_time)"""
+    session = Session()
+    
+    try:
+        rows = session.query(MegaFile.expiration_time).filter(
+            MegaFile.expiration_time.isnot(None)
+        ).order_by(MegaFile.expiration_time).limit(limit).all()
+        return [row.expiration_time for row in rows]
+    finally:
+        session.close()
+
+def expire_mega_files(destroy, limit):
+    """Удаление пачки истекших файлов MEGA.
+    
+    Истекшие записи блокируются (FOR UPDATE SKIP LOCKED), поэтому несколько
+    процессов бота и воркеров разбирают разные пачки. destroy(file_ids, account)
+    удаляет файлы одного аккаунта MEGA одним запросом и возвращает
+    идентификаторы, которых там больше нет; их записи и записи кэша
+    результатов удаляются в той же транзакции. Ошибка удаления на одном
+    аккаунте не мешает удалению файлов остальных. Удаление неудаленных
+    откладывается на EXPIRY_RETRY_DELAY секунд, чтобы они не занимали
+    начало каждой пачки. Возвращает число
+    удаленных файлов и наибольшую задержку удаления относительно срока
+    истечения (в секундах).
+    """
+    session = Session()
+    
+    try:
+        now = datetime.now()
+        files = session.query(MegaFile.file_id, MegaFile.account, MegaFile.expiration_time).filter(
+            MegaFile.expiration_time <= now
+        ).order_by(MegaFile.expiration_time).limit(limit).with_for_update(skip_locked=True).all()
+        
+        if not files:
+            session.rollback()
+            return 0, None
+        
+        accounts = {}
+        for file in files:
+            accounts.setdefault(file.account, []).append(file.file_id)
+        
+        removed = set()
+        for account, file_ids in accounts.items():
+            try:
+                removed.update(destroy(file_ids, account))
+            except Exception as e:
+                logger.error(f"Ошибка при удалении файлов с аккаунта MEGA {account or 'по умолчанию'}: {e}")
+        
+        if removed:
+            session.query(ResultCache).filter(
+                ResultCache.mega_file_id.in_(removed)
+            ).delete(synchronize_session=False)
+            session.query(MegaFile).filter(
+                MegaFile.file_id.in_(removed)
+            ).delete(synchronize_session=False)
+        
+        failed = [file.file_id for file in files if file.file_id not in removed]
+        if failed:
+            session.query(MegaFile).filter(MegaFile.file_id.in_(failed)).update(
+                {MegaFile.expiration_time: now + timedelta(seconds=EXPIRY_RETRY_DELAY)},
+                synchronize_session=False
+            )
+        session.commit()
+        
+        lags = [(now - file.expiration_time).total_seconds() for file in files if file.file_id in removed]
+        return len(removed), max(lags, default=None)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+@with_session
+def get_stats(session):
+    """Получение статистики для администратора.
+    
+    Все значения берутся из агрегатов (счетчики и строки за последние
+    30 дней), поэтому время ответа не зависит от размера истории.
+    """
+    counters = dict(session.query(StatsCounter.name, StatsCounter.value).all())
+    
+    today = date.today()
+    month_start = today - timedelta(days=29)
+    
+    # Загрузки и объем за периоды
+    daily = {row.date: row for row in session.query(DailyStats).filter(DailyStats.date >= month_start).all()}
+    ranges = {}
+    for name, days in [('today', 1), ('week', 7), ('month', 30)]:
+        rows = [row for day, row in daily.items() if day > today - timedelta(days=days)]
+        ranges[name] = {
+            'downloads': sum(row.downloads for row in rows),
+            'megabytes': sum(row.megabytes for row in rows),
+            'new_users': sum(row.new_users for row in rows)
+        }
+    
+    # Распределение по качеству и формату за 30 дней
+    qualities = dict(
+        session.query(DailyQualityStats.quality, func.sum(DailyQualityStats.downloads))
+        .filter(DailyQualityStats.date >= month_start)
+        .group_by(DailyQualityStats.quality)
+        .all()
+    )
+    formats = dict(
+        session.query(DailyFormatStats.file_format, func.sum(DailyFormatStats.downloads))
+        .filter(DailyFormatStats.date >= month_start)
+        .group_by(DailyFormatStats.file_format)
+        .all()
+    )
+    
+    # Топ пользователей по загрузкам (по индексу на total_downloads)
+    top_users = session.query(User).order_by(User.total_downloads.desc()).limit(5).all()
+    
+    # Преобразуем объекты User в словари
+    top_users_list = []
+    for user in top_users:
+        top_users_list.append({
+            'user_id': user.user_id,
+            'username': user.username,
+            'first_name': user.first_name,
+            'total_downloads': user.total_downloads
+        })
+    
+    return {
+        'total_users': counters.get('total_users', 0),
+        'total_downloads': counters.get('total_downloads', 0),
+        'downloads_today': ranges['today']['downloads'],
+        'active_users_today': daily[today].active_users if today in daily else 0,
+        'ranges': ranges,
+        'qualities': qualities,
+        'formats': formats,
+        'top_users': top_users_list
+    }
+
+def rebuild_stats():
+    """Пересчет агрегатов статистики по исходным таблицам.
+    
+    Выполняется один раз, когда агрегаты появляются в базе с историей;
+    активность за прошлые дни восстановить нельзя, она учитывается с сегодняшнего дня.
+    """
     session = Session()
     
+    def to_date(value):
+        # SQLite возвращает date() строкой
+        return date.fromisoformat(value) if isinstance(value, str) else value
+    
     try:
-        existing_user = session.query(User).filter_by(user_id=user_id).first()
+        for model in [StatsCounter, DailyStats, DailyQualityStats, DailyFormatStats, DailyActiveUser]:
+            session.query(model).delete()
+        
+        increment_counters(session, {
+            'total_users': session.query(func.count(User.id)).scalar(),
+            'total_downloads': session.query(func.count(Download.id)).scalar()
+        })
+        
+        day = func.date(Download.timestamp)
+        increment_rows(session, DailyStats, ['date'], [
+            {'date': to_date(value), 'downloads': count, 'megabytes': megabytes or 0}
+            for value, count, megabytes in
+            session.query(day, func.count(Download.id), func.sum(Download.file_size)).group_by(day).all()
+            if value
+        ])
+        increment_rows(session, DailyQualityStats, ['date', 'quality'], [
+            {'date': to_date(value), 'quality': quality, 'downloads': count}
+            for value, quality, count in
+            session.query(day, Download.quality, func.count(Download.id)).group_by(day, Download.quality).all()
+            if value
+        ])
+        increment_rows(session, DailyFormatStats, ['date', 'file_format'], [
+            {'date': to_date(value), 'file_format': file_format, 'downloads': count}
+            for value, file_format, count in
+            session.query(day, Download.file_format, func.count(Download.id)).group_by(day, Download.file_format).all()
+            if value
+        ])
+        
+        registered = func.date(User.registered_at)
+        increment_rows(session, DailyStats, ['date'], [
+            {'date': to_date(value), 'new_users': count}
+            for value, count in
+            session.query(registered, func.count(User.id)).group_by(registered).all()
+            if value
+        ])
         
-        if existing_user:
-            existing_user.username = username
-            existing_user.first_name = first_name
-            existing_user.last_active = datetime.now()
+        today = date.today()
+        midnight = datetime.combine(today, datetime.min.time())
+        active_today = [user_id for (user_id,) in session.query(User.user_id).filter(User.last_active >= midnight).all()]
+        increment_rows(session, DailyStats, ['date'], [
+            {'date': today, 'active_users': mark_active_users(session, today, active_today)}
+        ])
+        
+        # Создаем строку счетчиков даже для пустой базы, чтобы не пересчитывать при каждом запуске
+        session.merge(StatsCounter(name='rebuilt_at', value=int(datetime.now().timestamp())))
+        session.commit()
+    finally:
+        session.close()
+
+def _job_to_dict(job):
+    """Преобразование задачи в словарь, пригодный для использования вне сессии"""
+    return {
+        'id': job.id,
+        'user_id': job.user_id,
+        'chat_id': job.chat_id,
+        'message_id': job.message_id,
+        'youtube_url': job.youtube_url,
+        'video_id': job.video_id,
+        'video_title': job.video_title,
+        'quality': job.quality,
+        'clip': job.clip,
+        'batch_id': job.batch_id,
+        'status': job.status,
+        'attempts': job.attempts,
+        'error': job.error,
+        'delivery': job.delivery,
+        'link': job.link,
+        'file_size': job.file_size,
+        'file_format': job.file_format,
+        'expiration_time': job.expiration_time,
+        'stage': job.stage,
+        'bytes_done': job.bytes_done,
+        'bytes_total': job.bytes_total,
+        'stage_started_at': job.stage_started_at,
+        'progress_at': job.progress_at,
+        'trace_id': job.trace_id,
+        'speculative': bool(job.speculative),
+        'confirmed': bool(job.confirmed),
+        'created_at': job.created_at
+    }
+
+def lock_job_queue(session):
+    """Блокировка очереди задач до конца транзакции сессии.
+    
+    Выбор задачи воркером и постановка задач с проверкой места в очереди
+    выполняются по одной: иначе параллельные транзакции видят одно и то же
+    число задач и вместе превышают лимиты.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': JOB_CLAIM_LOCK_KEY})
+    elif dialect == 'sqlite':
+        # В SQLite нет блокировок строк: пустое изменение открывает транзакцию
+        # записи, и остальные ждут ее завершения
+        session.execute(text('UPDATE jobs SET id = id WHERE 0'))
+
+def _awaiting_choice():
+    """Условие: упреждающая задача, качество которой пользователь еще не выбрал"""
+    return and_(Job.speculative.is_(True), Job.confirmed.isnot(True))
+
+def _queue_load(user_id):
+    """Запрос числа задач в ожидании: всего и у пользователя (упреждающие до выбора качества не считаются)"""
+    return select(
+        func.count(Job.id),
+        func.coalesce(func.sum(case((Job.user_id == user_id, 1), else_=0)), 0)
+    ).where(Job.status == 'pending', ~_awaiting_choice())
+
+@with_session
+def get_queue_load(session, user_id):
+    """Задачи в ожидании: (всего, у пользователя)"""
+    return tuple(session.execute(_queue_load(user_id)).one())
+
+@with_session
+def enqueue_job(session, user_id, chat_id, message_id, youtube_url, video_id, video_title, quality, trace_id=None, speculative=False,
+                max_pending=0, max_pending_per_user=0, clip=None):
+    """Постановка задачи загрузки в очередь; speculative — упреждающая загрузка до выбора качества,
+    clip — фрагмент видео «начало-конец» в секундах.
+    
+    Если в очереди ожидания нет места (лимиты max_pending и
+    max_pending_per_user, 0 — без ограничения), задача не ставится и
+    возникает QueueFull.
+    """
+    if max_pending or max_pending_per_user:
+        lock_job_queue(session)
+        check_queue(*session.execute(_queue_load(user_id)).one(), 1, max_pending, max_pending_per_user, speculative)
+    
+    job = Job(
+        user_id=user_id,
+        chat_id=chat_id,
+        message_id=message_id,
+        youtube_url=youtube_url,
+        video_id=video_id,
+        video_title=video_title,
+        quality=quality,
+        clip=clip,
+        status='pending',
+        attempts=0,
+        trace_id=trace_id,
+        speculative=speculative,
+        confirmed=False,
+        needs_report=False,
+        created_at=datetime.now()
+    )
+    session.add(job)
+    session.commit()
+    return job.id
+
+@with_session
+def enqueue_batch(session, user_id, chat_id, message_id, items, quality, trace_id=None, max_pending=0, max_pending_per_user=0):
+    """Постановка пакета задач в очередь одной транзакцией.
+    
+    items — список словарей с ключами url, video_id и title. Все задачи
+    пакета сообщают о состоянии в одно сообщение message_id. Возвращает
+    идентификатор пакета. Пакет, не помещающийся в очередь ожидания,
+    не ставится целиком (QueueFull).
+    """
+    if max_pending or max_pending_per_user:
+        lock_job_queue(session)
+        check_queue(*session.execute(_queue_load(user_id)).one(), len(items), max_pending, max_pending_per_user)
+    
+    batch_id = uuid.uuid4().hex
+    now = datetime.now()
+    session.add_all([
+        Job(
+            user_id=user_id,
+            chat_id=chat_id,
+            message_id=message_id,
+            youtube_url=item['url'],
+            video_id=item['video_id'],
+            video_title=item['title'],
+            quality=quality,
+            batch_id=batch_id,
+            status='pending',
+            attempts=0,
+            trace_id=trace_id,
+            needs_report=False,
+            created_at=now
+        )
+        for item in items
+    ])
+    session.commit()
+    return batch_id
+
+@with_session
+def get_batch_jobs(session, batch_ids):
+    """Задачи пакетов: идентификатор пакета -> список задач в порядке добавления"""
+    jobs = session.query(Job).filter(Job.batch_id.in_(batch_ids)).order_by(Job.id).all()
+    
+    batches = {}
+    for job in jobs:
+        batches.setdefault(job.batch_id, []).append(_job_to_dict(job))
+    return batches
+
+@with_session
+def get_queue_positions(session, limit=500):
+    """Места в очереди задач, ожидающих выполнения (кроме задач пакетов).
+    
+    Место примерное: задачи считаются в порядке постановки, а воркеры
+    выдают их с чередованием пользователей.
+    """
+    jobs = (
+        session.query(Job)
+        .filter(Job.status == 'pending', ~_awaiting_choice())
+        .order_by(Job.created_at, Job.id)
+        .limit(limit)
+        .all()
+    )
+    return [
+        dict(_job_to_dict(job), position=position)
+        for position, job in enumerate(jobs, start=1)
+        if not job.batch_id
+    ]
+
+def claim_job(worker_id, max_running, max_running_per_user, max_speculative_running=0):
+    """Захват следующей задачи воркером.
+    
+    Соблюдает глобальный лимит и лимит на пользователя, а пользователей
+    обслуживает по кругу: первым идет тот, чья задача запускалась давнее всех.
+    Задача не выдается, пока выполняется другая задача с тем же видео,
+    качеством и фрагментом: после ее завершения результат будет взят из кэша.
+    Упреждающие задачи выдаются после обычных, не больше
+    max_speculative_running одновременно, и не занимают лимит пользователя.
+    """
+    for _ in range(JOB_CLAIM_RETRIES):
+        job = _claim_next_job(worker_id, max_running, max_running_per_user, max_speculative_running)
+        if job is not False:
+            return job
+    return None
+
+def _claim_next_job(worker_id, max_running, max_running_per_user, max_speculative_running):
+    """Одна попытка захвата: задача, None, если выдать нечего, или False, если задачу перехватил другой воркер"""
+    session = Session()
+    
+    try:
+        # Сериализуем выбор задачи между воркерами, чтобы лимиты не превышались
+        lock_job_queue(session)
+        
+        running = session.query(func.count(Job.id)).filter(Job.status == 'running').scalar()
+        if running >= max_running:
             session.commit()
+            return None
+        
+        # Пользователи, уже достигшие своего лимита
+        busy_users = (
+            session.query(Job.user_id)
+            .filter(Job.status == 'running', ~_awaiting_choice())
+            .group_by(Job.user_id)
+            .having(func.count(Job.id) >= max_running_per_user)
+        )
+        
+        # Время последнего запуска задачи пользователя для справедливой очереди
+        served = aliased(Job)
+        last_served = (
+            session.query(func.max(served.started_at))
+            .filter(served.user_id == Job.user_id)
+            .correlate(Job)
+            .scalar_subquery()
+        )
+        
+        # Такое же видео (или тот же фрагмент) в том же качестве уже загружается
+        inflight = aliased(Job)
+        duplicate_running = exists().where(
+            inflight.status == 'running',
+            inflight.video_id == Job.video_id,
+            inflight.quality == Job.quality,
+            func.coalesce(inflight.clip, '') == func.coalesce(Job.clip, '')
+        )
+        
+        query = session.query(Job).filter(Job.status == 'pending', ~Job.user_id.in_(busy_users), ~duplicate_running)
+        
+        speculative_running = (
+            session.query(func.count(Job.id)).filter(Job.status == 'running', _awaiting_choice()).scalar()
+        )
+        if speculative_running >= max_speculative_running:
+            query = query.filter(~_awaiting_choice())
+        
+        job = (
+            query
+            .order_by(case((_awaiting_choice(), 1), else_=0), last_served.asc().nulls_first(), Job.created_at, Job.id)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        
+        if not job:
+            session.commit()
+            return None
+        
+        # Задача захватывается, только если она все еще в ожидании: без
+        # блокировки ее мог успеть захватить другой воркер
+        now = datetime.now()
+        claimed = session.query(Job).filter(Job.id == job.id, Job.status == 'pending').update({
+            'status': 'running',
+            'worker_id': worker_id,
+            'attempts': func.coalesce(Job.attempts, 0) + 1,
+            'started_at': now,
+            'heartbeat_at': now,
+            # Прогресс предыдущей попытки больше не актуален
+            'stage': None,
+            'bytes_done': None,
+            'bytes_total': None,
+            # О задаче, качество которой еще не выбрано, пользователю не сообщается
+            'needs_report': not job.speculative or bool(job.confirmed)
+        }, synchronize_session=False)
+        
+        if not claimed:
+            session.rollback()
+            logger.warning(f"Задачу {job.id} захватил другой воркер, выбираем следующую")
             return False
+        
+        session.commit()
+        # После фиксации объект перечитывается из базы уже с новым статусом
+        return _job_to_dict(job)
+    finally:
+        session.close()
+
+def heartbeat_jobs(job_ids):
+    """Отметка о том, что задачи все еще выполняются"""
+    if not job_ids:
+        return
+    
+    session = Session()
+    
+    try:
+        session.query(Job).filter(Job.id.in_(job_ids), Job.status == 'running').update(
+            {'heartbeat_at': datetime.now()}, synchronize_session=False
+        )
+        session.commit()
+    finally:
+        session.close()
+
+def get_transfer_shares():
+    """Воркеры, выполняющие задачи: (их число, пользователь -> число воркеров с его задачами)"""
+    session = Session()
+    
+    try:
+        pairs = session.query(Job.worker_id, Job.user_id).filter(Job.status == 'running').distinct().all()
+    finally:
+        session.close()
+    
+    user_workers = {}
+    for _, user_id in pairs:
+        user_workers[user_id] = user_workers.get(user_id, 0) + 1
+    return len({worker_id for worker_id, _ in pairs}), user_workers
+
+def update_job_progress(job_id, stage, bytes_done, bytes_total, stage_started_at):
+    """Сохранение прогресса выполняющейся задачи для показа пользователю"""
+    session = Session()
+    
+    try:
+        now = datetime.now()
+        session.query(Job).filter(Job.id == job_id, Job.status == 'running').update({
+            'stage': stage,
+            'bytes_done': bytes_done,
+            'bytes_total': bytes_total,
+            'stage_started_at': stage_started_at,
+            'progress_at': now,
+            'heartbeat_at': now,
+            'needs_report': or_(Job.speculative.isnot(True), Job.confirmed.is_(True))
+        }, synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+
+def complete_job(job_id, link, file_size, file_format, expiration_time, processing=None, delivery='mega'):
+    """Отметка об успешном выполнении задачи"""
+    session = Session()
+    
+    try:
+        processing = processing or {}
+        session.query(Job).filter_by(id=job_id).update({
+            'status': 'done',
+            'delivery': delivery,
+            'link': link,
+            'file_size': file_size,
+            'file_format': file_format,
+            'expiration_time': expiration_time,
+            'process_stage': processing.get('stage'),
+            'process_time': processing.get('wall_time'),
+            'process_cpu_time': processing.get('cpu_time'),
+            'finished_at': datetime.now(),
+            'needs_report': True
+        }, synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+
+def fail_job(job_id, error, max_attempts):
+    """Отметка об ошибке: задача возвращается в очередь, пока не исчерпаны попытки"""
+    session = Session()
+    
+    try:
+        job = session.query(Job).filter_by(id=job_id).first()
+        # Задача могла быть отменена или возвращена в очередь, пока выполнялась
+        if not job or job.status != 'running':
+            return
+        
+        job.error = error
+        if job.speculative and not job.confirmed:
+            # Упреждающая загрузка не повторяется
+            job.status = 'failed'
+            job.finished_at = datetime.now()
+        elif job.attempts < max_attempts:
+            job.status = 'pending'
+            job.worker_id = None
         else:
-            new_user = User(
-                user_id=user_id,
-                username=username,
-                first_name=first_name,
-                last_active=datetime.now(),
-                total_downloads=0,
-                registered_at=datetime.now()
-            )
-            session.add(new_user)
-            session.commit()
-            return True
+            job.status = 'failed'
+            job.finished_at = datetime.now()
+            job.needs_report = True
+        session.commit()
     finally:
         session.close()
 
-def update_user_activity(user_id):
-    """Обновление времени последней активности пользователя"""
+def requeue_stale_jobs(timeout_seconds):
+    """Возврат в очередь задач, воркер которых перестал подавать признаки жизни"""
     session = Session()
     
     try:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        if user:
-            user.last_active = datetime.now()
-            session.commit()
+        deadline = datetime.now() - timedelta(seconds=timeout_seconds)
+        count = session.query(Job).filter(Job.status == 'running', Job.heartbeat_at < deadline).update(
+            {'status': 'pending', 'worker_id': None}, synchronize_session=False
+        )
+        session.commit()
+        return count
     finally:
         session.close()
 
-def increment_download_count(user_id):
-    """Увеличение счетчика загрузок для пользователя"""
+def release_jobs(worker_id, job_ids):
+    """Возврат в очередь задач, прерванных остановкой воркера.
+    
+    Прерванная попытка не засчитывается, задачу сразу может взять другой воркер.
+    """
+    if not job_ids:
+        return 0
+    
     session = Session()
     
     try:
-        user = session.query(User).filter_by(user_id=user_id).first()
-        if user:
-            user.total_downloads += 1
-            session.commit()
+        count = session.query(Job).filter(
+            Job.id.in_(list(job_ids)), Job.worker_id == worker_id, Job.status == 'running'
+        ).update(
+            {'status': 'pending', 'worker_id': None, 'attempts': Job.attempts - 1}, synchronize_session=False
+        )
+        session.commit()
+        return count
     finally:
         session.close()
 
-def log_download(user_id, youtube_url, quality, file_size, file_format):
-    """Логирование загрузки в базе данных"""
+@with_session
+def predict_quality(session, user_id, choices, history):
+    """Наиболее вероятный выбор качества из choices.
+    
+    Берется самое частое качество среди последних history загрузок
+    пользователя, а если он еще ничего не загружал — среди всех загрузок
+    за 30 дней. None, если подходящих загрузок нет.
+    """
+    recent = (
+        session.query(Download.quality)
+        .filter(Download.user_id == user_id)
+        .order_by(Download.timestamp.desc())
+        .limit(history)
+        .subquery()
+    )
+    counts = dict(
+        session.query(recent.c.quality, func.count())
+        .filter(recent.c.quality.in_(choices))
+        .group_by(recent.c.quality)
+        .all()
+    )
+    
+    if not counts:
+        counts = dict(
+            session.query(DailyQualityStats.quality, func.sum(DailyQualityStats.downloads))
+            .filter(DailyQualityStats.date >= date.today() - timedelta(days=29), DailyQualityStats.quality.in_(choices))
+            .group_by(DailyQualityStats.quality)
+            .all()
+        )
+    
+    if not counts:
+        return None
+    return max(counts, key=counts.get)
+
+def finish_prefetch(job_id, bytes_done):
+    """Завершение упреждающей загрузки, качество которой пользователь еще не выбрал.
+    
+    Возвращает False, если пользователь выбрал это качество во время
+    загрузки: тогда задача стала обычной и воркер должен ее доставить.
+    """
     session = Session()
     
     try:
-        download = Download(
-            user_id=user_id,
-            youtube_url=youtube_url,
+        updated = session.query(Job).filter(
+            Job.id == job_id, Job.status == 'running', Job.confirmed.isnot(True)
+        ).update({
+            'status': 'prefetched',
+            'bytes_done': bytes_done,
+            'finished_at': datetime.now()
+        }, synchronize_session=False)
+        session.commit()
+        return updated > 0
+    finally:
+        session.close()
+
+@with_session
+def promote_speculative_job(session, job_id):
+    """Пользователь выбрал качество упреждающей загрузки: задача становится обычной.
+    
+    Выполняющаяся задача продолжает работу и будет доставлена, уже
+    загруженная снова ставится в очередь и доставляется из локального
+    хранилища воркера. False, если задачу нельзя использовать (отменена
+    или завершилась ошибкой) — тогда нужно поставить новую.
+    """
+    updated = session.query(Job).filter(
+        Job.id == job_id,
+        _awaiting_choice(),
+        Job.status.in_(['pending', 'running', 'prefetched'])
+    ).update({
+        'confirmed': True,
+        'status': case((Job.status == 'prefetched', 'pending'), else_=Job.status),
+        # Упреждающая загрузка не считается попыткой: иначе задача выглядит
+        # повторяемой после ошибки и теряет одну попытку из JOB_MAX_ATTEMPTS
+        'attempts': case((Job.status == 'prefetched', 0), else_=Job.attempts),
+        'finished_at': None
+    }, synchronize_session=False)
+    session.commit()
+    return updated > 0
+
+@with_session
+def cancel_speculative_job(session, job_id):
+    """Отмена упреждающей загрузки: пользователь выбрал другое качество.
+    
+    Выполняющаяся загрузка прерывается воркером при следующей записи прогресса.
+    """
+    updated = session.query(Job).filter(
+        Job.id == job_id,
+        _awaiting_choice(),
+        Job.status.in_(['pending', 'running', 'prefetched'])
+    ).update({
+        'status': 'cancelled',
+        'finished_at': func.coalesce(Job.finished_at, datetime.now())
+    }, synchronize_session=False)
+    session.commit()
+    return updated > 0
+
+def get_job_state(job_id):
+    """Статус задачи и выбор качества пользователем: (status, confirmed) или None"""
+    session = Session()
+    
+    try:
+        row = session.query(Job.status, Job.confirmed).filter_by(id=job_id).first()
+        return (row.status, bool(row.confirmed)) if row else None
+    finally:
+        session.close()
+
+@with_session
+def claim_job_reports(session, limit=500):
+    """Получение задач, о смене статуса которых нужно сообщить пользователю.
+    
+    Флаг снимается в той же транзакции, поэтому несколько экземпляров бота
+    не отправят одно и то же обновление дважды.
+    """
+    jobs = (
+        session.query(Job)
+        .filter(Job.needs_report == True)  # noqa: E712
+        .order_by(Job.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    
+    result = [_job_to_dict(job) for job in jobs]
+    
+    # Флаг снимается, только если статус не изменился после чтения: без
+    # блокировки строк (SQLite) задача могла завершиться за это время,
+    # и итоговое сообщение не должно потеряться
+    statuses = {}
+    for job in result:
+        statuses.setdefault(job['status'], []).append(job['id'])
+    for status, ids in statuses.items():
+        session.query(Job).filter(Job.id.in_(ids), Job.status == status).update(
+            {'needs_report': False}, synchronize_session=False
+        )
+    session.commit()
+    return result
+
+def _count_cache_lookup(hit):
+    """Учет обращения к кэшу результатов: в метриках процесса и в общих счетчиках статистики (отложенная запись)"""
+    cache_lookups.inc(result='hit' if hit else 'miss')
+    write_buffer.add_counters({'cache_hits' if hit else 'cache_misses': 1})
+
+@with_session
+def get_cached_result(session, video_id, quality):
+    """Поиск действующей ссылки MEGA для видео в нужном качестве.
+    
+    При попадании срок действия файла продлевается, чтобы ссылка, только что
+    выданная пользователю, не истекла раньше обычного.
+    """
+    now = datetime.now()
+    row = (
+        session.query(ResultCache, MegaFile)
+        .join(MegaFile, ResultCache.mega_file_id == MegaFile.file_id)
+        .filter(
+            ResultCache.video_id == video_id,
+            ResultCache.quality == quality,
+            MegaFile.expiration_time > now
+        )
+        .first()
+    )
+    
+    if not row:
+        _count_cache_lookup(False)
+        return None
+    
+    cache_entry, mega_file = row
+    mega_file.expiration_time = max(mega_file.expiration_time, now + timedelta(seconds=LINK_EXPIRATION_TIME))
+    cache_entry.hits = (cache_entry.hits or 0) + 1
+    cache_entry.last_hit_at = now
+    
+    result = {
+        'link': mega_file.link,
+        'expiration_time': mega_file.expiration_time,
+        'file_size': cache_entry.file_size,
+        'file_format': cache_entry.file_format
+    }
+    session.commit()
+    _count_cache_lookup(True)
+    return result
+
+@with_session
+def has_delivered_result(session, video_id, quality):
+    """Есть ли готовый результат (файл Telegram или действующая ссылка MEGA); счетчики попаданий не меняются"""
+    telegram_file = exists().where(TelegramFile.video_id == video_id, TelegramFile.quality == quality)
+    cached = (
+        exists()
+        .where(
+            ResultCache.video_id == video_id,
+            ResultCache.quality == quality,
+            ResultCache.mega_file_id == MegaFile.file_id,
+            MegaFile.expiration_time > datetime.now()
+        )
+    )
+    return session.query(or_(telegram_file, cached)).scalar()
+
+def store_cached_result(video_id, quality, mega_file_id, file_size, file_format):
+    """Сохранение результата загрузки в кэш; ожидающие задачи с тем же видео сразу найдут его"""
+    session = Session()
+    
+    try:
+        statement = upsert(ResultCache.__table__).values(
+            video_id=video_id,
             quality=quality,
+            mega_file_id=mega_file_id,
             file_size=file_size,
             file_format=file_format,
-            timestamp=datetime.now()
+            hits=0,
+            created_at=datetime.now()
         )
-        session.add(download)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['video_id', 'quality'],
+            set_={
+                'mega_file_id': statement.excluded.mega_file_id,
+                'file_size': statement.excluded.file_size,
+                'file_format': statement.excluded.file_format,
+                'created_at': statement.excluded.created_at
+            }
+        ))
         session.commit()
     finally:
         session.close()
 
-def register_mega_file(file_id, path, link, expiration_time):
-    """Регистрация файла, загруженного на MEGA"""
+@with_session
+def get_telegram_file(session, video_id, quality):
+    """Файл Telegram, ранее отправленный для видео в нужном качестве"""
+    telegram_file = session.query(TelegramFile).filter_by(video_id=video_id, quality=quality).first()
+    if not telegram_file:
+        return None
+    
+    telegram_file.hits = (telegram_file.hits or 0) + 1
+    telegram_file.last_hit_at = datetime.now()
+    result = {
+        'file_id': telegram_file.file_id,
+        'file_size': telegram_file.file_size,
+        'file_format': telegram_file.file_format
+    }
+    session.commit()
+    return result
+
+def store_telegram_file(video_id, quality, file_id, file_size, file_format):
+    """Сохранение file_id отправленного файла для повторной отправки"""
     session = Session()
     
     try:
-        mega_file = MegaFile(
+        statement = upsert(TelegramFile.__table__).values(
+            video_id=video_id,
+            quality=quality,
             file_id=file_id,
-            path=path,
-            link=link,
-            uploaded_at=datetime.now(),
-            expiration_time=expiration_time
+            file_size=file_size,
+            file_format=file_format,
+            hits=0,
+            created_at=datetime.now()
         )
-        session.add(mega_file)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['video_id', 'quality'],
+            set_={'file_id': statement.excluded.file_id, 'file_size': statement.excluded.file_size}
+        ))
         session.commit()
     finally:
         session.close()
 
-def get_expired_mega_files():
-    """Получение списка истекших файлов на MEGA"""
+@with_session
+def delete_telegram_file(session, video_id, quality):
+    """Удаление file_id, который Telegram больше не принимает"""
+    session.query(TelegramFile).filter_by(video_id=video_id, quality=quality).delete()
+    session.commit()
+
+@with_session
+def get_cache_stats(session):
+    """Статистика кэша результатов.
+    
+    Попадания и промахи суммируются по всем процессам бота и воркеров (в
+    основном это поиск воркером перед загрузкой) и попадают в базу вместе
+    с пакетом отложенной записи.
+    """
+    entries = session.query(func.count(ResultCache.id)).scalar()
+    total_hits = session.query(func.coalesce(func.sum(ResultCache.hits), 0)).scalar()
+    counters = dict(
+        session.query(StatsCounter.name, StatsCounter.value)
+        .filter(StatsCounter.name.in_(['cache_hits', 'cache_misses']))
+        .all()
+    )
+    
+    return {
+        'entries': entries,
+        'total_hits': total_hits,
+        'hits': counters.get('cache_hits', 0),
+        'misses': counters.get('cache_misses', 0)
+    }
+
+@with_session
+def get_processing_stats(session, since):
+    """Суммарное время обработки ffmpeg по этапам для планирования мощностей"""
+    rows = (
+        session.query(
+            Job.process_stage,
+            func.count(Job.id),
+            func.sum(Job.process_time),
+            func.sum(Job.process_cpu_time)
+        )
+        .filter(Job.process_stage.isnot(None), Job.finished_at >= since)
+        .group_by(Job.process_stage)
+        .all()
+    )
+    
+    return {
+        stage: {'jobs': count, 'wall_time': wall_time or 0, 'cpu_time': cpu_time or 0}
+        for stage, count, wall_time, cpu_time in rows
+    }
+
+@with_session
+def get_speculative_stats(session, since):
+    """Результаты упреждающих загрузок: угаданные, отмененные и невостребованные, потраченные впустую байты"""
+    rows = (
+        session.query(Job.status, Job.confirmed, func.count(Job.id), func.sum(Job.bytes_done))
+        .filter(Job.speculative.is_(True), Job.created_at >= since)
+        .group_by(Job.status, Job.confirmed)
+        .all()
+    )
+    
+    stats = {'hits': 0, 'misses': 0, 'unused': 0, 'wasted_bytes': 0}
+    for status, confirmed, count, bytes_done in rows:
+        if confirmed:
+            stats['hits'] += count
+            continue
+        if status == 'cancelled':
+            stats['misses'] += count
+        elif status == 'prefetched':
+            stats['unused'] += count
+        if status in ('cancelled', 'prefetched', 'failed'):
+            stats['wasted_bytes'] += bytes_done or 0
+    return stats
+
+def get_video_metadata(video_id):
+    """Получение сохраненных метаданных видео, если они еще действительны"""
     session = Session()
     
     try:
-        current_time = datetime.now()
-        expired_files = session.query(MegaFile).filter(MegaFile.expiration_time < current_time).all()
-        return expired_files
+        metadata = session.query(VideoMetadata).filter(
+            VideoMetadata.video_id == video_id,
+            VideoMetadata.expires_at > datetime.now()
+        ).first()
+        return json.loads(metadata.data) if metadata else None
     finally:
         session.close()
 
-def delete_mega_file_record(file_id):
-    """Удаление записи о файле MEGA из базы данных"""
+def save_video_metadata(video_id, data, expires_at):
+    """Сохранение метаданных видео для других процессов (бота и воркеров)"""
     session = Session()
     
     try:
-        session.query(MegaFile).filter_by(file_id=file_id).delete()
+        session.merge(VideoMetadata(video_id=video_id, data=json.dumps(data), expires_at=expires_at))
         session.commit()
     finally:
         session.close()
 
-def get_stats():
-    """Получение статистики для администратора"""
+def delete_video_metadata(video_id):
+    """Удаление метаданных видео (например, когда ссылки на потоки перестали работать)"""
     session = Session()
     
     try:
-        # Общее количество пользователей
-        total_users = session.query(func.count(User.id)).scalar()
-        
-        # Общее количество загрузок
-        total_downloads = session.query(func.count(Download.id)).scalar()
-        
-        # Сегодняшняя дата с временем 00:00:00
-        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # Загрузки сегодня
-        downloads_today = session.query(func.count(Download.id)).filter(Download.timestamp >= today).scalar()
-        
-        # Активные пользователи сегодня
-        active_users_today = session.query(func.count(User.id)).filter(User.last_active >= today).scalar()
-        
-        # Топ пользователей по загрузкам
-        top_users = session.query(User).order_by(User.total_downloads.desc()).limit(5).all()
-        
-        # Преобразуем объекты User в словари
-        top_users_list = []
-        for user in top_users:
-            top_users_list.append({
-                'user_id': user.user_id,
-                'username': user.username,
-                'first_name': user.first_name,
-                'total_downloads': user.total_downloads
-            })
-        
-        return {
-            'total_users': total_users,
-            'total_downloads': total_downloads,
-            'downloads_today': downloads_today,
-            'active_users_today': active_users_today,
-            'top_users': top_users_list
-        }
+        session.query(VideoMetadata).filter_by(video_id=video_id).delete()
+        session.commit()
     finally:
-        session.close() 
\ No newline at end of file
+        session.close()
+
+@with_session
+def save_conversation_state(session, key, data, expires_at):
+    """Сохранение состояния диалога"""
+    session.merge(ConversationState(key=key, data=json.dumps(data), expires_at=expires_at))
+    session.commit()
+
+@with_session
+def get_conversation_state(session, key):
+    """Состояние диалога и время его истечения; None, если его нет или оно истекло"""
+    state = session.query(ConversationState).filter(
+        ConversationState.key == key,
+        ConversationState.expires_at > datetime.now()
+    ).first()
+    return (json.loads(state.data), state.expires_at) if state else None
+
+@with_session
+def take_conversation_state(session, key):
+    """Получение и удаление состояния диалога.
+    
+    Состояние достается только одному вызову, даже если кнопку нажали
+    дважды и нажатия обработали разные экземпляры бота.
+    """
+    state = session.query(ConversationState).filter(
+        ConversationState.key == key,
+        ConversationState.expires_at > datetime.now()
+    ).first()
+    if not state:
+        return None
+    
+    data = json.loads(state.data)
+    deleted = session.query(ConversationState).filter_by(key=key).delete(synchronize_session=False)
+    session.commit()
+    return data if deleted else None
+
+@with_session
+def delete_expired_conversation_states(session):
+    """Удаление истекших состояний диалогов"""
+    deleted = session.query(ConversationState).filter(ConversationState.expires_at <= datetime.now()).delete()
+    session.commit()
+    return deleted
+
+@with_session
+def register_update(session, update_id):
+    """Отметка обновления как принятого; False, если оно уже было принято раньше"""
+    result = session.execute(
+        upsert(ProcessedUpdate.__table__)
+        .values(update_id=update_id, received_at=datetime.now())
+        .on_conflict_do_nothing(index_elements=['update_id'])
+    )
+    session.commit()
+    return result.rowcount == 1
+
+@with_session
+def forget_update(session, update_id):
+    """Снятие отметки, если обновление не удалось принять в обработку"""
+    session.query(ProcessedUpdate).filter_by(update_id=update_id).delete()
+    session.commit()
+
+@with_session
+def delete_processed_updates(session, before):
+    """Удаление отметок об обновлениях, полученных раньше before"""
+    deleted = session.query(ProcessedUpdate).filter(ProcessedUpdate.received_at < before).delete()
+    session.commit()
+    return deleted
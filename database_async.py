@@ -0,0 +1,131 @@
+import logging
+import functools
+import threading
+import importlib.util
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from config import DATABASE_URL, DB_ASYNC, DB_STATEMENT_CACHE_SIZE
+import database
+from database import (
+    PoolMetricsMixin, engine_options,
+    # Изменения через буфер отложенной записи не обращаются к базе при вызове
+    update_user_activity, increment_download_count, log_download, flush_writes
+)
+from executor import run_io
+
+logger = logging.getLogger(__name__)
+
+# Асинхронный доступ к базе для обработчиков бота: те же функции, что в
+# database.py, но запросы выполняются в цикле событий через асинхронный
+# драйвер, без перехода в пул потоков. Запросы, модели, миграции и буфер
+# отложенной записи общие с database.py: здесь только работа с сессией
+
+# Асинхронные драйверы для баз данных
+ASYNC_DRIVERS = {'postgresql': 'asyncpg', 'sqlite': 'aiosqlite'}
+
+class MeteredAsyncQueuePool(PoolMetricsMixin, AsyncAdaptedQueuePool):
+    pool_name = 'async'
+
+def async_database_url(url, mode):
+    """URL базы для асинхронного драйвера; None, если запросы выполняются в пуле потоков"""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    driver = ASYNC_DRIVERS.get(backend)
+    # aiosqlite выполняет запросы в собственном потоке на соединение и на
+    # SQLite медленнее пула потоков, поэтому используется только по явному DB_ASYNC=true
+    if mode == 'false' or not driver or (backend == 'sqlite' and mode != 'true'):
+        return None
+    if importlib.util.find_spec(driver) is None:
+        logger.warning(f"Драйвер {driver} не установлен, запросы бота к базе выполняются в пуле потоков")
+        return None
+
+    query = dict(url.query)
+    if backend == 'postgresql':
+        # asyncpg принимает ssl вместо sslmode из URL libpq
+        if 'sslmode' in query:
+            query['ssl'] = query.pop('sslmode')
+        # Подготовленные запросы кэшируются в каждом соединении и используются повторно
+        query['prepared_statement_cache_size'] = str(DB_STATEMENT_CACHE_SIZE)
+
+    return url.set(drivername=f"{backend}+{driver}", query=query)
+
+# URL и движок определяются при первом запросе, как и синхронный движок в
+# database.py: импорт модуля не читает настройки базы и не подключается к ней
+_async_url = None
+_async_url_resolved = False
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = async_sessionmaker(expire_on_commit=False)
+
+def get_async_url():
+    """URL асинхронного драйвера (None — запросы в пуле потоков), вычисляемый при первом обращении"""
+    global _async_url, _async_url_resolved
+    if not _async_url_resolved:
+        with _engine_lock:
+            if not _async_url_resolved:
+                _async_url = async_database_url(DATABASE_URL, DB_ASYNC)
+                _async_url_resolved = True
+    return _async_url
+
+def get_engine():
+    """Асинхронный движок базы данных, создаваемый при первом обращении"""
+    global _engine
+    if _engine is None:
+        url = get_async_url()
+        with _engine_lock:
+            if _engine is None:
+                _engine = create_async_engine(url, **engine_options(DATABASE_URL, MeteredAsyncQueuePool))
+    return _engine
+
+def Session():
+    """Новая асинхронная сессия, привязанная к движку базы данных"""
+    return _session_factory(bind=get_engine())
+
+def mirror(sync_function):
+    """Асинхронный вариант функции database.py, объявленной через with_session.
+
+    Тело функции выполняется в асинхронной сессии (AsyncSession.run_sync),
+    а без асинхронного драйвера вызывается синхронная функция в пуле потоков.
+    """
+    @functools.wraps(sync_function)
+    async def function(*args, **kwargs):
+        if get_async_url() is None:
+            return await run_io(sync_function, *args, **kwargs)
+
+        async with Session() as session:
+            return await session.run_sync(sync_function.body, *args, **kwargs)
+    return function
+
+async def dispose_engine():
+    """Закрытие соединений пула при остановке бота"""
+    global _engine
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+
+register_user = mirror(database.register_user)
+get_stats = mirror(database.get_stats)
+get_processing_stats = mirror(database.get_processing_stats)
+get_speculative_stats = mirror(database.get_speculative_stats)
+get_cache_stats = mirror(database.get_cache_stats)
+get_queue_load = mirror(database.get_queue_load)
+enqueue_job = mirror(database.enqueue_job)
+enqueue_batch = mirror(database.enqueue_batch)
+get_queue_positions = mirror(database.get_queue_positions)
+get_batch_jobs = mirror(database.get_batch_jobs)
+claim_job_reports = mirror(database.claim_job_reports)
+predict_quality = mirror(database.predict_quality)
+promote_speculative_job = mirror(database.promote_speculative_job)
+cancel_speculative_job = mirror(database.cancel_speculative_job)
+get_cached_result = mirror(database.get_cached_result)
+has_delivered_result = mirror(database.has_delivered_result)
+get_telegram_file = mirror(database.get_telegram_file)
+delete_telegram_file = mirror(database.delete_telegram_file)
+save_conversation_state = mirror(database.save_conversation_state)
+get_conversation_state = mirror(database.get_conversation_state)
+take_conversation_state = mirror(database.take_conversation_state)
+delete_expired_conversation_states = mirror(database.delete_expired_conversation_states)
+register_update = mirror(database.register_update)
+forget_update = mirror(database.forget_update)
+delete_processed_updates = mirror(database.delete_processed_updates)
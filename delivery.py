@@ -0,0 +1,42 @@
+import os
+import asyncio
+from config import TELEGRAM_DIRECT_DELIVERY, TELEGRAM_DIRECT_MAX_MB, TELEGRAM_UPLOAD_TIMEOUT, TELEGRAM_DIRECT_CONCURRENCY
+from metrics import stage_seconds, transfer_bytes
+
+# Файлы, одновременно отправляемые процессом: python-telegram-bot при
+# отправке читает содержимое файла в память целиком
+upload_slots = asyncio.Semaphore(TELEGRAM_DIRECT_CONCURRENCY)
+
+def fits_telegram(file_size_bytes):
+    """Можно ли отправить файл такого размера напрямую в Telegram"""
+    return TELEGRAM_DIRECT_DELIVERY and file_size_bytes is not None \
+        and file_size_bytes <= TELEGRAM_DIRECT_MAX_MB * 1024 * 1024
+
+async def _send(bot, chat_id, file, file_format, title, file_name):
+    timeouts = {'read_timeout': TELEGRAM_UPLOAD_TIMEOUT, 'write_timeout': TELEGRAM_UPLOAD_TIMEOUT}
+
+    with stage_seconds.time(stage='telegram_send'):
+        if file_format == 'mp3':
+            return await bot.send_audio(chat_id, audio=file, title=title, filename=file_name, **timeouts)
+        return await bot.send_video(
+            chat_id, video=file, caption=title, filename=file_name, supports_streaming=True, **timeouts
+        )
+
+async def send_file(bot, chat_id, file, file_format, title, file_name=None):
+    """Отправка файла в чат: MP3 как аудио, остальное как видео.
+
+    file — открытый файл или file_id ранее отправленного файла.
+    Возвращает file_id, по которому файл можно отправить повторно.
+    """
+    if isinstance(file, str):
+        message = await _send(bot, chat_id, file, file_format, title, file_name)
+    else:
+        async with upload_slots:
+            message = await _send(bot, chat_id, file, file_format, title, file_name)
+        transfer_bytes.inc(os.fstat(file.fileno()).st_size, direction='telegram')
+
+    if file_format == 'mp3':
+        return message.audio.file_id
+
+    # Видео, которое Telegram не распознал, приходит как документ
+    return (message.video or message.document).file_id
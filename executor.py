@@ -0,0 +1,56 @@
+import asyncio
+import functools
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from config import IO_POOL_SIZE, CPU_POOL_SIZE
+
+# Пулы создаются при первом обращении, чтобы не плодить потоки и процессы при импорте
+_io_pool = None
+_cpu_pool = None
+_pools_lock = threading.Lock()
+
+def get_io_pool():
+    """Пул потоков для блокирующего ввода-вывода (pytube, MEGA, база данных)"""
+    global _io_pool
+    with _pools_lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(max_workers=IO_POOL_SIZE, thread_name_prefix='io')
+    return _io_pool
+
+def get_cpu_pool():
+    """Пул процессов для задач, нагружающих процессор"""
+    global _cpu_pool
+    with _pools_lock:
+        if _cpu_pool is None:
+            _cpu_pool = ProcessPoolExecutor(max_workers=CPU_POOL_SIZE)
+    return _cpu_pool
+
+async def run_io(func, *args, **kwargs):
+    """Выполнение блокирующей функции в пуле потоков без остановки цикла событий.
+    
+    Функция выполняется в копии текущего контекста, поэтому переменные
+    контекста (например, идентификатор трассировки) доступны и в пуле.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_io_pool(), functools.partial(context.run, func, *args, **kwargs))
+
+async def run_cpu(func, *args, **kwargs):
+    """Выполнение функции в пуле процессов (функция и аргументы должны сериализоваться pickle)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_cpu_pool(), functools.partial(func, *args, **kwargs))
+
+def run_cpu_sync(func, *args, **kwargs):
+    """Выполнение функции в пуле процессов из обычного (не асинхронного) кода с ожиданием результата"""
+    return get_cpu_pool().submit(func, *args, **kwargs).result()
+
+def shutdown_pools(wait=True):
+    """Остановка пулов при завершении работы"""
+    global _io_pool, _cpu_pool
+    if _io_pool is not None:
+        _io_pool.shutdown(wait=wait)
+        _io_pool = None
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=wait)
+        _cpu_pool = None
@@ -0,0 +1,133 @@
+import time
+import heapq
+import logging
+import threading
+from config import EXPIRY_BATCH_SIZE, EXPIRY_REFRESH_INTERVAL
+from database import get_upcoming_mega_expirations
+from mega_handler import cleanup_expired_files
+from metrics import stage_seconds, mega_files_deleted
+
+logger = logging.getLogger(__name__)
+
+class ExpiryEngine:
+    """Удаление файлов MEGA в момент истечения срока.
+
+    Ближайшие сроки истечения хранятся в куче; поток спит до ближайшего
+    срока и удаляет все истекшие к этому моменту файлы пачками по
+    batch_size. Каждые refresh_interval секунд сроки перечитываются из базы,
+    поэтому учитываются файлы, загруженные другими процессами, и продленные
+    при попадании в кэш сроки. Движок можно запускать в нескольких
+    процессах одновременно: пачки разбираются в базе без пересечений, а
+    повторное удаление уже удаленного файла не считается ошибкой.
+    """
+
+    def __init__(self, batch_size=EXPIRY_BATCH_SIZE, refresh_interval=EXPIRY_REFRESH_INTERVAL):
+        self.batch_size = batch_size
+        self.refresh_interval = refresh_interval
+        self.deadlines = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.refreshed_at = None
+
+        # Статистика удаления
+        self.deleted = 0
+        self.cycles = 0
+        self.last_lag = None
+        self.max_lag = 0
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, name='expiry', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def schedule(self, expiration_time):
+        """Добавление срока файла, загруженного этим процессом"""
+        with self.condition:
+            heapq.heappush(self.deadlines, expiration_time.timestamp())
+            self.condition.notify()
+
+    def refresh(self):
+        """Чтение ближайших сроков из базы"""
+        deadlines = [expiration_time.timestamp() for expiration_time in get_upcoming_mega_expirations(self.batch_size)]
+        heapq.heapify(deadlines)
+
+        with self.condition:
+            self.deadlines = deadlines
+            self.refreshed_at = time.monotonic()
+
+    def run_cycle(self):
+        """Удаление всех истекших файлов; пачки повторяются, пока они заполнены"""
+        total = 0
+        while True:
+            with stage_seconds.time(stage='cleanup_mega'):
+                deleted, lag = cleanup_expired_files(self.batch_size)
+            mega_files_deleted.inc(deleted)
+
+            with self.condition:
+                self.cycles += 1
+                self.deleted += deleted
+                if lag is not None:
+                    self.last_lag = lag
+                    self.max_lag = max(self.max_lag, lag)
+
+            total += deleted
+            if deleted:
+                logger.info(f"Удалено истекших файлов MEGA: {deleted}, задержка {lag:.1f} с")
+            if deleted < self.batch_size:
+                return total
+
+    def _wait(self):
+        """Ожидание ближайшего срока; True, если пора удалять файлы"""
+        with self.condition:
+            while self.running:
+                now = time.time()
+                if self.deadlines and self.deadlines[0] <= now:
+                    while self.deadlines and self.deadlines[0] <= now:
+                        heapq.heappop(self.deadlines)
+                    return True
+
+                timeout = self.refresh_interval - (time.monotonic() - self.refreshed_at)
+                if timeout <= 0:
+                    return False
+                if self.deadlines:
+                    timeout = min(timeout, self.deadlines[0] - now)
+                self.condition.wait(timeout)
+            return False
+
+    def _run(self):
+        while self.running:
+            try:
+                if self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.refresh_interval:
+                    self.refresh()
+                # После удаления сроки перечитываются сразу; если удалить ничего
+                # не удалось (срок продлен или MEGA недоступна), повтор будет
+                # при следующем плановом чтении сроков
+                if self._wait() and self.run_cycle():
+                    self.refreshed_at = None
+            except Exception as e:
+                logger.error(f"Ошибка при удалении истекших файлов: {e}")
+                time.sleep(self.refresh_interval)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'deleted': self.deleted,
+                'cycles': self.cycles,
+                'last_lag': self.last_lag,
+                'max_lag': self.max_lag,
+                'pending': len(self.deadlines)
+            }
+
+# Общий движок процесса; запускается ботом и воркером
+expiry_engine = ExpiryEngine()
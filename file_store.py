@@ -0,0 +1,182 @@
+import os
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+from config import DOWNLOAD_DIR, TEMP_DIR, FILE_STORE_QUOTA_MB, FILE_STORE_TTL
+
+# Служебные файлы, относящиеся к основному файлу (прогресс загрузки, вывод ffmpeg,
+# фрагменты потока до сборки фрагмента видео)
+SIDE_SUFFIXES = ('.media.progress.tmp', '.media.progress', '.media', '.progress.tmp', '.progress', '.tmp')
+
+def main_path(path):
+    """Путь к основному файлу для служебного файла"""
+    for suffix in SIDE_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+class LocalFileStore:
+    """Локальное хранилище загруженных файлов с квотой и вытеснением.
+
+    Файл, который скачивается, обрабатывается или загружается на MEGA,
+    удерживается разделяемой блокировкой flock на отдельном файле .lock.
+    Вытеснение удаляет только файлы, на которые удалось взять
+    исключительную блокировку, поэтому незавершенные задачи (в том числе
+    в других процессах на этой машине) никогда не теряют свои файлы.
+    Остальные файлы удаляются по истечении ttl и, если занято больше quota
+    байт, начиная с давно не использовавшихся — так часто запрашиваемые
+    файлы остаются на диске для повторного использования.
+    """
+
+    def __init__(self, directories, quota_bytes, ttl):
+        self.directories = directories
+        self.quota_bytes = quota_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.usage_bytes = 0
+        self.files = 0
+
+    def prepare(self):
+        """Создание каталогов хранилища; вызывается при запуске воркера"""
+        for directory in self.directories:
+            os.makedirs(directory, exist_ok=True)
+
+    def lock_path(self, path):
+        directory, name = os.path.split(main_path(path))
+        return os.path.join(directory, f".{name}.lock")
+
+    def _open_lock(self, path, operation):
+        """Блокировка файла; None, если неблокирующая блокировка не удалась"""
+        lock_path = self.lock_path(path)
+        os.makedirs(os.path.dirname(lock_path) or '.', exist_ok=True)
+
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, operation)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+
+            # Файл блокировки мог быть удален при вытеснении, пока мы ждали
+            try:
+                if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    @contextmanager
+    def use(self, path):
+        """Отметка файла как используемого на время блока with"""
+        fd = self._open_lock(path, fcntl.LOCK_SH)
+        try:
+            yield path
+        finally:
+            # Время изменения служит временем последнего использования для LRU
+            try:
+                os.utime(path)
+            except OSError:
+                # Файла нет (временный файл удален после обработки) — удаляем
+                # и файл блокировки, если его больше никто не держит
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    if not self._group_exists(path):
+                        os.remove(self.lock_path(path))
+                except OSError:
+                    pass
+            os.close(fd)
+
+    def _group_exists(self, path):
+        path = main_path(path)
+        return any(os.path.exists(path + suffix) for suffix in ('',) + SIDE_SUFFIXES)
+
+    def is_complete(self, path):
+        """Файл загружен полностью и может быть использован повторно"""
+        return os.path.exists(path) and not any(
+            os.path.exists(path + suffix) for suffix in SIDE_SUFFIXES
+        )
+
+    def _scan(self):
+        """Группы файлов (основной и служебные): путь -> [время использования, размер, файлы]"""
+        groups = {}
+
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+
+            for entry in os.scandir(directory):
+                if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                    continue
+
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                group = groups.setdefault(main_path(entry.path), [0, 0, []])
+                group[0] = max(group[0], stat.st_mtime)
+                group[1] += stat.st_size
+                group[2].append(entry.path)
+
+        return groups
+
+    def _remove(self, path, paths):
+        """Удаление группы файлов, если она не используется"""
+        fd = self._open_lock(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if fd is None:
+            return False
+
+        try:
+            for file_path in paths:
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+            os.remove(self.lock_path(path))
+            return True
+        finally:
+            os.close(fd)
+
+    def evict(self):
+        """Удаление устаревших файлов и файлов сверх квоты"""
+        groups = self._scan()
+        now = time.time()
+        usage = sum(size for _, size, _ in groups.values())
+        evictions = evicted_bytes = 0
+
+        # Давно не использовавшиеся файлы идут первыми
+        for path, (last_used, size, paths) in sorted(groups.items(), key=lambda item: item[1][0]):
+            expired = now - last_used > self.ttl
+            if not expired and usage <= self.quota_bytes:
+                break
+
+            if self._remove(path, paths):
+                usage -= size
+                evictions += 1
+                evicted_bytes += size
+
+        with self.lock:
+            self.evictions += evictions
+            self.evicted_bytes += evicted_bytes
+            self.usage_bytes = usage
+            self.files = len(groups) - evictions
+
+        return self.stats()
+
+    def stats(self):
+        """Занятое место и счетчики вытеснения"""
+        with self.lock:
+            return {
+                'usage_bytes': self.usage_bytes,
+                'files': self.files,
+                'quota_bytes': self.quota_bytes,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes
+            }
+
+# Общее хранилище для каталогов загрузок и временных файлов
+file_store = LocalFileStore([DOWNLOAD_DIR, TEMP_DIR], FILE_STORE_QUOTA_MB * 1024 * 1024, FILE_STORE_TTL)
@@ -0,0 +1,97 @@
+import time
+import shutil
+import resource
+import subprocess
+from config import FFMPEG_PATH, MP3_BITRATE
+
+# Функции этого модуля выполняются в пуле процессов (executor.run_cpu_sync),
+# поэтому модуль не импортирует ничего тяжелого
+
+def ffmpeg_available():
+    """Проверка наличия ffmpeg"""
+    return shutil.which(FFMPEG_PATH) is not None
+
+def run_ffmpeg(stage, args):
+    """Запуск ffmpeg с замером времени и процессорного времени.
+
+    Процессорное время берется из getrusage(RUSAGE_CHILDREN) процесса пула,
+    поэтому учитывается только завершившийся ffmpeg.
+    """
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.monotonic()
+
+    result = subprocess.run(
+        [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-y'] + args,
+        capture_output=True,
+        text=True
+    )
+
+    wall_time = time.monotonic() - started
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg ({stage}) завершился с кодом {result.returncode}: {result.stderr.strip()}")
+
+    return {
+        'stage': stage,
+        'wall_time': wall_time,
+        'cpu_time': cpu_time
+    }
+
+def mux_streams(video_path, audio_path, output_path):
+    """Объединение видео- и аудиопотока без перекодирования"""
+    return run_ffmpeg('mux', [
+        '-i', video_path,
+        '-i', audio_path,
+        '-map', '0:v:0',
+        '-map', '1:a:0',
+        '-c', 'copy',
+        '-movflags', '+faststart',
+        '-f', 'mp4',
+        output_path
+    ])
+
+def transcode_to_mp3(input_path, output_path):
+    """Перекодирование аудиопотока в MP3"""
+    return run_ffmpeg('transcode', [
+        '-i', input_path,
+        '-vn',
+        '-codec:a', 'libmp3lame',
+        '-b:a', MP3_BITRATE,
+        '-f', 'mp3',
+        output_path
+    ])
+
+def cut_streams(inputs, duration, file_format, output_path):
+    """Вырезка фрагмента длительностью duration секунд без перекодирования.
+
+    inputs — список (путь, смещение начала фрагмента в секундах): один
+    файл со всеми потоками или видео и аудио отдельно, тогда они
+    объединяются. Фрагмент начинается с ближайшего ключевого кадра до смещения.
+    """
+    args = []
+    for path, offset in inputs:
+        args += ['-ss', f"{offset:.3f}", '-i', path]
+    if len(inputs) == 2:
+        args += ['-map', '0:v:0', '-map', '1:a:0']
+    else:
+        args += ['-map', '0']
+
+    args += ['-t', f"{duration:.3f}", '-c', 'copy', '-avoid_negative_ts', 'make_zero']
+    if file_format == 'mp4':
+        args += ['-movflags', '+faststart']
+    return run_ffmpeg('cut', args + ['-f', file_format, output_path])
+
+def cut_to_mp3(input_path, offset, duration, output_path):
+    """Вырезка фрагмента аудиопотока с перекодированием в MP3"""
+    return run_ffmpeg('cut', [
+        '-ss', f"{offset:.3f}",
+        '-i', input_path,
+        '-t', f"{duration:.3f}",
+        '-vn',
+        '-codec:a', 'libmp3lame',
+        '-b:a', MP3_BITRATE,
+        '-f', 'mp3',
+        output_path
+    ])
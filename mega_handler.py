@@ -1,112 +1,495 @@
 import os
+import json
 import uuid
+import queue
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-import shutil
+import requests
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
 from mega import Mega
-from config import MEGA_EMAIL, MEGA_PASSWORD, DOWNLOAD_DIR, TEMP_DIR, LINK_EXPIRATION_TIME
-from database import register_mega_file, get_expired_mega_files, delete_mega_file_record
+from mega.errors import RequestError
+from mega.crypto import (
+    a32_to_str, str_to_a32, a32_to_base64, base64_url_encode, encrypt_attr, encrypt_key, get_chunks
+)
+from config import (
+    MEGA_ACCOUNTS, LINK_EXPIRATION_TIME, STREAM_BUFFER_CHUNKS,
+    MEGA_POOL_SIZE, MEGA_FILES_CACHE_TTL, MEGA_ACCOUNT_QUOTA_GB, MEGA_USAGE_REFRESH
+)
+from database import register_mega_file, expire_mega_files, get_mega_usage
+from metrics import stage_seconds, transfer_bytes, mega_account_used_bytes
 
-# Инициализация директорий, если они не существуют
-os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-os.makedirs(TEMP_DIR, exist_ok=True)
+logger = logging.getLogger(__name__)
 
-# Создаем экземпляр MEGA
-mega = Mega()
-
-# Функция для входа в MEGA
-def login_to_mega():
+# Функция для входа в аккаунт MEGA.
+# Для каждого входа создается отдельный экземпляр: вызовы выполняются
+# параллельно из пула потоков, а объект Mega хранит состояние сессии
+def login_to_mega(email, password):
     try:
-        m = mega.login(MEGA_EMAIL, MEGA_PASSWORD)
+        with stage_seconds.time(stage='mega_login'):
+            m = Mega().login(email, password)
         return m
     except Exception as e:
-        print(f"Ошибка при входе в MEGA: {e}")
+        logger.error(f"Ошибка при входе в MEGA ({email}): {e}")
         return None
 
-# Функция для загрузки файла на MEGA
-def upload_to_mega(file_path, file_name):
-    try:
-        m = login_to_mega()
+# Пул долгоживущих сессий одного аккаунта MEGA.
+# Вход в MEGA (вывод ключа и загрузка дерева файлов) выполняется один раз
+# на сессию, а не при каждой операции. Сессия, на которой произошла ошибка,
+# закрывается, и при следующем запросе выполняется повторный вход
+class MegaSessionPool:
+    def __init__(self, size, email, password, files_ttl=MEGA_FILES_CACHE_TTL):
+        self.size = size
+        self.email = email
+        self.password = password
+        self.files_ttl = files_ttl
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.available = threading.Semaphore(size)
+        
+        # Кэш идентификатора папки и дерева файлов аккаунта
+        self.folder_id = None
+        self.files = None
+        self.files_loaded_at = 0
+    
+    def acquire(self):
+        self.available.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        m = login_to_mega(self.email, self.password)
         if not m:
+            self.available.release()
             return None
         
-        # Создаем папку для временных файлов, если она не существует
-        folder_name = "youtube_downloads_temp"
-        folders = m.get_files()
+        with self.lock:
+            self.created += 1
+        return m
+    
+    def release(self, m, broken=False):
+        if broken:
+            with self.lock:
+                self.created -= 1
+        else:
+            self.idle.put(m)
+        self.available.release()
+    
+    @contextmanager
+    def session(self):
+        """Сессия MEGA из пула; при ошибке API сессия закрывается и кэш сбрасывается"""
+        m = self.acquire()
+        if not m:
+            raise ConnectionError("Не удалось войти в MEGA")
         
-        # Проверяем, существует ли папка
-        folder_exists = False
-        folder_id = None
+        try:
+            yield m
+        except (RequestError, requests.RequestException, RuntimeError):
+            # Ошибка API или сети: сессия могла истечь, а папка — быть удалена
+            self.release(m, broken=True)
+            self.invalidate()
+            raise
+        except Exception:
+            # Ошибка на нашей стороне (например, в источнике данных) — сессия исправна
+            self.release(m)
+            raise
+        else:
+            self.release(m)
+    
+    def invalidate(self, folder=True):
+        """Сброс кэша дерева файлов (и, по умолчанию, идентификатора папки)"""
+        with self.lock:
+            self.files = None
+            if folder:
+                self.folder_id = None
+    
+    def get_files(self, m):
+        """Дерево файлов аккаунта с кэшированием на files_ttl секунд"""
+        with self.lock:
+            if self.files is not None and time.monotonic() - self.files_loaded_at < self.files_ttl:
+                return self.files
         
-        for item_id, item_data in folders.items():
-            if item_data['a'] and item_data['t'] == 1 and item_data['a']['n'] == folder_name:
-                folder_exists = True
-                folder_id = item_id
-                break
+        files = m.get_files()
         
-        # Если папка не существует, создаем ее
-        if not folder_exists:
-            folder_id = m.create_folder(folder_name)
+        with self.lock:
+            self.files = files
+            self.files_loaded_at = time.monotonic()
+        return files
+    
+    def get_upload_folder(self, m):
+        """Идентификатор папки для временных файлов; дерево файлов читается только при первом обращении"""
+        if self.folder_id:
+            return self.folder_id
         
-        # Загружаем файл в папку
-        file = m.upload(file_path, dest=folder_id)
+        folder_id = get_upload_folder(m, self.get_files(m))
         
-        # Получаем ссылку на файл
-        link = m.get_upload_link(file)
+        with self.lock:
+            self.folder_id = folder_id
+        return folder_id
+
+# Поиск или создание папки для временных файлов
+def get_upload_folder(m, files=None):
+    folder_name = "youtube_downloads_temp"
+    folders = files if files is not None else m.get_files()
+    
+    # Проверяем, существует ли папка
+    for item_id, item_data in folders.items():
+        if item_data['a'] and item_data['t'] == 1 and item_data['a']['n'] == folder_name:
+            return item_id
+    
+    # Если папка не существует, создаем ее
+    return m.create_folder(folder_name)[folder_name]
+
+# Код ошибки API MEGA: на аккаунте закончилось место
+MEGA_OVER_QUOTA = -17
+
+class MegaAccount:
+    """Аккаунт MEGA: пул сессий, занятое место и загрузки, которые идут сейчас"""
+    
+    def __init__(self, email, password, quota):
+        self.email = email
+        self.quota = quota
+        self.sessions = MegaSessionPool(MEGA_POOL_SIZE, email, password)
+        # Байты файлов по базе плюс загруженные процессом после последнего пересчета
+        self.used = 0
+        # Байты и число загрузок этого процесса, которые еще идут
+        self.reserved = 0
+        self.uploads = 0
+    
+    def free(self):
+        return self.quota - self.used - self.reserved
+
+class MegaAccountPool:
+    """Аккаунты MEGA, между которыми распределяются загрузки.
+    
+    Место, занятое на каждом аккаунте, считается по таблице mega_files
+    (сумма размеров еще не удаленных файлов) одним запросом к базе не чаще
+    раза в usage_ttl секунд, а между пересчетами — по загрузкам этого
+    процесса; дерево файлов MEGA для этого не читается. Файл загружается
+    на аккаунт с наименьшим числом текущих загрузок среди тех, где он
+    помещается, а при равенстве — с наибольшим свободным местом.
+    """
+    
+    def __init__(self, accounts, quota, usage_ttl):
+        self.accounts = [MegaAccount(email, password, quota) for email, password in accounts]
+        self.by_email = {account.email: account for account in self.accounts}
+        self.usage_ttl = usage_ttl
+        self.usage_loaded_at = None
+        self.lock = threading.Lock()
+    
+    def find(self, email):
+        """Аккаунт по адресу; файлы без адреса (загруженные до появления нескольких аккаунтов) относятся к первому"""
+        if email is None:
+            return self.accounts[0]
+        return self.by_email.get(email)
+    
+    def refresh_usage(self):
+        """Пересчет занятого места по базе, если с прошлого пересчета прошло больше usage_ttl секунд"""
+        with self.lock:
+            if self.usage_loaded_at is not None and time.monotonic() - self.usage_loaded_at < self.usage_ttl:
+                return
+            self.usage_loaded_at = time.monotonic()
         
-        # Вычисляем время истечения
-        expiration_time = datetime.now() + timedelta(seconds=LINK_EXPIRATION_TIME)
+        try:
+            usage = get_mega_usage()
+        except Exception as e:
+            logger.warning(f"Не удалось получить занятое место на аккаунтах MEGA: {e}")
+            return
+        
+        with self.lock:
+            for account in self.accounts:
+                account.used = usage.get(account.email, 0)
+            self.accounts[0].used += usage.get(None, 0)
+            
+            for account in self.accounts:
+                mega_account_used_bytes.set(account.used, account=account.email)
+    
+    @contextmanager
+    def place(self, file_size):
+        """Выбор аккаунта для загрузки file_size байт; место резервируется до конца блока with"""
+        self.refresh_usage()
         
-        # Регистрируем файл в базе данных
-        register_mega_file(file, file_path, link, expiration_time)
+        with self.lock:
+            fitting = [account for account in self.accounts if account.free() >= file_size]
+            if fitting:
+                account = min(fitting, key=lambda account: (account.uploads, -account.free()))
+            else:
+                account = max(self.accounts, key=MegaAccount.free)
+                logger.warning(f"Ни на одном аккаунте MEGA нет {file_size} байт свободного места, выбран {account.email}")
+            
+            account.uploads += 1
+            account.reserved += file_size
         
-        return {
-            "file_id": file,
-            "link": link,
-            "expiration_time": expiration_time
-        }
+        try:
+            yield account
+        except RequestError as e:
+            if e.code == MEGA_OVER_QUOTA:
+                # Место закончилось раньше, чем показывает учет (например, из-за
+                # чужих файлов): аккаунт не выбирается до следующего пересчета
+                with self.lock:
+                    account.used = account.quota
+            raise
+        else:
+            with self.lock:
+                account.used += file_size
+                mega_account_used_bytes.set(account.used, account=account.email)
+        finally:
+            with self.lock:
+                account.uploads -= 1
+                account.reserved -= file_size
+
+# Общие аккаунты; вход в каждый выполняется при первом использовании
+mega_accounts = MegaAccountPool(MEGA_ACCOUNTS, MEGA_ACCOUNT_QUOTA_GB * 1024 ** 3, MEGA_USAGE_REFRESH)
+
+# Загрузка данных на MEGA по фрагментам.
+# read(size) должна возвращать ровно size байт (меньше — только в конце данных).
+# Повторяет алгоритм Mega.upload, но не требует файла на диске и сообщает
+# о прогрессе: on_bytes(n) вызывается после отправки каждого фрагмента
+def upload_chunks(m, read, file_size, file_name, dest, on_bytes=None):
+    with stage_seconds.time(stage='mega_upload'):
+        return _upload_chunks(m, read, file_size, file_name, dest, on_bytes)
+
+def _upload_chunks(m, read, file_size, file_name, dest, on_bytes):
+    ul_url = m._api_request({'a': 'u', 's': file_size})['p']
     
-    except Exception as e:
-        print(f"Ошибка при загрузке на MEGA: {e}")
-        return None
+    # Случайный ключ AES (128 бит) и nonce для файла
+    ul_key = [random.randint(0, 0xFFFFFFFF) for _ in range(6)]
+    k_str = a32_to_str(ul_key[:4])
+    count = Counter.new(128, initial_value=((ul_key[4] << 32) + ul_key[5]) << 64)
+    aes = AES.new(k_str, AES.MODE_CTR, counter=count)
+    
+    mac_str = b'\0' * 16
+    mac_encryptor = AES.new(k_str, AES.MODE_CBC, mac_str)
+    iv_str = a32_to_str([ul_key[4], ul_key[5], ul_key[4], ul_key[5]])
+    completion_file_handle = None
+    
+    if file_size > 0:
+        for chunk_start, chunk_size in get_chunks(file_size):
+            chunk = read(chunk_size)
+            if len(chunk) != chunk_size:
+                raise IOError(f"Данные закончились раньше ожидаемого: {chunk_start + len(chunk)} из {file_size} байт")
+            
+            # MAC фрагмента — последний блок CBC по фрагменту, дополненному нулями
+            padded = chunk + b'\0' * (-len(chunk) % 16)
+            chunk_mac = AES.new(k_str, AES.MODE_CBC, iv_str).encrypt(padded)[-16:]
+            mac_str = mac_encryptor.encrypt(chunk_mac)
+            
+            # Шифруем и отправляем фрагмент
+            response = requests.post(f"{ul_url}/{chunk_start}", data=aes.encrypt(chunk), timeout=m.timeout)
+            completion_file_handle = response.text
+            transfer_bytes.inc(chunk_size, direction='mega')
+            if on_bytes:
+                on_bytes(chunk_size)
+    else:
+        response = requests.post(f"{ul_url}/0", data='', timeout=m.timeout)
+        completion_file_handle = response.text
+    
+    # Вычисляем meta MAC и ключ файла
+    file_mac = str_to_a32(mac_str)
+    meta_mac = (file_mac[0] ^ file_mac[1], file_mac[2] ^ file_mac[3])
+    
+    encrypt_attribs = base64_url_encode(encrypt_attr({'n': file_name}, ul_key[:4]))
+    key = [
+        ul_key[0] ^ ul_key[4], ul_key[1] ^ ul_key[5],
+        ul_key[2] ^ meta_mac[0], ul_key[3] ^ meta_mac[1],
+        ul_key[4], ul_key[5], meta_mac[0], meta_mac[1]
+    ]
+    encrypted_key = a32_to_base64(encrypt_key(key, m.master_key))
+    
+    # Завершаем загрузку, создавая узел файла в папке
+    return m._api_request({
+        'a': 'p',
+        't': dest,
+        'i': m.request_id,
+        'n': [{
+            'h': completion_file_handle,
+            't': 0,
+            'a': encrypt_attribs,
+            'k': encrypted_key
+        }]
+    })
 
-# Функция для удаления файлов с истекшим сроком действия
-def cleanup_expired_files():
+# Получение ссылки на загруженный файл и регистрация его в базе данных.
+# Файл без записи в базе никогда не был бы удален, поэтому при ошибке он
+# сразу удаляется с MEGA
+def publish_uploaded_file(m, file, path, account, file_size):
+    # Идентификатор узла MEGA, по которому файл потом удаляется
+    file_id = file['f'][0]['h']
+    
+    # Вычисляем время истечения
+    expiration_time = datetime.now() + timedelta(seconds=LINK_EXPIRATION_TIME)
+    
     try:
-        m = login_to_mega()
-        if not m:
-            return
+        # Получаем ссылку на файл
+        link = m.get_upload_link(file)
         
-        # Получаем просроченные файлы из базы данных
-        expired_files = get_expired_mega_files()
+        # Регистрируем файл в базе данных вместе с аккаунтом, с которого его потом удалять
+        register_mega_file(file_id, path, link, expiration_time, account.email, file_size)
+    except Exception:
+        try:
+            destroy_files([file_id], account.email)
+        except Exception as e:
+            logger.error(f"Не удалось удалить незарегистрированный файл {file_id} с MEGA ({account.email}): {e}")
+        raise
+    
+    return {
+        "file_id": file_id,
+        "link": link,
+        "expiration_time": expiration_time
+    }
+
+# Функция для загрузки файла на MEGA
+def upload_to_mega(file_path, file_name, on_bytes=None):
+    file_size = os.path.getsize(file_path)
+    
+    try:
+        with mega_accounts.place(file_size) as account, account.sessions.session() as m:
+            folder_id = account.sessions.get_upload_folder(m)
+            
+            # Загружаем файл в папку под именем для пользователя: локальный
+            # файл назван по идентификатору видео
+            with open(file_path, 'rb') as f:
+                file = upload_chunks(m, f.read, file_size, file_name, folder_id, on_bytes)
+            account.sessions.invalidate(folder=False)
+            
+            return publish_uploaded_file(m, file, file_path, account, file_size)
+    
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке на MEGA: {e}")
+        return None
+
+# Чтение данных из ограниченной очереди фрагментов, которую заполняет поток загрузки
+class QueueReader:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.pending = bytearray()
+        self.eof = False
+    
+    def read(self, size):
+        while len(self.pending) < size and not self.eof:
+            item = self.buffer.get()
+            if item is None:
+                self.eof = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                self.pending += item
         
-        for file in expired_files:
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+# Поток, переносящий фрагменты из источника в очередь.
+# Когда очередь заполнена, поток ждет: так загрузка с YouTube не обгоняет
+# загрузку на MEGA больше чем на размер буфера
+def produce_chunks(chunks, buffer, stop):
+    def put(item):
+        while not stop.is_set():
             try:
-                # Удаляем файл из MEGA
-                m.delete(file.file_id)
-                
-                # Удаляем запись из базы данных
-                delete_mega_file_record(file.file_id)
-                
-                # Если есть локальный файл, удаляем его
-                if os.path.exists(file.path):
-                    os.remove(file.path)
-            except Exception as e:
-                print(f"Ошибка при удалении файла {file.file_id}: {e}")
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    try:
+        for chunk in chunks:
+            if not put(chunk):
+                return
+        put(None)
+    except Exception as e:
+        put(e)
+
+# Потоковая загрузка на MEGA без сохранения файла на диск.
+# Скачивание и загрузка идут одновременно, в памяти хранится не больше
+# STREAM_BUFFER_CHUNKS фрагментов и один фрагмент MEGA (до 1 МБ)
+def upload_stream_to_mega(chunks, file_size, file_name, on_bytes=None):
+    stop = threading.Event()
+    
+    try:
+        with mega_accounts.place(file_size) as account, account.sessions.session() as m:
+            folder_id = account.sessions.get_upload_folder(m)
+            
+            buffer = queue.Queue(maxsize=STREAM_BUFFER_CHUNKS)
+            producer = threading.Thread(target=produce_chunks, args=(chunks, buffer, stop), daemon=True)
+            producer.start()
+            
+            file = upload_chunks(m, QueueReader(buffer).read, file_size, file_name, folder_id, on_bytes)
+            account.sessions.invalidate(folder=False)
+            
+            # Локального файла нет, поэтому путь не сохраняем
+            return publish_uploaded_file(m, file, '', account, file_size)
     
     except Exception as e:
-        print(f"Ошибка при очистке файлов: {e}")
+        logger.error(f"Ошибка при потоковой загрузке на MEGA: {e}")
+        return None
+    finally:
+        stop.set()
+
+# Коды ответа API MEGA, при которых файла на MEGA больше нет
+MEGA_DELETED_CODES = (0, -9)  # успех, ENOENT (уже удален другим процессом)
+
+# Отправка нескольких команд API одним запросом.
+# Mega._api_request возвращает только первый ответ, поэтому запрос
+# собирается так же, как в нем, но возвращается весь список ответов
+def api_batch_request(m, commands):
+    params = {'id': m.sequence_num}
+    m.sequence_num += 1
+    if m.sid:
+        params['sid'] = m.sid
+    
+    response = requests.post(
+        f'{m.schema}://g.api.{m.domain}/cs',
+        params=params,
+        data=json.dumps(commands),
+        timeout=m.timeout
+    )
+    result = json.loads(response.text)
+    
+    # Ошибка всего запроса приходит одним числом
+    if isinstance(result, int):
+        if result == -3:
+            raise RuntimeError('Request failed, retrying')
+        raise RequestError(result)
+    return result
+
+# Безвозвратное удаление файлов с аккаунта MEGA (адрес; None — первый аккаунт) одним запросом.
+# destroy не требует загрузки дерева файлов, в отличие от перемещения в корзину.
+# Возвращает идентификаторы файлов, которых больше нет на MEGA
+def destroy_files(file_ids, email=None):
+    account = mega_accounts.find(email)
+    if not account:
+        # Аккаунт убран из настроек: файлы остаются в базе до его возвращения
+        logger.warning(f"Аккаунт MEGA {email} не настроен, удаление {len(file_ids)} файлов отложено")
+        return []
+    
+    with account.sessions.session() as m:
+        results = api_batch_request(m, [
+            {'a': 'd', 'n': file_id, 'i': m.request_id}
+            for file_id in file_ids
+        ])
+    
+    removed = []
+    for file_id, result in zip(file_ids, results):
+        if result in MEGA_DELETED_CODES:
+            removed.append(file_id)
+        else:
+            logger.warning(f"Ошибка при удалении файла {file_id}: код {result}")
+    
+    account.sessions.invalidate(folder=False)
+    return removed
 
-# Функция для очистки временных локальных файлов
-def cleanup_local_files():
+# Удаление одной пачки истекших файлов с MEGA и из базы данных.
+# Возвращает число удаленных файлов и наибольшую задержку удаления в секундах
+def cleanup_expired_files(limit=100):
     try:
-        # Очищаем директории загрузок и временных файлов
-        for dir_path in [DOWNLOAD_DIR, TEMP_DIR]:
-            if os.path.exists(dir_path):
-                for item in os.listdir(dir_path):
-                    item_path = os.path.join(dir_path, item)
-                    if os.path.isfile(item_path):
-                        os.remove(item_path)
-                    elif os.path.isdir(item_path):
-                        shutil.rmtree(item_path)
+        return expire_mega_files(destroy_files, limit)
     except Exception as e:
-        print(f"Ошибка при очистке локальных файлов: {e}") 
\ No newline at end of file
+        logger.error(f"Ошибка при очистке файлов: {e}")
+        return 0, None
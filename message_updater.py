@@ -0,0 +1,164 @@
+import time
+import asyncio
+import logging
+from telegram.error import BadRequest, RetryAfter
+from config import PROGRESS_EDIT_INTERVAL, TELEGRAM_EDIT_RATE
+from metrics import telegram_edits
+
+logger = logging.getLogger(__name__)
+
+# Записи об отправленных текстах старше этого времени (в секундах) удаляются
+SENT_TEXT_TTL = 3600
+
+class MessageUpdater:
+    """Изменение сообщений о задачах с учетом ограничений Telegram.
+
+    Новый текст сообщения заменяет еще не отправленный, поэтому частые
+    обновления прогресса объединяются и сообщение меняется не чаще раза в
+    min_interval секунд. Итоговые тексты (final) отправляются без ожидания
+    интервала и не заменяются промежуточными. Общее число изменений
+    ограничено rate в секунду; при ответе RetryAfter отправка
+    приостанавливается на указанное Telegram время. Текст, совпадающий с
+    уже отправленным, не отправляется.
+    """
+
+    def __init__(self, bot, min_interval=PROGRESS_EDIT_INTERVAL, rate=TELEGRAM_EDIT_RATE):
+        self.bot = bot
+        self.min_interval = min_interval
+        self.rate = rate
+        self.pending = {}  # (chat_id, message_id) -> (текст, итоговый)
+        self.sent = {}  # (chat_id, message_id) -> (текст, время отправки)
+        self.tokens = rate
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0
+        self.wakeup = asyncio.Event()
+
+    def submit(self, chat_id, message_id, text, final=False):
+        """Постановка нового текста сообщения в очередь на отправку"""
+        key = (chat_id, message_id)
+
+        queued = self.pending.get(key)
+        if queued and queued[1] and not final:
+            return
+        if not final and key in self.sent and self.sent[key][0] == text:
+            self.pending.pop(key, None)
+            return
+
+        self.pending[key] = (text, final)
+        self.wakeup.set()
+
+    def _ready(self, now):
+        """Сообщения, которые можно изменить сейчас: сначала итоговые, затем давно не менявшиеся"""
+        ready = []
+        for key, (text, final) in self.pending.items():
+            sent_at = self.sent[key][1] if key in self.sent else 0
+            if final or now - sent_at >= self.min_interval:
+                ready.append((not final, sent_at, key))
+        ready.sort()
+        return [key for _, _, key in ready]
+
+    async def _edit(self, key, text, final):
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(
+                text,
+                chat_id=chat_id,
+                message_id=message_id,
+                parse_mode='HTML',
+                disable_web_page_preview=True
+            )
+        except RetryAfter as e:
+            # Превышен лимит: текст возвращается в очередь, если его не заменил более новый
+            telegram_edits.inc(result='retry_after')
+            self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            if final or key not in self.pending:
+                self.pending[key] = (text, final)
+            return
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                telegram_edits.inc(result='error')
+                logger.error(f"Не удалось изменить сообщение {message_id}: {e}")
+        except Exception as e:
+            telegram_edits.inc(result='error')
+            logger.error(f"Не удалось изменить сообщение {message_id}: {e}")
+        else:
+            telegram_edits.inc(result='ok')
+
+        if final:
+            self.sent.pop(key, None)
+        else:
+            self.sent[key] = (text, time.monotonic())
+
+    async def flush(self):
+        """Отправка всех сообщений, которые можно изменить сейчас; возвращает время до следующей попытки"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        self.tokens = min(self.rate, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+        batch = []
+        for key in self._ready(now):
+            if self.tokens < 1:
+                break
+            text, final = self.pending.pop(key)
+            self.tokens -= 1
+            batch.append(self._edit(key, text, final))
+
+        if batch:
+            await asyncio.gather(*batch)
+
+        if not self.pending:
+            return None
+
+        # Ожидание до готовности ближайшего сообщения и появления свободного изменения
+        now = time.monotonic()
+        next_ready = min(
+            0 if final or key not in self.sent else self.sent[key][1] + self.min_interval - now
+            for key, (_, final) in self.pending.items()
+        )
+        token_wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+        return max(next_ready, token_wait, 0.05)
+
+    async def drain(self, timeout):
+        """Отправка итоговых текстов при остановке; возвращает число неотправленных.
+
+        Промежуточные тексты отбрасываются, итоговые отправляются с учетом
+        тех же ограничений, пока не истечет timeout секунд.
+        """
+        for key in [key for key, (_, final) in self.pending.items() if not final]:
+            del self.pending[key]
+
+        deadline = time.monotonic() + timeout
+        while self.pending:
+            delay = await self.flush()
+            remaining = deadline - time.monotonic()
+            if delay is None or remaining <= 0:
+                break
+            await asyncio.sleep(min(delay, remaining))
+
+        return len(self.pending)
+
+    def prune(self):
+        """Удаление записей о сообщениях, которые давно не менялись"""
+        threshold = time.monotonic() - SENT_TEXT_TTL
+        for key in [key for key, (_, sent_at) in self.sent.items() if sent_at < threshold]:
+            del self.sent[key]
+
+    async def run(self):
+        """Цикл отправки; выполняется как фоновая задача приложения"""
+        pruned_at = time.monotonic()
+
+        while True:
+            self.wakeup.clear()
+            delay = await self.flush()
+
+            if time.monotonic() - pruned_at > SENT_TEXT_TTL:
+                self.prune()
+                pruned_at = time.monotonic()
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,296 @@
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from config import LOG_TRACE_IDS
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительности этапов, секунды
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Метрика с набором меток; значения хранятся по кортежу значений меток"""
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labels}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """Строки (суффикс имени, значения меток, дополнительные метки, значение)"""
+        with self.lock:
+            return [('', key, (), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labels, key, extra)} {_format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Текущее значение; для метрики без меток значение может вычисляться при чтении"""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        try:
+            return [('', (), (), self.function())]
+        except Exception as e:
+            logger.warning(f"Не удалось вычислить метрику {self.name}: {e}")
+            return []
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Измерение длительности блока with (в том числе завершившегося ошибкой)"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+
+        samples = []
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                samples.append(('_bucket', key, (('le', _format_value(bound)),), count))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), counts[-1]))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# Метрики конвейера задач. В боте и воркере заполняются разные метрики,
+# но набор один, чтобы их можно было собирать с обоих процессов одинаково
+stage_seconds = registry.register(Histogram(
+    'youtubesaver_stage_seconds',
+    'Длительность этапов: metadata, download, mux, transcode, cut, mega_login, mega_upload, '
+    'telegram_send, queue_wait, db_flush, cleanup_mega, cleanup_local, intake',
+    ['stage']
+))
+transfer_bytes = registry.register(Counter(
+    'youtubesaver_transfer_bytes_total',
+    'Переданные байты: youtube (скачано), mega и telegram (отправлено)',
+    ['direction']
+))
+jobs_total = registry.register(Counter(
+    'youtubesaver_jobs_total',
+    'Завершенные попытки выполнения задач по результату (done, retried, failed, cancelled)',
+    ['result']
+))
+telegram_edits = registry.register(Counter(
+    'youtubesaver_telegram_edits_total',
+    'Изменения сообщений о задачах по результату (ok, retry_after, error)',
+    ['result']
+))
+db_writes = registry.register(Counter(
+    'youtubesaver_db_buffered_writes_total',
+    'Изменения, записанные буфером отложенной записи'
+))
+mega_files_deleted = registry.register(Counter(
+    'youtubesaver_mega_files_deleted_total',
+    'Истекшие файлы, удаленные с MEGA'
+))
+updates_total = registry.register(Counter(
+    'youtubesaver_updates_total',
+    'Обновления Telegram, полученные через webhook (accepted, duplicate, rejected, invalid)',
+    ['result']
+))
+intake_queue_depth = registry.register(Gauge(
+    'youtubesaver_intake_queue_depth',
+    'Обновления Telegram, ожидающие обработки'
+))
+db_pool_wait_seconds = registry.register(Histogram(
+    'youtubesaver_db_pool_wait_seconds',
+    'Ожидание соединения из пула базы данных (sync — потоки, async — цикл событий)',
+    ['pool'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+))
+db_pool_in_use = registry.register(Gauge(
+    'youtubesaver_db_pool_connections_in_use',
+    'Соединения, выданные из пула базы данных',
+    ['pool']
+))
+speculative_total = registry.register(Counter(
+    'youtubesaver_speculative_total',
+    'Упреждающие загрузки: hit и miss (угадано ли качество), prefetched и cancelled (результат загрузки)',
+    ['result']
+))
+speculative_wasted_bytes = registry.register(Counter(
+    'youtubesaver_speculative_wasted_bytes_total',
+    'Байты, скачанные упреждающими загрузками, которые были отменены'
+))
+jobs_rejected = registry.register(Counter(
+    'youtubesaver_jobs_rejected_total',
+    'Запросы, отклоненные при заполненной очереди задач: queue (общая очередь) и user (очередь пользователя)',
+    ['reason']
+))
+cache_lookups = registry.register(Counter(
+    'youtubesaver_cache_lookups_total',
+    'Поиск ссылки MEGA в кэше результатов: hit и miss',
+    ['result']
+))
+clip_skipped_bytes = registry.register(Counter(
+    'youtubesaver_clip_skipped_bytes_total',
+    'Байты исходных потоков, которые не пришлось скачивать при вырезке фрагмента по индексу'
+))
+throttle_seconds = registry.register(Counter(
+    'youtubesaver_throttle_seconds_total',
+    'Время, на которое загрузки приостанавливались ограничением скорости: global, user и speculative',
+    ['scope']
+))
+jobs_in_flight = registry.register(Gauge(
+    'youtubesaver_jobs_in_flight',
+    'Задачи, выполняемые процессом воркера'
+))
+mega_account_used_bytes = registry.register(Gauge(
+    'youtubesaver_mega_account_used_bytes',
+    'Место, занятое файлами бота на аккаунте MEGA (по базе и загрузкам этого процесса)',
+    ['account']
+))
+disk_usage_bytes = registry.register(Gauge(
+    'youtubesaver_disk_usage_bytes',
+    'Место, занятое локальным хранилищем файлов (по последней проверке квоты)'
+))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_metrics_server(host, port):
+    """Запуск HTTP-сервера /metrics в фоновом потоке; port 0 — сервер не запускается"""
+    if not port:
+        return None
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Метрики доступны по адресу http://{host}:{port}/metrics")
+    return server
+
+# Идентификатор трассировки текущей задачи или обновления Telegram. Переменная
+# контекста передается в пул потоков через run_io, а между процессами — в
+# поле trace_id задачи
+trace_id_var = contextvars.ContextVar('trace_id', default=None)
+
+def current_trace_id():
+    return trace_id_var.get()
+
+@contextmanager
+def trace(trace_id):
+    """Выполнение блока with с заданным идентификатором трассировки"""
+    token = trace_id_var.set(trace_id)
+    try:
+        yield trace_id
+    finally:
+        trace_id_var.reset(token)
+
+class TraceIdFilter(logging.Filter):
+    """Добавление идентификатора трассировки в записи журнала"""
+
+    def filter(self, record):
+        record.trace_id = trace_id_var.get() or '-'
+        return True
+
+def setup_logging(level=logging.INFO):
+    """Настройка журнала процесса; при LOG_TRACE_IDS в записи добавляется идентификатор трассировки"""
+    log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    if LOG_TRACE_IDS:
+        log_format = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+
+    logging.basicConfig(format=log_format, level=level)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(TraceIdFilter())
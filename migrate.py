@@ -0,0 +1,25 @@
+import logging
+from database import init_db, missing_schema, dispose_engine
+from metrics import setup_logging
+
+# Создание и обновление схемы базы данных. Выполняется один раз при
+# развертывании, до запуска бота и воркеров: сами они схему не меняют,
+# а только проверяют при запуске, что миграция выполнена
+logger = logging.getLogger(__name__)
+
+def main() -> None:
+    setup_logging()
+
+    missing = missing_schema()
+    if missing:
+        logger.info(f"Создание недостающих таблиц и столбцов: {', '.join(missing)}")
+
+    try:
+        init_db()
+    finally:
+        dispose_engine()
+
+    logger.info("Схема базы данных актуальна")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import struct
+
+# Разбор индекса фрагментированного MP4 (DASH): по боксу sidx время
+# фрагмента сопоставляется с диапазоном байт потока. Адаптивные потоки
+# YouTube в mp4 устроены так: ftyp и moov (инициализирующий сегмент),
+# затем sidx со списком фрагментов и сами фрагменты moof + mdat
+
+class IndexNotFound(Exception):
+    """В начале потока нет индекса sidx (например, обычный MP4 или WebM)"""
+
+def locate_index(head):
+    """Положение бокса sidx в начале потока head: (начало, конец).
+
+    Все боксы до sidx (ftyp и moov) — инициализирующий сегмент. Если
+    данных не хватает, чтобы дойти до sidx, возвращается (None, смещение):
+    начало потока нужно дочитать до этого смещения и повторить поиск.
+    Если sidx нет до первого фрагмента, возникает IndexNotFound.
+    """
+    offset = 0
+    while True:
+        if offset + 16 > len(head):
+            return None, offset + 16
+
+        size, box_type = struct.unpack_from('>I4s', head, offset)
+        if size == 1:
+            size = struct.unpack_from('>Q', head, offset + 8)[0]
+        # Тип бокса — четыре латинские буквы или цифры; иначе это не MP4 (например, WebM)
+        if not box_type.isalnum() or size < 8:
+            raise IndexNotFound("Начало потока не похоже на MP4")
+        if box_type == b'sidx':
+            return offset, offset + size
+        if box_type in (b'moof', b'mdat'):
+            raise IndexNotFound("Индекс sidx не найден")
+        offset += size
+
+def parse_sidx(box, anchor):
+    """Фрагменты из бокса sidx: список (начало, конец в секундах, первый байт, последний байт).
+
+    anchor — смещение в потоке первого байта после sidx, от которого
+    отсчитываются смещения фрагментов.
+    """
+    version = box[8]
+    timescale = struct.unpack_from('>I', box, 16)[0]
+    if version == 0:
+        earliest, first_offset = struct.unpack_from('>II', box, 20)
+        position = 28
+    else:
+        earliest, first_offset = struct.unpack_from('>QQ', box, 20)
+        position = 36
+    count = struct.unpack_from('>H', box, position + 2)[0]
+    position += 4
+
+    if not timescale:
+        raise ValueError("Нулевая шкала времени в sidx")
+
+    segments = []
+    time, offset = earliest, anchor + first_offset
+    for _ in range(count):
+        reference, duration = struct.unpack_from('>II', box, position)
+        position += 12
+        if reference & 0x80000000:
+            # Ссылка на вложенный sidx: такие индексы YouTube не использует
+            raise ValueError("Иерархический индекс sidx не поддерживается")
+        size = reference & 0x7FFFFFFF
+        segments.append((time / timescale, (time + duration) / timescale, offset, offset + size - 1))
+        time += duration
+        offset += size
+    return segments
+
+def select_segments(segments, start, end):
+    """Фрагменты, покрывающие отрезок [start, end] секунд: (начало первого в секундах, первый байт, последний байт).
+
+    Фрагмент начинается с ключевого кадра, поэтому для вырезки без
+    перекодирования достаточно байт с начала фрагмента, в который попадает start.
+    """
+    selected = [segment for segment in segments if segment[1] > start and segment[0] < end]
+    if not selected:
+        raise ValueError(f"Отрезок {start}-{end} вне индекса потока")
+    return selected[0][0], selected[0][2], selected[-1][3]
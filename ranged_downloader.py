@@ -0,0 +1,319 @@
+import os
+import json
+import queue
+import logging
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from config import DOWNLOAD_CONNECTIONS, DOWNLOAD_PART_SIZE, DOWNLOAD_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Размер блока чтения из сокета
+READ_BLOCK_SIZE = 256 * 1024
+
+# Максимальное число перенаправлений для одного запроса
+MAX_REDIRECTS = 5
+
+class RangeNotSupported(Exception):
+    """Сервер не поддерживает Range-запросы"""
+
+def progress_path(file_path):
+    """Путь к файлу прогресса рядом с загружаемым файлом"""
+    return f"{file_path}.progress"
+
+def load_progress(file_path, file_size, part_size):
+    """Номера уже загруженных частей, если прогресс относится к тому же файлу"""
+    try:
+        with open(progress_path(file_path)) as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if progress.get('size') != file_size or progress.get('part_size') != part_size:
+        return None
+    if not os.path.exists(file_path) or os.path.getsize(file_path) != file_size:
+        return None
+    return set(progress.get('done', []))
+
+def save_progress(file_path, file_size, part_size, done):
+    """Атомарная запись прогресса (через временный файл)"""
+    path = progress_path(file_path)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump({'size': file_size, 'part_size': part_size, 'done': sorted(done)}, f)
+    os.replace(temp_path, path)
+
+def preallocate(file_path, file_size):
+    """Создание файла нужного размера, в который части пишутся по своим смещениям"""
+    with open(file_path, 'wb') as f:
+        if file_size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(f.fileno(), 0, file_size)
+                return
+            except OSError:
+                pass
+        f.truncate(file_size)
+
+class ByteCounter:
+    """Сообщение о полученных байтах участка файла без повторов.
+
+    Участок, загружаемый заново (часть после сбоя или весь файл после
+    отказа сервера от Range-запросов), снова получает байты, о которых уже
+    сообщено: on_bytes получает только прирост сверх наибольшего числа
+    байт, полученных за одну попытку. reported — байты, уже сообщенные
+    до первой попытки.
+    """
+
+    def __init__(self, on_bytes, reported=0):
+        self.on_bytes = on_bytes
+        self.reported = reported
+        self.received = 0
+
+    def restart(self):
+        """Новая попытка загрузить участок с начала"""
+        self.received = 0
+
+    def __call__(self, count):
+        self.received += count
+        if self.received > self.reported:
+            count, self.reported = self.received - self.reported, self.received
+            self.on_bytes(count)
+
+class ConnectionPool:
+    """Постоянные HTTP-соединения, по одному на поток загрузки и хост"""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get(self, scheme, netloc):
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+
+        key = (scheme, netloc)
+        if key not in connections:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            connections[key] = connection_class(netloc, timeout=self.timeout)
+        return connections[key]
+
+    def discard(self, scheme, netloc):
+        connections = getattr(self.local, 'connections', {})
+        connection = connections.pop((scheme, netloc), None)
+        if connection:
+            connection.close()
+
+def open_response(pool, url, headers):
+    """GET-запрос по постоянному соединению с переходом по перенаправлениям: (ответ, части URL)"""
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else '')
+        connection = pool.get(parts.scheme, parts.netloc)
+
+        try:
+            connection.request('GET', path, headers=dict(headers, **{
+                'User-Agent': 'Mozilla/5.0',
+                'Connection': 'keep-alive'
+            }))
+            response = connection.getresponse()
+        except (OSError, http.client.HTTPException):
+            pool.discard(parts.scheme, parts.netloc)
+            raise
+
+        if response.status in (301, 302, 303, 307, 308):
+            response.read()
+            url = urljoin(url, response.getheader('Location'))
+            continue
+        return response, parts
+
+    raise IOError(f"Слишком много перенаправлений для {url}")
+
+def fetch_range(pool, url, start, end, fd, on_bytes=None, remote_offset=0):
+    """Загрузка диапазона байт [start, end] и запись его в файл по смещению start.
+
+    remote_offset — смещение файла в ресурсе: запрашиваются байты
+    [start + remote_offset, end + remote_offset].
+    """
+    response, parts = open_response(pool, url, {'Range': f'bytes={start + remote_offset}-{end + remote_offset}'})
+
+    if response.status != 206:
+        if response.status == 200:
+            # Тело ответа — весь ресурс: соединение закрывается, не дочитывая его
+            pool.discard(parts.scheme, parts.netloc)
+            raise RangeNotSupported(f"Сервер вернул 200 вместо 206 для {start}-{end}")
+        response.read()
+        raise IOError(f"HTTP {response.status} для диапазона {start}-{end}")
+
+    offset = start
+    try:
+        while True:
+            block = response.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            os.pwrite(fd, block, offset)
+            offset += len(block)
+            if on_bytes:
+                on_bytes(len(block))
+    except (OSError, http.client.HTTPException):
+        pool.discard(parts.scheme, parts.netloc)
+        raise
+
+    if offset != end + 1:
+        pool.discard(parts.scheme, parts.netloc)
+        raise IOError(f"Диапазон {start}-{end} получен не полностью: {offset - start} байт")
+
+def fetch_sequential(pool, url, file_size, fd, on_bytes=None, remote_offset=0):
+    """Загрузка file_size байт ресурса с смещения remote_offset одним запросом без Range.
+
+    Запасной вариант для серверов, которые отвечают на Range-запросы
+    полным телом (200): байты до remote_offset читаются и отбрасываются,
+    остальные пишутся в файл с начала.
+    """
+    response, parts = open_response(pool, url, {})
+
+    try:
+        if response.status != 200:
+            raise IOError(f"HTTP {response.status} для {url}")
+
+        skip = remote_offset
+        while skip:
+            block = response.read(min(READ_BLOCK_SIZE, skip))
+            if not block:
+                break
+            skip -= len(block)
+
+        offset = 0
+        while offset < file_size:
+            block = response.read(min(READ_BLOCK_SIZE, file_size - offset))
+            if not block:
+                break
+            os.pwrite(fd, block, offset)
+            offset += len(block)
+            if on_bytes:
+                on_bytes(len(block))
+    finally:
+        # Остаток тела не дочитывается, поэтому соединение не используется повторно
+        pool.discard(parts.scheme, parts.netloc)
+
+    if offset != file_size:
+        raise IOError(f"Получено {offset} из {file_size} байт")
+
+def download_ranges(url, file_path, file_size, connections=DOWNLOAD_CONNECTIONS,
+                    part_size=DOWNLOAD_PART_SIZE, retries=DOWNLOAD_RETRIES, on_bytes=None, remote_offset=0):
+    """Загрузка файла частями по нескольким соединениям с возобновлением.
+
+    Файл делится на части по part_size байт, которые параллельно загружаются
+    Range-запросами и пишутся в заранее созданный файл. Номера загруженных
+    частей сохраняются в файле прогресса, поэтому прерванная загрузка
+    продолжается с места остановки. on_bytes(n) вызывается по мере получения
+    данных, каждый байт файла сообщается один раз; части, загруженные до
+    возобновления, сообщаются в начале одним вызовом on_bytes(n, resumed=True).
+    Если задан remote_offset, загружается не весь ресурс, а file_size байт
+    начиная с этого смещения. Если сервер не поддерживает Range-запросы,
+    файл загружается заново одним запросом.
+    """
+    # Файл без прогресса нужного размера считается уже загруженным
+    if os.path.exists(file_path) and not os.path.exists(progress_path(file_path)) \
+            and os.path.getsize(file_path) == file_size:
+        return file_path
+
+    part_count = max(1, -(-file_size // part_size))
+    done = load_progress(file_path, file_size, part_size)
+
+    if done is None:
+        done = set()
+        # Прогресс записывается до создания файла, чтобы недокачанный файл
+        # нельзя было принять за полностью загруженный
+        save_progress(file_path, file_size, part_size, done)
+        preallocate(file_path, file_size)
+
+    if file_size == 0:
+        os.remove(progress_path(file_path))
+        return file_path
+
+    parts = queue.Queue()
+    for index in range(part_count):
+        if index not in done:
+            parts.put(index)
+
+    resumed = sum(min(part_size, file_size - index * part_size) for index in done)
+    if on_bytes and resumed:
+        on_bytes(resumed, resumed=True)
+
+    pool = ConnectionPool()
+    lock = threading.Lock()
+    errors = []
+    counters = []
+
+    fd = os.open(file_path, os.O_WRONLY)
+
+    def worker():
+        while not errors:
+            try:
+                index = parts.get_nowait()
+            except queue.Empty:
+                return
+
+            start = index * part_size
+            end = min(start + part_size, file_size) - 1
+            counter = None
+            if on_bytes:
+                counter = ByteCounter(on_bytes)
+                with lock:
+                    counters.append(counter)
+
+            for attempt in range(retries + 1):
+                if counter:
+                    counter.restart()
+                try:
+                    fetch_range(pool, url, start, end, fd, counter, remote_offset)
+                    break
+                except RangeNotSupported as e:
+                    errors.append(e)
+                    return
+                except (OSError, http.client.HTTPException) as e:
+                    if attempt == retries:
+                        errors.append(e)
+                        return
+                except Exception as e:
+                    # Ошибка из on_bytes (например, отмена загрузки) останавливает все соединения
+                    errors.append(e)
+                    return
+
+            with lock:
+                done.add(index)
+                save_progress(file_path, file_size, part_size, done)
+
+    try:
+        threads = [
+            threading.Thread(target=worker, daemon=True)
+            for _ in range(min(connections, parts.qsize()))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors and isinstance(errors[0], RangeNotSupported):
+            logger.warning(f"{errors[0]}: загрузка одним соединением без возобновления")
+            errors = []
+            # Файл загружается заново целиком: сообщаются только байты сверх уже сообщенных частями
+            counter = ByteCounter(on_bytes, resumed + sum(part.reported for part in counters)) if on_bytes else None
+            for attempt in range(retries + 1):
+                if counter:
+                    counter.restart()
+                try:
+                    fetch_sequential(pool, url, file_size, fd, counter, remote_offset)
+                    break
+                except (OSError, http.client.HTTPException) as e:
+                    if attempt == retries:
+                        errors.append(e)
+    finally:
+        os.close(fd)
+
+    if errors:
+        raise errors[0]
+
+    os.remove(progress_path(file_path))
+    return file_path
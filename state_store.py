@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+from config import CONVERSATION_STATE_TTL, CONVERSATION_STATE_CACHE_SIZE
+from database_async import (
+    save_conversation_state, get_conversation_state, take_conversation_state, delete_expired_conversation_states
+)
+from ttl_cache import TTLCache
+
+def message_key(chat_id, message_id):
+    """Ключ состояния сообщения с клавиатурой"""
+    return f"{chat_id}:{message_id}"
+
+class ConversationStateStore:
+    """Состояние диалогов в базе данных с кэшем в памяти процесса.
+
+    Состояние привязано к ключу (обычно к сообщению с клавиатурой) и не
+    меняется после записи, поэтому кэш в памяти не расходится с базой, а
+    нажатие кнопки может обработать любой экземпляр бота. Записи
+    истекают через ttl секунд.
+    """
+
+    def __init__(self, cache_size=CONVERSATION_STATE_CACHE_SIZE, ttl=CONVERSATION_STATE_TTL):
+        self.ttl = ttl
+        self.cache = TTLCache(cache_size, ttl)
+
+    async def put(self, key, data):
+        await save_conversation_state(key, data, datetime.now() + timedelta(seconds=self.ttl))
+        self.cache.set(key, data)
+
+    async def get(self, key):
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+
+        state = await get_conversation_state(key)
+        if not state:
+            return None
+
+        data, expires_at = state
+        self.cache.set(key, data, ttl=(expires_at - datetime.now()).total_seconds())
+        return data
+
+    async def take(self, key):
+        """Получение и удаление состояния; база решает, какому из одновременных вызовов оно достанется"""
+        self.cache.pop(key)
+        return await take_conversation_state(key)
+
+    async def cleanup(self):
+        return await delete_expired_conversation_states()
+
+# Общее хранилище процесса бота
+conversation_states = ConversationStateStore()
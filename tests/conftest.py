@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Модуль database, подключенный к пустой базе SQLite во временном каталоге.
+    
+    database_async использует ту же базу через пул потоков.
+    """
+    import database
+    import database_async
+    url = f"sqlite:///{tmp_path / 'bot.db'}"
+    database.dispose_engine()
+    monkeypatch.setattr(database, 'DATABASE_URL', url)
+    monkeypatch.setattr(database_async, 'DATABASE_URL', url)
+    monkeypatch.setattr(database_async, '_async_url_resolved', False)
+    database.init_db()
+    yield database
+    # Изменения из буфера отложенной записи пишутся, пока база еще доступна
+    database.flush_writes()
+    database.dispose_engine()
@@ -0,0 +1,170 @@
+import threading
+
+import pytest
+
+import admission
+from admission import QueueFull, check_queue, TokenBucket, BandwidthLimiter
+
+class FakeClock:
+    """Подмена модуля time в admission: время идет только при sleep"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission, 'time', clock)
+    return clock
+
+def test_check_queue_accepts_while_there_is_room():
+    check_queue(9, 2, 1, max_pending=10, max_pending_per_user=3)
+    check_queue(100, 100, 5, max_pending=0, max_pending_per_user=0)
+
+@pytest.mark.parametrize('pending, user_pending, count, reason', [
+    (10, 0, 1, 'queue'),
+    (8, 0, 3, 'queue'),
+    (0, 3, 1, 'user'),
+    (10, 3, 1, 'queue'),
+])
+def test_check_queue_rejects_when_full(pending, user_pending, count, reason):
+    with pytest.raises(QueueFull) as error:
+        check_queue(pending, user_pending, count, max_pending=10, max_pending_per_user=3)
+    assert error.value.reason == reason
+
+def test_check_queue_sheds_speculative_jobs_at_half_capacity():
+    check_queue(4, 0, 1, max_pending=10, max_pending_per_user=0, speculative=True)
+    with pytest.raises(QueueFull):
+        check_queue(5, 0, 1, max_pending=10, max_pending_per_user=0, speculative=True)
+    check_queue(5, 0, 1, max_pending=10, max_pending_per_user=0)
+
+def test_token_bucket_without_rate_never_waits(clock):
+    bucket = TokenBucket(0)
+
+    assert bucket.consume(10 ** 9) == 0
+    assert clock.slept == []
+
+def test_token_bucket_waits_for_debt(clock):
+    bucket = TokenBucket(100)
+
+    assert bucket.consume(100) == 0
+    assert bucket.consume(50) == pytest.approx(0.5)
+    assert bucket.consume(100) == pytest.approx(1)
+
+def test_token_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(100, burst=150)
+    bucket.consume(150)
+
+    clock.now += 10
+
+    assert bucket.reserve(150) == 0
+    assert bucket.reserve(1) == pytest.approx(0.01)
+
+def test_token_bucket_keeps_debt_when_rate_changes(clock):
+    bucket = TokenBucket(100)
+    bucket.reserve(300)
+
+    # Половина секунды по старой скорости гасит 50 из 200 маркеров долга
+    clock.now += 0.5
+    bucket.set_rate(50)
+
+    assert bucket.reserve(0) == pytest.approx(3)
+    assert bucket.burst == 50
+
+def test_token_bucket_rate_zero_lifts_limit(clock):
+    bucket = TokenBucket(100)
+    bucket.reserve(1000)
+
+    bucket.set_rate(0)
+
+    assert bucket.reserve(1000) == 0
+
+def test_bandwidth_limiter_splits_total_between_workers(clock):
+    limiter = BandwidthLimiter(100, 0)
+
+    limiter.set_shares(4, {})
+
+    assert limiter.total.rate == 25
+    limiter.consume(1, 25)
+    assert limiter.consume(1, 25) == pytest.approx(1)
+
+def test_bandwidth_limiter_without_busy_workers_takes_whole_rate(clock):
+    limiter = BandwidthLimiter(100, 40)
+    limiter.set_shares(4, {1: 2})
+
+    limiter.set_shares(0, {})
+
+    assert limiter.total.rate == 100
+    assert limiter.user_bucket(1).rate == 40
+
+def test_bandwidth_limiter_splits_user_rate_between_workers_with_user_jobs(clock):
+    limiter = BandwidthLimiter(0, 40)
+    existing = limiter.user_bucket(1)
+
+    limiter.set_shares(3, {1: 2, 2: 1})
+
+    assert existing.rate == 20
+    assert limiter.user_bucket(2).rate == 40
+    # Пользователь без задач на других воркерах получает лимит целиком
+    assert limiter.user_bucket(3).rate == 40
+
+def test_bandwidth_limiter_waits_for_slower_bucket(clock):
+    limiter = BandwidthLimiter(1000, 100)
+    limiter.consume(1, 100)
+
+    assert limiter.consume(1, 50) == pytest.approx(0.5)
+    # Другой пользователь упирается только в общий лимит
+    assert limiter.consume(2, 50) == 0
+
+def test_bandwidth_limiter_ignores_user_limit_without_user(clock):
+    limiter = BandwidthLimiter(0, 100)
+
+    assert limiter.consume(None, 10 ** 6) == 0
+
+def enqueue(db, user_id, max_pending, max_pending_per_user):
+    return db.enqueue_job(
+        user_id, user_id, 100, 'https://youtu.be/abc', 'abc', 'Видео', '720',
+        max_pending=max_pending, max_pending_per_user=max_pending_per_user
+    )
+
+def test_enqueue_rejects_job_over_limits(db):
+    enqueue(db, 1, 3, 2)
+    enqueue(db, 1, 3, 2)
+
+    with pytest.raises(QueueFull) as error:
+        enqueue(db, 1, 3, 2)
+    assert error.value.reason == 'user'
+
+    enqueue(db, 2, 3, 2)
+    with pytest.raises(QueueFull) as error:
+        db.enqueue_batch(3, 3, 100, [{'url': 'u', 'video_id': 'v', 'title': 't'}], '720', max_pending=3)
+    assert error.value.reason == 'queue'
+
+def test_concurrent_enqueues_do_not_exceed_queue_limit(db):
+    max_pending = 5
+    start = threading.Barrier(20)
+    accepted = []
+
+    def run(user_id):
+        start.wait()
+        try:
+            accepted.append(enqueue(db, user_id, max_pending, 0))
+        except QueueFull:
+            pass
+
+    threads = [threading.Thread(target=run, args=(user_id,)) for user_id in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(accepted) == max_pending
+    assert db.get_queue_load(0)[0] == max_pending
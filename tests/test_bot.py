@@ -0,0 +1,42 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+class FakeMessage:
+    def __init__(self, text):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+def handle(text, monkeypatch):
+    batches = []
+
+    async def handle_batch(update, context, urls):
+        batches.append(urls)
+
+    monkeypatch.setattr(bot, 'handle_batch', handle_batch)
+    message = FakeMessage(text)
+    update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=1))
+    asyncio.run(bot.handle_youtube_url(update, None))
+    return message.replies, batches
+
+@pytest.mark.parametrize('text', [
+    "https://youtu.be/aaaaaaaaaaa https://youtu.be/bbbbbbbbbbb 1:30-2:00",
+    "https://www.youtube.com/playlist?list=PL0123456789 1:30-2:00",
+])
+def test_batch_with_clip_is_rejected(db, monkeypatch, text):
+    replies, batches = handle(text, monkeypatch)
+
+    assert batches == []
+    assert replies and replies[0].startswith("Фрагменты можно загружать только по одной ссылке")
+
+def test_batch_without_clip_is_queued(db, monkeypatch):
+    replies, batches = handle("https://youtu.be/aaaaaaaaaaa https://youtu.be/bbbbbbbbbbb", monkeypatch)
+
+    assert replies == []
+    assert batches == [["https://youtu.be/aaaaaaaaaaa", "https://youtu.be/bbbbbbbbbbb"]]
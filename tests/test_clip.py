@@ -0,0 +1,152 @@
+import struct
+
+import pytest
+
+import youtube_downloader
+from mp4_index import IndexNotFound, locate_index, parse_sidx, select_segments
+from youtube_downloader import extract_clip, clip_bounds, plan_clip_stream
+
+def box(box_type, payload=b''):
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+def sidx(references, version=0, timescale=1000, earliest=0, first_offset=0):
+    """Бокс sidx; references — список (размер фрагмента, длительность) или (размер, длительность, вложенный)"""
+    payload = struct.pack('>B3xII', version, 1, timescale)
+    if version == 0:
+        payload += struct.pack('>II', earliest, first_offset)
+    else:
+        payload += struct.pack('>QQ', earliest, first_offset)
+    payload += struct.pack('>HH', 0, len(references))
+    for size, duration, *nested in references:
+        payload += struct.pack('>III', size | (0x80000000 if nested else 0), duration, 0x90000000)
+    return box(b'sidx', payload)
+
+INIT = box(b'ftyp', b'dash' + b'\0' * 12) + box(b'moov', b'\0' * 100)
+REFERENCES = [(100, 5000), (200, 5000), (300, 2500)]
+
+def test_parses_sidx_version_0():
+    assert parse_sidx(sidx(REFERENCES), 1000) == [
+        (0, 5, 1000, 1099),
+        (5, 10, 1100, 1299),
+        (10, 12.5, 1300, 1599),
+    ]
+
+def test_parses_sidx_version_1_with_offsets():
+    box = sidx([(100, 900), (200, 900)], version=1, timescale=90, earliest=2 ** 33, first_offset=50)
+
+    segments = parse_sidx(box, 1000)
+
+    assert [segment[2:] for segment in segments] == [(1050, 1149), (1150, 1349)]
+    assert segments[0][0] == pytest.approx(2 ** 33 / 90)
+    assert segments[1][1] - segments[0][0] == pytest.approx(20)
+
+def test_rejects_unsupported_sidx():
+    with pytest.raises(ValueError):
+        parse_sidx(sidx([(100, 5000, 'nested')]), 0)
+    with pytest.raises(ValueError):
+        parse_sidx(sidx(REFERENCES, timescale=0), 0)
+
+def test_locates_index_after_init_segment():
+    head = INIT + sidx(REFERENCES) + box(b'moof')
+
+    start, end = locate_index(head)
+
+    assert (start, end) == (len(INIT), len(INIT) + len(sidx(REFERENCES)))
+
+def test_locates_index_after_large_box():
+    large = struct.pack('>I4sQ', 1, b'moov', 16 + 10) + b'\0' * 10
+    head = box(b'ftyp', b'dash') + large + sidx(REFERENCES)
+
+    assert locate_index(head)[0] == len(head) - len(sidx(REFERENCES))
+
+def test_asks_for_more_data_when_index_is_not_reached():
+    head = INIT + sidx(REFERENCES)
+
+    assert locate_index(head[:20]) == (None, len(box(b'ftyp', b'dash' + b'\0' * 12)) + 16)
+
+@pytest.mark.parametrize('head', [
+    INIT + box(b'moof') + sidx(REFERENCES),
+    b'\x1aE\xdf\xa3' + b'\0' * 60,
+])
+def test_stream_without_index(head):
+    with pytest.raises(IndexNotFound):
+        locate_index(head)
+
+SEGMENTS = parse_sidx(sidx(REFERENCES), 1000)
+
+@pytest.mark.parametrize('start, end, expected', [
+    # Внутри одного фрагмента
+    (1, 4, (0, 1000, 1099)),
+    (6, 7, (5, 1100, 1299)),
+    # Отрезок пересекает границу фрагментов
+    (4, 6, (0, 1000, 1299)),
+    (2, 11, (0, 1000, 1599)),
+    # Начало ровно на границе: предыдущий фрагмент не нужен
+    (5, 7, (5, 1100, 1299)),
+    # Конец за пределами индекса
+    (11, 100, (10, 1300, 1599)),
+])
+def test_selects_segments_covering_range(start, end, expected):
+    assert select_segments(SEGMENTS, start, end) == expected
+
+def test_rejects_range_past_index():
+    with pytest.raises(ValueError):
+        select_segments(SEGMENTS, 13, 20)
+
+@pytest.mark.parametrize('text, clip', [
+    ("https://youtu.be/abc 1:30-2:00", "90-120"),
+    ("90-120 https://youtu.be/abc", "90-120"),
+    ("https://youtu.be/abc 1:00:00-1:00:30", "3600-3630"),
+    ("https://youtu.be/abc 0:05-1:00:00", "5-3600"),
+])
+def test_extracts_clip(text, clip):
+    assert extract_clip(text) == clip
+    assert clip_bounds(clip) == tuple(int(value) for value in clip.split('-'))
+
+@pytest.mark.parametrize('text', [
+    "https://youtu.be/abc",
+    "https://youtu.be/abc 2:00-1:30",
+    "https://youtu.be/abc 90-90",
+    "https://youtu.be/abc 1:75-2:00",
+    "https://youtu.be/abc 1:30-2:00:",
+    "https://youtu.be/abc -1:30",
+    "https://youtu.be/abc 1.5-2",
+])
+def test_ignores_invalid_or_reversed_clip(text):
+    assert extract_clip(text) is None
+
+@pytest.mark.parametrize('known_index', [False, True])
+def test_plans_download_of_covering_fragments(monkeypatch, known_index):
+    index = sidx(REFERENCES)
+    anchor = len(INIT) + len(index)
+    data = INIT + index + bytes(600)
+    requests = []
+
+    def fetch_bytes(url, start, end):
+        requests.append((start, end))
+        return data[start:end + 1]
+
+    monkeypatch.setattr(youtube_downloader, 'fetch_bytes', fetch_bytes)
+    stream = {
+        'url': 'https://example.com/video', 'itag': 137, 'filesize': len(data),
+        # Положение индекса из манифеста: читается ровно начало потока до конца sidx
+        'index_range': (len(INIT), anchor - 1) if known_index else None
+    }
+
+    plan = plan_clip_stream(stream, 7, 11)
+
+    assert plan['init'] == INIT
+    assert plan['range'] == (anchor + 100, anchor + 599)
+    assert plan['offset'] == 2
+    assert plan['size'] == len(INIT) + 500
+    if known_index:
+        assert requests == [(0, anchor - 1)]
+
+def test_plans_whole_stream_without_index(monkeypatch):
+    data = b'\x1aE\xdf\xa3' + bytes(1000)
+    monkeypatch.setattr(youtube_downloader, 'fetch_bytes', lambda url, start, end: data[start:end + 1])
+    stream = {'url': 'https://example.com/video', 'itag': 248, 'filesize': len(data), 'index_range': None}
+
+    plan = plan_clip_stream(stream, 7, 11)
+
+    assert plan == {'init': None, 'range': None, 'offset': 7, 'size': len(data)}
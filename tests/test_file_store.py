@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import subprocess
+
+import pytest
+
+from file_store import LocalFileStore, main_path
+
+def create(path, size, age=0):
+    """Файл размера size, последний раз использованный age секунд назад"""
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    used_at = time.time() - age
+    os.utime(path, (used_at, used_at))
+    return str(path)
+
+@pytest.fixture
+def store(tmp_path):
+    downloads, temp = tmp_path / 'downloads', tmp_path / 'temp'
+    store = LocalFileStore([str(downloads), str(temp)], quota_bytes=10000, ttl=3600)
+    store.prepare()
+    return store
+
+def test_main_path_strips_side_suffixes():
+    assert main_path('/d/video.mp4.media.progress.tmp') == '/d/video.mp4'
+    assert main_path('/d/video.mp4.progress') == '/d/video.mp4'
+    assert main_path('/d/video.mp4.tmp') == '/d/video.mp4'
+    assert main_path('/d/video.mp4') == '/d/video.mp4'
+
+def test_is_complete_ignores_files_with_side_files(store, tmp_path):
+    path = create(tmp_path / 'downloads' / 'video.mp4', 100)
+    assert store.is_complete(path)
+
+    for suffix in ('.tmp', '.progress', '.media', '.media.progress'):
+        side = create(path + suffix, 10)
+        assert not store.is_complete(path)
+        os.remove(side)
+
+    assert store.is_complete(path)
+    assert not store.is_complete(str(tmp_path / 'downloads' / 'missing.mp4'))
+
+def test_used_file_is_not_evicted(store, tmp_path):
+    store.quota_bytes = 0
+    path = create(tmp_path / 'downloads' / 'video.mp4', 100, age=7200)
+
+    with store.use(path):
+        stats = store.evict()
+        assert os.path.exists(path)
+        assert stats['evictions'] == 0
+        assert stats['usage_bytes'] == 100
+
+    store.evict()
+    assert not os.path.exists(path)
+    assert not os.path.exists(store.lock_path(path))
+
+def test_file_used_by_other_process_is_not_evicted(store, tmp_path):
+    store.quota_bytes = 0
+    path = create(tmp_path / 'downloads' / 'video.mp4', 100)
+    script = (
+        "import sys\n"
+        "from file_store import LocalFileStore\n"
+        "with LocalFileStore([], 0, 0).use(sys.argv[1]):\n"
+        "    print('ready', flush=True)\n"
+        "    sys.stdin.readline()\n"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    holder = subprocess.Popen(
+        [sys.executable, '-c', script, path], cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+    )
+    try:
+        assert holder.stdout.readline().strip() == 'ready'
+        store.evict()
+        assert os.path.exists(path)
+    finally:
+        holder.communicate('\n')
+
+    store.evict()
+    assert not os.path.exists(path)
+
+def test_shared_uses_do_not_block_each_other(store, tmp_path):
+    path = create(tmp_path / 'downloads' / 'video.mp4', 100)
+
+    with store.use(path), store.use(path):
+        assert os.path.exists(store.lock_path(path))
+
+def test_expired_files_are_evicted_with_side_files(store, tmp_path):
+    old = create(tmp_path / 'temp' / 'old.mp4', 100, age=7200)
+    old_progress = create(old + '.progress', 10, age=7200)
+    fresh = create(tmp_path / 'downloads' / 'fresh.mp4', 100, age=60)
+
+    stats = store.evict()
+
+    assert not os.path.exists(old)
+    assert not os.path.exists(old_progress)
+    assert os.path.exists(fresh)
+    assert stats == {'usage_bytes': 100, 'files': 1, 'quota_bytes': 10000, 'evictions': 1, 'evicted_bytes': 110}
+
+def test_least_recently_used_files_are_evicted_down_to_quota(store, tmp_path):
+    store.quota_bytes = 4000
+    oldest = create(tmp_path / 'downloads' / 'a.mp4', 3000, age=300)
+    older = create(tmp_path / 'temp' / 'b.mp4', 2000, age=200)
+    newer = create(tmp_path / 'downloads' / 'c.mp4', 2000, age=100)
+    newest = create(tmp_path / 'downloads' / 'd.mp4', 1000, age=0)
+
+    stats = store.evict()
+
+    assert not os.path.exists(oldest)
+    assert not os.path.exists(older)
+    assert os.path.exists(newer) and os.path.exists(newest)
+    assert stats['usage_bytes'] == 3000
+    assert stats['files'] == 2
+    assert (stats['evictions'], stats['evicted_bytes']) == (2, 5000)
+
+def test_used_file_over_quota_is_skipped(store, tmp_path):
+    store.quota_bytes = 2000
+    busy = create(tmp_path / 'downloads' / 'busy.mp4', 2000, age=300)
+    idle = create(tmp_path / 'downloads' / 'idle.mp4', 1000, age=200)
+
+    with store.use(busy):
+        stats = store.evict()
+
+    assert os.path.exists(busy)
+    assert not os.path.exists(idle)
+    assert stats['usage_bytes'] == 2000
+
+def test_eviction_counts_accumulate(store, tmp_path):
+    store.ttl = 100
+    create(tmp_path / 'downloads' / 'a.mp4', 100, age=200)
+    store.evict()
+    create(tmp_path / 'downloads' / 'b.mp4', 200, age=200)
+
+    stats = store.evict()
+
+    assert (stats['evictions'], stats['evicted_bytes']) == (2, 300)
+    assert stats['usage_bytes'] == 0
+    assert store.stats() == stats
+
+def test_use_of_removed_temp_file_removes_lock(store, tmp_path):
+    path = create(tmp_path / 'temp' / 'video_0.webm', 100)
+
+    with store.use(path):
+        os.remove(path)
+
+    assert not os.path.exists(store.lock_path(path))
@@ -0,0 +1,44 @@
+from bot import format_queued
+
+def enqueue(db, user_id=1, quality='720', speculative=False):
+    return db.enqueue_job(
+        user_id, user_id, 100, 'https://youtu.be/abc', 'abc', 'Видео', quality, speculative=speculative
+    )
+
+def claim(db):
+    return db.claim_job('worker-1', max_running=10, max_running_per_user=10, max_speculative_running=10)
+
+def test_promoted_prefetch_is_queued_as_first_attempt(db):
+    job_id = enqueue(db, speculative=True)
+    assert claim(db)['id'] == job_id
+    assert db.finish_prefetch(job_id, 1000)
+
+    assert db.promote_speculative_job(job_id)
+
+    [job] = db.get_queue_positions()
+    assert job['id'] == job_id
+    assert job['attempts'] == 0
+    assert format_queued(job).startswith("Задача на загрузку видео в качестве 720p поставлена в очередь")
+
+def test_promoted_prefetch_is_retried_after_error(db):
+    job_id = enqueue(db, speculative=True)
+    claim(db)
+    db.finish_prefetch(job_id, 1000)
+    db.promote_speculative_job(job_id)
+
+    assert claim(db)['attempts'] == 1
+    db.fail_job(job_id, 'ошибка', max_attempts=2)
+
+    assert db.get_job_state(job_id)[0] == 'pending'
+    [job] = db.get_queue_positions()
+    assert format_queued(job).startswith("Повторяю загрузку после ошибки")
+
+def test_promoted_running_prefetch_keeps_its_attempt(db):
+    job_id = enqueue(db, speculative=True)
+    claim(db)
+
+    assert db.promote_speculative_job(job_id)
+
+    assert db.get_job_state(job_id) == ('running', True)
+    db.fail_job(job_id, 'ошибка', max_attempts=1)
+    assert db.get_job_state(job_id)[0] == 'failed'
@@ -0,0 +1,178 @@
+import asyncio
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+import message_updater
+from message_updater import MessageUpdater
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+class FakeBot:
+    """Бот, запоминающий изменения сообщений; errors — исключения для следующих вызовов"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.edits = []
+        self.errors = []
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.edits.append((self.clock.now, message_id, text))
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(message_updater, 'time', clock)
+    return clock
+
+@pytest.fixture
+def bot(clock):
+    return FakeBot(clock)
+
+def flush(updater):
+    return asyncio.run(updater.flush())
+
+def test_coalesces_progress_texts(clock, bot):
+    updater = MessageUpdater(bot, min_interval=3, rate=20)
+    for percent in (10, 20, 30):
+        updater.submit(1, 100, f"{percent}%")
+
+    assert flush(updater) is None
+    assert bot.edits == [(1000.0, 100, "30%")]
+
+def test_waits_interval_between_edits_of_one_message(clock, bot):
+    updater = MessageUpdater(bot, min_interval=3, rate=20)
+    updater.submit(1, 100, "10%")
+    flush(updater)
+
+    clock.now += 1
+    updater.submit(1, 100, "20%")
+    updater.submit(1, 200, "другое сообщение")
+    delay = flush(updater)
+
+    assert [text for _, _, text in bot.edits] == ["10%", "другое сообщение"]
+    assert delay == pytest.approx(2)
+
+    clock.now += 2
+    flush(updater)
+    assert bot.edits[-1] == (1003.0, 100, "20%")
+
+def test_final_text_is_sent_at_once_and_not_replaced(clock, bot):
+    updater = MessageUpdater(bot, min_interval=3, rate=20)
+    updater.submit(1, 100, "10%")
+    flush(updater)
+
+    clock.now += 0.5
+    updater.submit(1, 100, "20%")
+    updater.submit(1, 100, "Готово", final=True)
+    updater.submit(1, 100, "30%")
+    flush(updater)
+
+    assert bot.edits == [(1000.0, 100, "10%"), (1000.5, 100, "Готово")]
+    assert updater.pending == {}
+
+def test_skips_text_equal_to_sent(clock, bot):
+    updater = MessageUpdater(bot, min_interval=3, rate=20)
+    updater.submit(1, 100, "10%")
+    flush(updater)
+
+    clock.now += 10
+    updater.submit(1, 100, "20%")
+    updater.submit(1, 100, "10%")
+
+    assert flush(updater) is None
+    assert len(bot.edits) == 1
+
+def test_limits_edits_per_second(clock, bot):
+    updater = MessageUpdater(bot, min_interval=3, rate=2)
+    for message_id in range(5):
+        updater.submit(1, message_id, "0%")
+
+    delay = flush(updater)
+
+    assert len(bot.edits) == 2
+    assert delay == pytest.approx(0.5)
+
+    clock.now += 1
+    flush(updater)
+    assert len(bot.edits) == 4
+
+def test_retry_after_pauses_all_edits(clock, bot):
+    updater = MessageUpdater(bot, min_interval=3, rate=20)
+    bot.errors.append(RetryAfter(5))
+    updater.submit(1, 100, "Готово", final=True)
+    flush(updater)
+
+    assert bot.edits == []
+    clock.now += 1
+    updater.submit(1, 200, "10%")
+    assert flush(updater) == pytest.approx(4)
+    assert bot.edits == []
+
+    clock.now += 4
+    flush(updater)
+    assert sorted(text for _, _, text in bot.edits) == ["10%", "Готово"]
+
+def test_retry_after_keeps_newer_text(clock, bot):
+    updater = MessageUpdater(bot, min_interval=0, rate=20)
+    bot.errors.append(RetryAfter(1))
+    updater.submit(1, 100, "10%")
+
+    async def run():
+        # Пока изменение ждет ответа, приходит более новый текст
+        original = bot.edit_message_text
+
+        async def edit(*args, **kwargs):
+            updater.submit(1, 100, "20%")
+            return await original(*args, **kwargs)
+
+        bot.edit_message_text = edit
+        await updater.flush()
+        bot.edit_message_text = original
+
+    asyncio.run(run())
+    clock.now += 1
+    flush(updater)
+
+    assert [text for _, _, text in bot.edits] == ["20%"]
+
+def test_not_modified_is_not_an_error(clock, bot):
+    updater = MessageUpdater(bot, min_interval=3, rate=20)
+    bot.errors.append(BadRequest("Message is not modified"))
+    updater.submit(1, 100, "10%")
+
+    assert flush(updater) is None
+    assert updater.sent[(1, 100)][0] == "10%"
+
+def test_drain_sends_only_final_texts(clock, bot):
+    updater = MessageUpdater(bot, min_interval=3, rate=20)
+    updater.submit(1, 100, "10%")
+    updater.submit(1, 200, "Готово", final=True)
+
+    assert asyncio.run(updater.drain(1)) == 0
+    assert bot.edits == [(1000.0, 200, "Готово")]
+
+def test_run_loop_sends_submitted_texts():
+    # Настоящее время: цикл отправки просыпается при постановке нового текста
+    async def run():
+        bot = FakeBot(FakeClock())
+        updater = MessageUpdater(bot, min_interval=0.2, rate=20)
+        task = asyncio.create_task(updater.run())
+        try:
+            updater.submit(1, 100, "10%")
+            await asyncio.sleep(0.05)
+            updater.submit(1, 100, "20%")
+            updater.submit(1, 100, "30%")
+            await asyncio.sleep(0.4)
+        finally:
+            task.cancel()
+        return [text for _, _, text in bot.edits]
+
+    assert asyncio.run(run()) == ["10%", "30%"]
@@ -0,0 +1,243 @@
+import os
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from ranged_downloader import download_ranges, progress_path
+
+DATA = os.urandom(1000 * 1024 + 123)
+PART_SIZE = 64 * 1024
+
+class FileServer(ThreadingHTTPServer):
+    """Локальный HTTP-сервер с одним файлом DATA.
+
+    ranges — отвечать ли на Range-запросы 206 (иначе всегда 200 с полным
+    телом), fail_starts — начала диапазонов, на которые один раз
+    возвращается 500, cut_starts — на которые один раз отдается половина
+    тела и соединение закрывается, full_starts — на которые отвечается 200
+    с полным телом. Заголовки Range всех запросов сохраняются в requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FileHandler)
+        self.ranges = True
+        self.fail_starts = set()
+        self.cut_starts = set()
+        self.full_starts = set()
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Клиент закрывает соединение, не дочитав тело ответа 200
+        pass
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/video?id=1"
+
+class FileHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        header = self.headers.get('Range')
+        with server.lock:
+            server.requests.append(header)
+
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', '/video?id=1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if not header or not server.ranges:
+            self.reply(200, DATA)
+            return
+
+        start, end = (int(value) for value in header.split('=')[1].split('-'))
+        with server.lock:
+            failed = start in server.fail_starts
+            server.fail_starts.discard(start)
+            cut = start in server.cut_starts
+            server.cut_starts.discard(start)
+        if failed:
+            self.reply(500, b'error')
+            return
+        if start in server.full_starts:
+            self.reply(200, DATA)
+            return
+
+        body = DATA[start:end + 1]
+        if cut:
+            self.close_connection = True
+        self.reply(206, body, {'Content-Range': f'bytes {start}-{end}/{len(DATA)}'}, sent=len(body) // 2 if cut else None)
+
+    def reply(self, status, body, headers=None, sent=None):
+        """Ответ с телом body; sent — сколько байт тела отправить на самом деле"""
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body[:sent])
+        except OSError:
+            # Клиент закрыл соединение, не дочитав тело
+            pass
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+class Received:
+    """on_bytes, запоминающий полученные и возобновленные байты"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = 0
+        self.resumed = 0
+
+    def __call__(self, count, resumed=False):
+        with self.lock:
+            if resumed:
+                self.resumed += count
+            else:
+                self.received += count
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def test_downloads_parts_over_several_connections(server, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    received = []
+
+    download_ranges(server.url, path, len(DATA), connections=4, part_size=PART_SIZE, on_bytes=received.append)
+
+    assert read(path) == DATA
+    assert sum(received) == len(DATA)
+    assert len(server.requests) == -(-len(DATA) // PART_SIZE)
+    assert not os.path.exists(progress_path(path))
+
+def test_downloads_slice_with_remote_offset(server, tmp_path):
+    path = str(tmp_path / 'clip.media')
+
+    download_ranges(server.url, path, 300 * 1024, connections=2, part_size=PART_SIZE, remote_offset=5000)
+
+    assert read(path) == DATA[5000:5000 + 300 * 1024]
+
+def test_follows_redirects(server, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+
+    download_ranges(server.url.replace('/video', '/redirect'), path, len(DATA), connections=2, part_size=PART_SIZE)
+
+    assert read(path) == DATA
+
+def test_resumes_from_progress_file(server, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    failed_part = 3
+    server.fail_starts.add(failed_part * PART_SIZE)
+
+    with pytest.raises(IOError):
+        download_ranges(server.url, path, len(DATA), connections=1, part_size=PART_SIZE, retries=0)
+
+    # Недокачанный файл уже нужного размера, но прогресс показывает, чего не хватает
+    assert os.path.getsize(path) == len(DATA)
+    with open(progress_path(path)) as f:
+        progress = json.load(f)
+    assert progress['size'] == len(DATA)
+    assert failed_part not in progress['done']
+
+    server.requests.clear()
+    received = Received()
+    download_ranges(server.url, path, len(DATA), connections=2, part_size=PART_SIZE, retries=0, on_bytes=received)
+
+    assert read(path) == DATA
+    # Части, загруженные до сбоя, сообщаются сразу и не передаются заново
+    assert received.resumed == len(progress['done']) * PART_SIZE
+    assert received.resumed + received.received == len(DATA)
+    assert not os.path.exists(progress_path(path))
+    # Повторно загружаются только недостающие части
+    part_count = -(-len(DATA) // PART_SIZE)
+    assert len(server.requests) == part_count - len(progress['done'])
+
+def test_retries_failed_part(server, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    server.fail_starts.add(2 * PART_SIZE)
+    received = []
+
+    download_ranges(server.url, path, len(DATA), connections=3, part_size=PART_SIZE, retries=1, on_bytes=received.append)
+
+    assert read(path) == DATA
+    assert sum(received) == len(DATA)
+
+def test_retried_part_is_not_counted_twice(server, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    server.cut_starts.update({0, 2 * PART_SIZE})
+    received = Received()
+
+    download_ranges(server.url, path, len(DATA), connections=3, part_size=PART_SIZE, retries=1, on_bytes=received)
+
+    assert read(path) == DATA
+    assert received.received == len(DATA)
+    assert received.resumed == 0
+
+def test_progress_for_other_size_starts_over(server, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    with open(path, 'wb') as f:
+        f.write(b'x' * len(DATA))
+    with open(progress_path(path), 'w') as f:
+        json.dump({'size': len(DATA) + 1, 'part_size': PART_SIZE, 'done': [0, 1, 2]}, f)
+
+    download_ranges(server.url, path, len(DATA), connections=4, part_size=PART_SIZE)
+
+    assert read(path) == DATA
+
+def test_complete_file_without_progress_is_not_downloaded(server, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    with open(path, 'wb') as f:
+        f.write(DATA)
+
+    download_ranges(server.url, path, len(DATA), part_size=PART_SIZE)
+
+    assert server.requests == []
+
+@pytest.mark.parametrize('remote_offset, size', [(0, len(DATA)), (7000, 200 * 1024)])
+def test_falls_back_to_single_request_without_range_support(server, tmp_path, remote_offset, size):
+    server.ranges = False
+    path = str(tmp_path / 'video.mp4')
+    received = []
+
+    download_ranges(
+        server.url, path, size, connections=4, part_size=PART_SIZE, on_bytes=received.append, remote_offset=remote_offset
+    )
+
+    assert read(path) == DATA[remote_offset:remote_offset + size]
+    assert sum(received) == size
+    assert None in server.requests
+    assert not os.path.exists(progress_path(path))
+
+def test_fallback_after_counted_parts_is_not_counted_twice(server, tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    # Сервер перестает поддерживать Range-запросы, когда часть файла уже получена
+    server.full_starts.add(6 * PART_SIZE)
+    server.cut_starts.add(5 * PART_SIZE)
+    received = Received()
+
+    download_ranges(server.url, path, len(DATA), connections=1, part_size=PART_SIZE, retries=1, on_bytes=received)
+
+    assert read(path) == DATA
+    assert received.received == len(DATA)
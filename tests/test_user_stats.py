@@ -0,0 +1,46 @@
+def stats(db):
+    result = db.get_stats()
+    return result['total_users'], result['active_users_today'], result['ranges']['today']['new_users']
+
+def test_start_registers_user_and_counts_activity(db):
+    assert db.register_user(1, 'user', 'Имя')
+
+    assert stats(db) == (1, 1, 1)
+
+def test_repeated_start_updates_user_without_counting_again(db):
+    db.register_user(1, 'user', 'Имя')
+
+    assert not db.register_user(1, 'renamed', 'Другое имя')
+
+    assert stats(db) == (1, 1, 1)
+    [user] = db.get_stats()['top_users']
+    assert (user['username'], user['first_name']) == ('renamed', 'Другое имя')
+
+def test_start_after_buffered_activity_is_not_counted_twice(db):
+    db.update_user_activity(1)
+    db.flush_writes()
+    assert stats(db) == (1, 1, 1)
+
+    assert not db.register_user(1, 'user', 'Имя')
+
+    assert stats(db) == (1, 1, 1)
+
+def test_buffered_activity_after_start_is_not_counted_twice(db):
+    db.increment_download_count(1)
+    db.register_user(1, 'user', 'Имя')
+
+    db.flush_writes()
+
+    assert stats(db) == (1, 1, 1)
+    [user] = db.get_stats()['top_users']
+    assert user['total_downloads'] == 1
+
+def test_buffered_activity_counts_new_and_active_users(db):
+    db.register_user(1, 'user', 'Имя')
+    db.update_user_activity(1)
+    db.update_user_activity(2)
+    db.increment_download_count(3)
+
+    db.flush_writes()
+
+    assert stats(db) == (3, 3, 3)
@@ -0,0 +1,180 @@
+import json
+import asyncio
+
+import pytest
+
+from webhook import IntakeQueue, UpdateDeduplicator, WebhookServer, MAX_HEADERS
+
+class FakeDeduplicator:
+    """Отсев повторов в памяти; fail — исключение при проверке (ошибка базы)"""
+
+    ttl = 3600
+
+    def __init__(self, fail=False):
+        self.seen = set()
+        self.fail = fail
+
+    async def accept(self, update_id):
+        if self.fail:
+            raise RuntimeError('база недоступна')
+        if update_id in self.seen:
+            return False
+        self.seen.add(update_id)
+        return True
+
+    async def forget(self, update_id):
+        self.seen.discard(update_id)
+
+    async def cleanup(self):
+        return 0
+
+def request(body=b'', path='/telegram', headers=()):
+    lines = [f"POST {path} HTTP/1.1", f"Content-Length: {len(body)}", *headers]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+def update(update_id):
+    return json.dumps({'update_id': update_id}).encode()
+
+async def read_all(reader):
+    data = b''
+    try:
+        while chunk := await reader.read(65536):
+            data += chunk
+    except ConnectionError:
+        pass
+    return data
+
+async def exchange(data, deduplicator=None, queue_size=10, read_timeout=5, idle_timeout=5, pause=0):
+    """Отправка data серверу; возвращает все полученные байты до закрытия соединения и очередь обновлений"""
+    queue = IntakeQueue(queue_size)
+    server = WebhookServer(
+        None, queue, deduplicator or FakeDeduplicator(), 'telegram',
+        read_timeout=read_timeout, idle_timeout=idle_timeout
+    )
+    await server.start('127.0.0.1', 0)
+    try:
+        port = server.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        # Ответ читается одновременно с отправкой: сервер может ответить и
+        # закрыть соединение, не дождавшись конца запроса
+        reading = asyncio.create_task(read_all(reader))
+        for chunk in data:
+            try:
+                writer.write(chunk)
+                await writer.drain()
+            except ConnectionError:
+                break
+            await asyncio.sleep(pause)
+        response = await asyncio.wait_for(reading, 10)
+        writer.close()
+        return response.decode(), queue
+    finally:
+        await server.stop()
+
+def statuses(response):
+    return [int(line.split(' ')[1]) for line in response.split('\r\n') if line.startswith('HTTP/1.1')]
+
+def test_accepts_updates_over_keep_alive_connection():
+    response, queue = asyncio.run(exchange([
+        request(update(1)), request(update(1)), request(update(2), headers=['Connection: close'])
+    ]))
+
+    assert statuses(response) == [200, 200, 200]
+    assert [queue.get_nowait().update_id for _ in range(queue.qsize())] == [1, 2]
+
+def test_rejects_updates_when_queue_is_full():
+    response, queue = asyncio.run(exchange([
+        request(update(1)), request(update(2), headers=['Connection: close'])
+    ], queue_size=1))
+
+    assert statuses(response) == [200, 503]
+    assert queue.qsize() == 1
+
+def test_answers_invalid_requests():
+    response, _ = asyncio.run(exchange([
+        request(b'not json'),
+        request(update(1), path='/other'),
+        b"GET /healthz HTTP/1.1\r\n\r\n",
+        b"GET /telegram HTTP/1.1\r\nConnection: close\r\n\r\n",
+    ]))
+
+    assert statuses(response) == [400, 404, 200, 405]
+
+def test_closes_idle_connection():
+    response, _ = asyncio.run(exchange([], idle_timeout=0.2))
+
+    assert response == ''
+
+def test_times_out_slow_headers():
+    # Заголовки приходят по одному, но все вместе дольше read_timeout
+    chunks = [b"POST /telegram HTTP/1.1\r\n"] + [f"X-Header-{i}: 1\r\n".encode() for i in range(10)]
+    response, _ = asyncio.run(exchange(chunks, read_timeout=0.3, pause=0.1))
+
+    assert statuses(response) == [408]
+
+def test_times_out_incomplete_body():
+    data = b"POST /telegram HTTP/1.1\r\nContent-Length: 100\r\n\r\n{"
+    response, _ = asyncio.run(exchange([data], read_timeout=0.2))
+
+    assert statuses(response) == [408]
+
+def test_rejects_too_many_headers():
+    headers = [f"X-Header-{i}: 1" for i in range(MAX_HEADERS + 1)]
+    response, _ = asyncio.run(exchange([request(update(1), headers=headers)]))
+
+    assert statuses(response) == [431]
+
+def test_rejects_too_large_headers():
+    response, _ = asyncio.run(exchange([request(update(1), headers=['X-Large: ' + 'a' * 20000])]))
+
+    assert statuses(response) == [431]
+
+def test_rejects_too_large_body():
+    response, _ = asyncio.run(exchange([b"POST /telegram HTTP/1.1\r\nContent-Length: 10000000\r\n\r\n"]))
+
+    assert statuses(response) == [413]
+
+def test_answers_500_when_request_handling_fails():
+    response, queue = asyncio.run(exchange([
+        request(update(1)), request(update(2), headers=['Connection: close'])
+    ], deduplicator=FakeDeduplicator(fail=True)))
+
+    assert statuses(response) == [500, 500]
+    assert queue.qsize() == 0
+
+def test_intake_queue_tracks_items():
+    async def run():
+        queue = IntakeQueue(2)
+        first, second = object(), object()
+        queue.put_nowait(first)
+        queue.put_nowait(second)
+        with pytest.raises(asyncio.QueueFull):
+            queue.put_nowait(object())
+
+        assert await queue.get() is first
+        assert queue.get_nowait() is second
+        assert queue.enqueued_at == {}
+
+    asyncio.run(run())
+
+def test_deduplicator_rejects_repeated_updates(db):
+    async def run():
+        deduplicator = UpdateDeduplicator(ttl=3600)
+        assert await deduplicator.accept(1)
+        assert not await deduplicator.accept(1)
+
+        # Другой экземпляр бота узнает о повторе из базы
+        assert not await UpdateDeduplicator(ttl=3600).accept(1)
+
+        await deduplicator.forget(1)
+        assert await UpdateDeduplicator(ttl=3600).accept(1)
+
+    asyncio.run(run())
+
+def test_deduplicator_cleanup_removes_old_marks(db):
+    async def run():
+        assert await UpdateDeduplicator(ttl=3600).accept(1)
+        assert await UpdateDeduplicator(ttl=0).cleanup() == 1
+        assert await UpdateDeduplicator(ttl=3600).accept(1)
+
+    asyncio.run(run())
@@ -0,0 +1,265 @@
+import hmac
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from telegram import Update
+from config import UPDATE_DEDUP_TTL, WEBHOOK_READ_TIMEOUT, WEBHOOK_IDLE_TIMEOUT
+from database_async import register_update, forget_update, delete_processed_updates
+from ttl_cache import TTLCache
+from metrics import stage_seconds, updates_total, intake_queue_depth
+
+logger = logging.getLogger(__name__)
+
+# Наибольший размер тела запроса с обновлением
+MAX_BODY_SIZE = 1024 * 1024
+
+# Наибольшее число и общий размер заголовков запроса
+MAX_HEADERS = 100
+MAX_HEADERS_SIZE = 16 * 1024
+
+# Недавно принятые обновления в памяти процесса (до проверки в базе)
+RECENT_UPDATES_SIZE = 10000
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable'
+}
+
+class RequestError(Exception):
+    """Запрос не может быть прочитан; соединение закрывается после ответа status"""
+
+    def __init__(self, status):
+        super().__init__(REASONS[status])
+        self.status = status
+
+class IntakeQueue(asyncio.Queue):
+    """Ограниченная очередь входящих обновлений.
+
+    Используется как update_queue приложения: время от постановки
+    обновления в очередь до начала его обработки попадает в метрику
+    stage_seconds (этап intake), глубина очереди — в intake_queue_depth.
+    """
+
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.enqueued_at = {}
+        intake_queue_depth.set_function(self.qsize)
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        self.enqueued_at[id(item)] = time.monotonic()
+
+    def get_nowait(self):
+        item = super().get_nowait()
+        enqueued_at = self.enqueued_at.pop(id(item), None)
+        if enqueued_at is not None:
+            stage_seconds.observe(time.monotonic() - enqueued_at, stage='intake')
+        return item
+
+class UpdateDeduplicator:
+    """Отсев повторно доставленных обновлений по update_id.
+
+    Недавние обновления проверяются в памяти, остальные — в базе, поэтому
+    повтор отсеивается, даже если Telegram доставил его другому экземпляру
+    бота. Отметки хранятся ttl секунд.
+    """
+
+    def __init__(self, ttl=UPDATE_DEDUP_TTL):
+        self.ttl = ttl
+        self.recent = TTLCache(RECENT_UPDATES_SIZE, ttl)
+
+    async def accept(self, update_id):
+        """True, если обновление получено впервые"""
+        if self.recent.get(update_id):
+            return False
+        if not await register_update(update_id):
+            self.recent.set(update_id, True)
+            return False
+        self.recent.set(update_id, True)
+        return True
+
+    async def forget(self, update_id):
+        self.recent.pop(update_id)
+        await forget_update(update_id)
+
+    async def cleanup(self):
+        return await delete_processed_updates(datetime.now() - timedelta(seconds=self.ttl))
+
+class WebhookServer:
+    """HTTP-сервер для приема обновлений Telegram через webhook.
+
+    Каждое обновление проверяется по секретному токену, отсеивается при
+    повторной доставке и кладется в ограниченную очередь update_queue,
+    из которой его берет приложение. Если очередь заполнена, Telegram
+    получает 503 и повторит доставку позже, поэтому при перегрузке
+    обновления не копятся в памяти. Обработка не зависит от экземпляра,
+    принявшего обновление, и несколько экземпляров можно поставить за
+    балансировщик нагрузки.
+
+    Медленные и молчащие клиенты не занимают соединения бесконечно:
+    заголовки и тело запроса должны прийти за read_timeout секунд, а
+    постоянное соединение без запросов закрывается через idle_timeout секунд.
+    """
+
+    def __init__(self, bot, update_queue, deduplicator, path, secret_token='',
+                 read_timeout=WEBHOOK_READ_TIMEOUT, idle_timeout=WEBHOOK_IDLE_TIMEOUT):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.deduplicator = deduplicator
+        self.path = '/' + path.strip('/')
+        self.secret_token = secret_token
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.server = None
+        self.cleanup_task = None
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        self.cleanup_task = asyncio.create_task(self.cleanup())
+        logger.info(f"Webhook принимает обновления на {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self.cleanup_task:
+            self.cleanup_task.cancel()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def cleanup(self):
+        """Периодическое удаление устаревших отметок об обновлениях"""
+        while True:
+            await asyncio.sleep(self.deduplicator.ttl / 24)
+            try:
+                await self.deduplicator.cleanup()
+            except Exception as e:
+                logger.error(f"Ошибка при удалении отметок об обновлениях: {e}")
+
+    async def handle_connection(self, reader, writer):
+        """Соединение HTTP/1.1; Telegram отправляет запросы по постоянным соединениям"""
+        try:
+            while True:
+                # Простаивающее постоянное соединение закрывается без ответа
+                request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                if not request_line:
+                    break
+
+                try:
+                    method, target, headers, body = await asyncio.wait_for(
+                        self.read_request(reader, request_line), self.read_timeout
+                    )
+                except asyncio.TimeoutError:
+                    await self.respond(writer, 408, keep_alive=False)
+                    break
+                except RequestError as e:
+                    await self.respond(writer, e.status, keep_alive=False)
+                    break
+
+                try:
+                    status = await self.handle_request(method, target.split('?')[0], headers, body)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке запроса webhook: {e}", exc_info=True)
+                    status = 500
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self.respond(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader, request_line):
+        """Разбор запроса после строки запроса: (method, target, headers, body)"""
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise RequestError(400)
+
+        headers = {}
+        count = size = 0
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # Строка длиннее буфера потока
+                raise RequestError(431)
+            if line in (b'\r\n', b'\n', b''):
+                break
+
+            count += 1
+            size += len(line)
+            if count > MAX_HEADERS or size > MAX_HEADERS_SIZE:
+                raise RequestError(431)
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise RequestError(400)
+        if length < 0:
+            raise RequestError(400)
+        if length > MAX_BODY_SIZE:
+            raise RequestError(413)
+
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body
+
+    async def respond(self, writer, status, keep_alive=True):
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Length: 0"]
+        if not keep_alive:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        await writer.drain()
+
+    async def handle_request(self, method, path, headers, body):
+        # Проверка для балансировщика нагрузки
+        if path == '/healthz':
+            return 200
+        if path != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+
+        if self.secret_token and not hmac.compare_digest(
+            headers.get('x-telegram-bot-api-secret-token', ''), self.secret_token
+        ):
+            return 403
+
+        try:
+            data = json.loads(body)
+            update_id = data['update_id']
+        except (ValueError, KeyError, TypeError):
+            updates_total.inc(result='invalid')
+            return 400
+
+        # Очередь заполнена: отказываем сразу, до обращения к базе
+        if self.update_queue.full():
+            updates_total.inc(result='rejected')
+            return 503
+
+        if not await self.deduplicator.accept(update_id):
+            updates_total.inc(result='duplicate')
+            return 200
+
+        try:
+            self.update_queue.put_nowait(Update.de_json(data, self.bot))
+        except asyncio.QueueFull:
+            # Очередь заполнилась, пока проверялся повтор: Telegram доставит обновление снова
+            await self.deduplicator.forget(update_id)
+            updates_total.inc(result='rejected')
+            return 503
+
+        updates_total.inc(result='accepted')
+        return 200
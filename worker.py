@@ -0,0 +1,462 @@
+import os
+import time
+import uuid
+import signal
+import socket
+import threading
+import asyncio
+import logging
+from datetime import datetime
+from apscheduler.schedulers.background import BackgroundScheduler
+from telegram import Bot
+
+from config import (
+    TELEGRAM_BOT_TOKEN, QUEUE_MAX_RUNNING, QUEUE_MAX_RUNNING_PER_USER, WORKER_CONCURRENCY, WORKER_POLL_INTERVAL,
+    JOB_MAX_ATTEMPTS, JOB_STALE_TIMEOUT, WORKER_DRAIN_TIMEOUT, STREAMING_UPLOAD, FILE_STORE_EVICT_INTERVAL, PROGRESS_WRITE_INTERVAL,
+    METRICS_HOST, METRICS_PORT, SPECULATIVE_MAX_RUNNING, SPECULATIVE_BANDWIDTH_MB, ADMISSION_BANDWIDTH_MB,
+    ADMISSION_USER_BANDWIDTH_MB, ADMISSION_SHARE_INTERVAL
+)
+from database import (
+    claim_job, heartbeat_jobs, update_job_progress, complete_job, fail_job, requeue_stale_jobs, release_jobs,
+    increment_download_count, log_download, get_cached_result, store_cached_result, flush_writes,
+    get_telegram_file, store_telegram_file, delete_telegram_file, get_job_state, finish_prefetch, has_delivered_result,
+    get_transfer_shares, check_schema, dispose_engine
+)
+from youtube_downloader import (
+    download_video, open_video_stream, local_file_path, estimate_file_size, result_quality, DownloadCancelled
+)
+from mega_handler import upload_to_mega, upload_stream_to_mega
+from file_store import file_store
+from expiry import expiry_engine
+from delivery import fits_telegram, send_file
+from admission import TokenBucket, BandwidthLimiter
+from executor import run_io, shutdown_pools
+from metrics import (
+    setup_logging, start_metrics_server, trace, stage_seconds, jobs_total, jobs_in_flight, disk_usage_bytes,
+    speculative_total, speculative_wasted_bytes, throttle_seconds
+)
+
+logger = logging.getLogger(__name__)
+
+# Уникальный идентификатор процесса воркера
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+# Задачи, выполняемые этим процессом (для heartbeat)
+active_jobs = set()
+jobs_in_flight.set_function(lambda: len(active_jobs))
+disk_usage_bytes.set_function(lambda: file_store.stats()['usage_bytes'])
+
+class JobError(Exception):
+    """Ошибка выполнения задачи, текст которой сохраняется в очереди"""
+
+class JobProgress:
+    """Прогресс задачи, который сохраняется в базу не чаще раза в interval секунд.
+
+    advance вызывается из потоков загрузки на каждый полученный или
+    отправленный блок, поэтому между записями только обновляется счетчик.
+    Там же действует ограничение скорости процесса и пользователя user_id.
+    Байты, загруженные до возобновления загрузки (resumed), только
+    учитываются в прогрессе.
+    """
+
+    def __init__(self, job_id, user_id=None, interval=PROGRESS_WRITE_INTERVAL):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stage = None
+        self.done = 0
+        self.total = None
+        self.started_at = None
+        self.written_at = 0
+
+    def start(self, stage, total=None):
+        """Начало нового этапа; сохраняется сразу"""
+        with self.lock:
+            self.stage = stage
+            self.done = 0
+            self.total = total
+            self.started_at = datetime.now()
+        self.write()
+
+    def advance(self, count, resumed=False):
+        if not resumed:
+            bandwidth.consume(self.user_id, count)
+        with self.lock:
+            self.done += count
+            due = time.monotonic() - self.written_at >= self.interval
+        if due:
+            self.write()
+
+    def write(self):
+        with self.lock:
+            self.written_at = time.monotonic()
+            snapshot = (self.stage, self.done, self.total, self.started_at)
+
+        try:
+            update_job_progress(self.job_id, *snapshot)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить прогресс задачи {self.job_id}: {e}")
+
+# Скорость загрузок всех слотов процесса: доля общих лимитов (см. share_bandwidth)
+bandwidth = BandwidthLimiter(ADMISSION_BANDWIDTH_MB * 1024 * 1024, ADMISSION_USER_BANDWIDTH_MB * 1024 * 1024)
+
+# Бюджет скорости упреждающих загрузок всех слотов процесса
+speculative_budget = TokenBucket(SPECULATIVE_BANDWIDTH_MB * 1024 * 1024)
+
+class SpeculativeProgress(JobProgress):
+    """Прогресс упреждающей загрузки.
+
+    Пока пользователь не выбрал качество, скорость ограничена общим
+    бюджетом. При каждой записи прогресса проверяется состояние задачи:
+    если загрузку отменили, следующий блок прерывает ее исключением
+    DownloadCancelled, если качество выбрано — ограничение снимается.
+    """
+
+    def __init__(self, job_id, user_id, budget, interval=PROGRESS_WRITE_INTERVAL):
+        super().__init__(job_id, user_id, interval)
+        self.budget = budget
+        self.downloaded = 0
+        self.confirmed = False
+        self.cancelled = False
+
+    def advance(self, count, resumed=False):
+        if self.cancelled:
+            raise DownloadCancelled(f"Упреждающая загрузка задачи {self.job_id} отменена")
+        if not resumed:
+            if not self.confirmed:
+                wait = self.budget.consume(count)
+                if wait:
+                    throttle_seconds.inc(wait, scope='speculative')
+            with self.lock:
+                self.downloaded += count
+        super().advance(count, resumed)
+
+    def write(self):
+        super().write()
+
+        try:
+            state = get_job_state(self.job_id)
+        except Exception as e:
+            logger.warning(f"Не удалось проверить состояние задачи {self.job_id}: {e}")
+            return
+
+        if not state or state[0] != 'running':
+            self.cancelled = True
+        elif state[1]:
+            self.confirmed = True
+
+# Бот для отправки файлов в чат и цикл событий воркера, в котором он работает;
+# создаются при запуске воркера (run_worker)
+telegram_bot = None
+event_loop = None
+
+# Сигнал остановки: слоты перестают брать новые задачи и дорабатывают текущие
+stopping = asyncio.Event()
+
+# Отправка файла в чат задачи из потока пула; возвращает file_id или None при ошибке
+def send_to_chat(job, file, file_format, file_name=None):
+    try:
+        future = asyncio.run_coroutine_threadsafe(
+            send_file(telegram_bot, job['chat_id'], file, file_format, job['video_title'], file_name),
+            event_loop
+        )
+        return future.result()
+    except Exception as e:
+        logger.warning(f"Не удалось отправить файл задачи {job['id']} в Telegram: {e}")
+        return None
+
+# Учет загрузки в статистике пользователя
+def record_download(job, file_size, file_format):
+    increment_download_count(job['user_id'])
+    log_download(job['user_id'], job['youtube_url'], job['quality'], file_size, file_format)
+
+# Упреждающая загрузка в локальное хранилище, пока пользователь выбирает качество.
+# Возвращает True, если во время загрузки пользователь выбрал это качество:
+# тогда задача выполняется дальше как обычная и файл берется из хранилища
+def prefetch_job(job):
+    progress = SpeculativeProgress(job['id'], job['user_id'], speculative_budget)
+
+    # Готовый результат бот выдаст без загрузки
+    if not has_delivered_result(job['video_id'], job['quality']):
+        try:
+            with file_store.use(local_file_path(job['video_id'], job['quality'])):
+                if not download_video(job['youtube_url'], job['quality'], progress):
+                    raise JobError("Ошибка при загрузке видео")
+        except DownloadCancelled:
+            speculative_total.inc(result='cancelled')
+            speculative_wasted_bytes.inc(progress.downloaded)
+            raise
+
+    if finish_prefetch(job['id'], progress.downloaded):
+        speculative_total.inc(result='prefetched')
+        return False
+    return True
+
+# Выполнение задачи: загрузка с YouTube, доставка пользователю и запись в базу.
+# Небольшие файлы отправляются напрямую в Telegram, остальные загружаются на MEGA
+def process_job(job):
+    if job['speculative'] and not job['confirmed'] and not prefetch_job(job):
+        return
+
+    # Фрагменты видео кэшируются отдельно от целого видео
+    quality = result_quality(job['quality'], job['clip'])
+
+    # Файл уже отправлялся в Telegram: отправляем его повторно по file_id без загрузки
+    telegram_file = get_telegram_file(job['video_id'], quality)
+    if telegram_file:
+        if send_to_chat(job, telegram_file['file_id'], telegram_file['file_format']):
+            record_download(job, telegram_file['file_size'], telegram_file['file_format'])
+            complete_job(
+                job['id'], None, telegram_file['file_size'], telegram_file['file_format'], None,
+                delivery='telegram'
+            )
+            return
+        delete_telegram_file(job['video_id'], quality)
+
+    # Такое же видео могло быть загружено, пока задача ждала в очереди
+    cached = get_cached_result(job['video_id'], quality)
+    if cached:
+        record_download(job, cached['file_size'], cached['file_format'])
+        complete_job(job['id'], cached['link'], cached['file_size'], cached['file_format'], cached['expiration_time'])
+        return
+
+    download_result, mega_result, telegram_file_id = None, None, None
+    progress = JobProgress(job['id'], job['user_id'])
+    file_path = local_file_path(job['video_id'], job['quality'], job['clip'])
+
+    # Файл, который можно отправить в Telegram, нужен на диске целиком
+    direct = fits_telegram(estimate_file_size(job['youtube_url'], job['quality'], job['clip']))
+
+    # Сначала пробуем потоковую загрузку без сохранения файла на диск,
+    # если файла еще нет в локальном хранилище; фрагмент всегда вырезается на диске
+    if STREAMING_UPLOAD and not direct and not job['clip'] and not file_store.is_complete(file_path):
+        download_result = open_video_stream(job['youtube_url'], job['quality'])
+        if download_result:
+            # Скачивание и загрузка идут одновременно: прогресс один на оба
+            progress.start('stream', download_result['file_size_bytes'])
+            mega_result = upload_stream_to_mega(
+                download_result['chunks'],
+                download_result['file_size_bytes'],
+                download_result['file_name'],
+                progress.advance
+            )
+
+    # Запасной вариант: скачивание в локальное хранилище и доставка с диска.
+    # Файл отмечен как используемый до конца доставки и не будет вытеснен
+    if not mega_result:
+        with file_store.use(file_path):
+            download_result = download_video(job['youtube_url'], job['quality'], progress, job['clip'])
+            if not download_result:
+                raise JobError("Ошибка при загрузке видео")
+
+            file_size_bytes = os.path.getsize(download_result['file_path'])
+
+            if fits_telegram(file_size_bytes):
+                progress.start('send', file_size_bytes)
+                with open(download_result['file_path'], 'rb') as f:
+                    telegram_file_id = send_to_chat(job, f, download_result['format'], download_result['file_name'])
+
+            # Если отправить в Telegram не удалось, загружаем файл на MEGA
+            if not telegram_file_id:
+                progress.start('upload', file_size_bytes)
+                mega_result = upload_to_mega(download_result['file_path'], download_result['file_name'], progress.advance)
+                if not mega_result:
+                    raise JobError("Ошибка при загрузке файла на MEGA")
+
+    record_download(job, download_result['file_size'], download_result['format'])
+
+    if telegram_file_id:
+        store_telegram_file(
+            job['video_id'],
+            quality,
+            telegram_file_id,
+            download_result['file_size'],
+            download_result['format']
+        )
+        complete_job(
+            job['id'],
+            None,
+            download_result['file_size'],
+            download_result['format'],
+            None,
+            download_result.get('processing'),
+            delivery='telegram'
+        )
+        return
+
+    store_cached_result(
+        job['video_id'],
+        quality,
+        mega_result['file_id'],
+        download_result['file_size'],
+        download_result['format']
+    )
+
+    expiry_engine.schedule(mega_result['expiration_time'])
+
+    complete_job(
+        job['id'],
+        mega_result['link'],
+        download_result['file_size'],
+        download_result['format'],
+        mega_result['expiration_time'],
+        download_result.get('processing')
+    )
+
+# Цикл одного слота воркера
+async def worker_slot(slot):
+    while not stopping.is_set():
+        try:
+            job = await run_io(claim_job, WORKER_ID, QUEUE_MAX_RUNNING, QUEUE_MAX_RUNNING_PER_USER, SPECULATIVE_MAX_RUNNING)
+        except Exception as e:
+            logger.error(f"Слот {slot}: ошибка при получении задачи: {e}")
+            job = None
+
+        if not job:
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        # Журнал задачи идет под идентификатором трассировки запроса из бота
+        with trace(job['trace_id'] or f"job-{job['id']}"):
+            logger.info(f"Слот {slot}: задача {job['id']} (попытка {job['attempts']})")
+            active_jobs.add(job['id'])
+
+            if job['attempts'] == 1 and not job['speculative']:
+                stage_seconds.observe((datetime.now() - job['created_at']).total_seconds(), stage='queue_wait')
+
+            try:
+                await run_io(process_job, job)
+                jobs_total.inc(result='done')
+                logger.info(f"Задача {job['id']} выполнена")
+            except DownloadCancelled as e:
+                # Статус задачи уже изменен при отмене
+                jobs_total.inc(result='cancelled')
+                logger.info(str(e))
+            except Exception as e:
+                logger.error(f"Ошибка при выполнении задачи {job['id']}: {e}")
+                jobs_total.inc(result='retried' if job['attempts'] < JOB_MAX_ATTEMPTS else 'failed')
+                await run_io(fail_job, job['id'], str(e), JOB_MAX_ATTEMPTS)
+            finally:
+                active_jobs.discard(job['id'])
+
+# Периодическое обслуживание очереди: heartbeat и возврат зависших задач
+async def maintenance():
+    while True:
+        await asyncio.sleep(JOB_STALE_TIMEOUT / 3)
+
+        try:
+            await run_io(heartbeat_jobs, list(active_jobs))
+            requeued = await run_io(requeue_stale_jobs, JOB_STALE_TIMEOUT)
+            if requeued:
+                logger.warning(f"Возвращено в очередь зависших задач: {requeued}")
+        except Exception as e:
+            logger.error(f"Ошибка при обслуживании очереди: {e}")
+
+# Пересчет доли общих лимитов скорости по задачам, выполняющимся на всех воркерах
+async def share_bandwidth():
+    while True:
+        try:
+            bandwidth.set_shares(*await run_io(get_transfer_shares))
+        except Exception as e:
+            logger.warning(f"Не удалось пересчитать долю лимита скорости: {e}")
+        await asyncio.sleep(ADMISSION_SHARE_INTERVAL)
+
+# Вытеснение устаревших файлов и файлов сверх квоты из локального хранилища
+def evict_local_files():
+    try:
+        evictions = file_store.stats()['evictions']
+        with stage_seconds.time(stage='cleanup_local'):
+            stats = file_store.evict()
+        if stats['evictions'] > evictions:
+            logger.info(
+                f"Локальное хранилище: вытеснено файлов {stats['evictions'] - evictions}, "
+                f"занято {stats['usage_bytes'] / (1024 * 1024):.1f} из {stats['quota_bytes'] / (1024 * 1024):.0f} МБ "
+                f"({stats['files']} файлов), всего вытеснено {stats['evictions']} "
+                f"({stats['evicted_bytes'] / (1024 * 1024):.1f} МБ)"
+            )
+    except Exception as e:
+        logger.error(f"Ошибка при очистке локальных файлов: {e}")
+
+async def drain(slots, timeout):
+    """Ожидание завершения слотов с текущими задачами после сигнала остановки.
+
+    Задачи, не успевшие завершиться за timeout секунд, возвращаются в
+    очередь без учета попытки. Возвращает True, если все задачи завершены.
+    """
+    _, pending = await asyncio.wait(slots, timeout=timeout)
+    if not pending:
+        return True
+
+    released = await run_io(release_jobs, WORKER_ID, list(active_jobs))
+    logger.warning(f"Не завершились за {timeout:.0f} с, возвращены в очередь задач: {released}")
+    return False
+
+async def run_worker():
+    """Работа воркера до сигнала SIGTERM или SIGINT; возвращает результат drain"""
+    global event_loop, telegram_bot
+    event_loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        event_loop.add_signal_handler(sig, stopping.set)
+
+    if telegram_bot is None:
+        telegram_bot = Bot(TELEGRAM_BOT_TOKEN)
+
+    logger.info(f"Воркер {WORKER_ID} запущен, слотов: {WORKER_CONCURRENCY}")
+
+    async with telegram_bot:
+        slots = [asyncio.create_task(worker_slot(slot)) for slot in range(WORKER_CONCURRENCY)]
+        background = [asyncio.create_task(maintenance())]
+        if ADMISSION_BANDWIDTH_MB or ADMISSION_USER_BANDWIDTH_MB:
+            background.append(asyncio.create_task(share_bandwidth()))
+
+        await stopping.wait()
+        logger.info(f"Остановка воркера {WORKER_ID}, выполняется задач: {len(active_jobs)}")
+
+        drained = await drain(slots, WORKER_DRAIN_TIMEOUT)
+        for task in background:
+            task.cancel()
+        return drained
+
+# Запуск: проверка схемы базы и подготовка локального хранилища.
+# Подключения к базе, MEGA и Telegram создаются при первом обращении
+def startup():
+    setup_logging()
+    check_schema()
+    file_store.prepare()
+    start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+# Основная функция
+def main() -> None:
+    startup()
+
+    # Локальные файлы хранятся на машине воркера, поэтому вытесняются здесь
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(evict_local_files, 'interval', seconds=FILE_STORE_EVICT_INTERVAL)
+    scheduler.start()
+
+    # Истекшие файлы MEGA удаляются и ботом, и воркерами без пересечений
+    expiry_engine.start()
+
+    drained = True
+    try:
+        drained = asyncio.run(run_worker())
+    finally:
+        expiry_engine.stop()
+        scheduler.shutdown(wait=False)
+        flush_writes()
+        dispose_engine()
+        shutdown_pools(wait=False)
+
+    if not drained:
+        # Потоки прерванных задач остановить нельзя, а возвращенные в очередь
+        # задачи уже может взять другой воркер: процесс завершается, не
+        # дожидаясь этих потоков
+        logging.shutdown()
+        os._exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -1,81 +1,726 @@
 import os
 import re
-from pytube import YouTube
-from config import DOWNLOAD_DIR, TEMP_DIR
+import time
+import shutil
+import logging
+import threading
+from datetime import datetime
+from itertools import islice
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import Request, urlopen
+from pytube import YouTube, Playlist
+from config import (
+    DOWNLOAD_DIR, TEMP_DIR, STREAM_CHUNK_SIZE, STREAM_RANGE_SIZE, METADATA_CACHE_SIZE, METADATA_CACHE_TTL, MP3_BITRATE,
+    CLIP_INDEX_PROBE_SIZE
+)
+from database import get_video_metadata, save_video_metadata, delete_video_metadata
+from ttl_cache import TTLCache
+from media import ffmpeg_available, mux_streams, transcode_to_mp3, cut_streams, cut_to_mp3
+from mp4_index import IndexNotFound, locate_index, parse_sidx, select_segments
+from executor import run_cpu_sync
+from ranged_downloader import download_ranges
+from file_store import file_store
+from metrics import stage_seconds, transfer_bytes, clip_skipped_bytes
+
+logger = logging.getLogger(__name__)
+
+class DownloadCancelled(Exception):
+    """Загрузка прервана вызывающим кодом (например, из progress.advance)"""
+
+YOUTUBE_REGEX = r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
 
 def is_valid_youtube_url(url):
     """Проверка, является ли ссылка допустимой ссылкой YouTube"""
-    youtube_regex = r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
-    return bool(re.match(youtube_regex, url))
+    return bool(re.match(YOUTUBE_REGEX, url))
+
+def extract_video_id(url):
+    """Получение канонического идентификатора видео из ссылки"""
+    match = re.match(YOUTUBE_REGEX, url)
+    return match.group(6) if match else None
+
+PLAYLIST_REGEX = r'(https?://)?(www\.|m\.)?youtube\.com/playlist\?(.*&)?list=([\w-]+)'
+
+def is_playlist_url(url):
+    """Проверка, является ли ссылка ссылкой на плейлист YouTube"""
+    return bool(re.match(PLAYLIST_REGEX, url))
+
+def extract_youtube_urls(text):
+    """Ссылки на видео и плейлисты YouTube из текста сообщения (по одной на строку или через пробел)"""
+    return [
+        token for token in text.split()
+        if is_playlist_url(token) or is_valid_youtube_url(token)
+    ]
+
+# Отрезок времени для вырезки фрагмента: секунды, м:сс или ч:мм:сс через дефис
+CLIP_REGEX = r'^(\d+(?::\d{1,2}){0,2})-(\d+(?::\d{1,2}){0,2})$'
+
+def parse_timestamp(value):
+    """Момент времени (секунды, м:сс или ч:мм:сс) в секундах; None, если он записан неверно"""
+    seconds = 0
+    for index, part in enumerate(value.split(':')):
+        if index and int(part) >= 60:
+            return None
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+def extract_clip(text):
+    """Отрезок времени из текста сообщения в виде строки «начало-конец» в секундах; None, если его нет"""
+    for token in text.split():
+        match = re.match(CLIP_REGEX, token)
+        if not match:
+            continue
+        start, end = parse_timestamp(match.group(1)), parse_timestamp(match.group(2))
+        if start is not None and end is not None and start < end:
+            return f"{start}-{end}"
+    return None
+
+def clip_bounds(clip):
+    """Начало и конец фрагмента в секундах"""
+    start, end = clip.split('-')
+    return int(start), int(end)
+
+def format_timestamp(seconds):
+    """Момент времени в виде м:сс или ч:мм:сс"""
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+def format_clip(clip):
+    """Отрезок времени фрагмента для сообщений пользователю"""
+    start, end = clip_bounds(clip)
+    return f"{format_timestamp(start)}–{format_timestamp(end)}"
+
+def result_quality(quality, clip=None):
+    """Качество как ключ кэша результатов: фрагменты хранятся отдельно от целого видео"""
+    return f"{quality}@{clip}" if clip else quality
+
+def get_playlist_video_urls(url, limit):
+    """Ссылки на первые limit видео плейлиста"""
+    try:
+        return list(islice(Playlist(url).video_urls, limit))
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка видео плейлиста: {e}")
+        return []
+
+# Разрешения, которые бот предлагает пользователю
+SUPPORTED_RESOLUTIONS = ['480', '720', '1080']
+
+# Запас до истечения ссылок на потоки, после которого метаданные считаются устаревшими
+STREAM_URL_EXPIRY_MARGIN = 300
+
+# Метаданные видео в памяти процесса, общие для всех пользователей
+metadata_cache = TTLCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+# Блокировки, чтобы одно и то же видео не запрашивалось с YouTube параллельно
+fetch_locks = {}
+fetch_locks_lock = threading.Lock()
+
+def stream_url_expiry(url):
+    """Время истечения ссылки на поток (параметр expire) в секундах Unix"""
+    expire = parse_qs(urlsplit(url).query).get('expire')
+    return int(expire[0]) if expire else None
+
+def build_manifest(yt):
+    """Сбор метаданных видео и списка потоков (с расшифрованными ссылками) в словарь"""
+    streams = []
+    
+    # Положение индекса фрагментов (sidx) адаптивных потоков: по нему
+    # фрагмент видео скачивается без загрузки всего потока
+    index_ranges = {
+        int(fmt['itag']): [int(fmt['indexRange']['start']), int(fmt['indexRange']['end'])]
+        for fmt in yt.streaming_data.get('adaptiveFormats', [])
+        if 'indexRange' in fmt
+    }
+    
+    for stream in yt.streams:
+        streams.append({
+            'itag': stream.itag,
+            'url': stream.url,
+            'subtype': stream.subtype,
+            'resolution': stream.resolution,
+            'abr': int(stream.abr.replace('kbps', '')) if stream.abr else 0,
+            # Размер из манифеста; если его нет, он будет запрошен при загрузке
+            'filesize': stream._filesize or None,
+            'progressive': stream.is_progressive,
+            'includes_audio': stream.includes_audio_track,
+            'includes_video': stream.includes_video_track,
+            'index_range': index_ranges.get(stream.itag)
+        })
+    
+    expiries = [stream_url_expiry(stream['url']) for stream in streams]
+    expiries = [expiry for expiry in expiries if expiry]
+    expires_at = time.time() + METADATA_CACHE_TTL
+    if expiries:
+        expires_at = min(expires_at, min(expiries) - STREAM_URL_EXPIRY_MARGIN)
+    
+    return {
+        'video_id': yt.video_id,
+        'title': yt.title,
+        'author': yt.author,
+        'length': yt.length,
+        'thumbnail': yt.thumbnail_url,
+        'streams': streams,
+        'expires_at': expires_at
+    }
+
+def get_manifest(url):
+    """Метаданные видео с кэшированием.
+    
+    Сначала проверяется кэш процесса, затем общий кэш в базе данных (его
+    заполняет бот при показе информации о видео, а использует воркер), и
+    только потом выполняется запрос к YouTube.
+    """
+    video_id = extract_video_id(url)
+    
+    manifest = metadata_cache.get(video_id)
+    if manifest:
+        return manifest
+    
+    with fetch_locks_lock:
+        lock = fetch_locks.setdefault(video_id, threading.Lock())
+    
+    with lock:
+        try:
+            manifest = metadata_cache.get(video_id)
+            if manifest:
+                return manifest
+            
+            manifest = get_video_metadata(video_id)
+            if not manifest:
+                with stage_seconds.time(stage='metadata'):
+                    manifest = build_manifest(YouTube(url))
+                save_video_metadata(video_id, manifest, datetime.fromtimestamp(manifest['expires_at']))
+            
+            metadata_cache.set(video_id, manifest, ttl=manifest['expires_at'] - time.time())
+            return manifest
+        finally:
+            with fetch_locks_lock:
+                fetch_locks.pop(video_id, None)
+
+def invalidate_manifest(url):
+    """Сброс кэша метаданных, например если ссылки на потоки перестали работать"""
+    video_id = extract_video_id(url)
+    metadata_cache.pop(video_id)
+    
+    try:
+        delete_video_metadata(video_id)
+    except Exception as e:
+        logger.error(f"Ошибка при сбросе метаданных видео: {e}")
 
 def get_video_info(url):
     """Получение информации о видео"""
     try:
-        yt = YouTube(url)
+        manifest = get_manifest(url)
+        streams = manifest['streams']
         
         # Собираем доступные разрешения
         resolutions = []
         
-        # Получаем доступные разрешения для видео
-        video_streams = yt.streams.filter(progressive=True).order_by('resolution')
+        # Получаем доступные разрешения для видео: прогрессивные потоки и,
+        # если есть ffmpeg, адаптивные (1080p почти всегда только адаптивный)
+        video_streams = [stream for stream in streams if stream['progressive']]
+        if ffmpeg_available():
+            video_streams += [
+                stream for stream in streams
+                if not stream['progressive'] and stream['includes_video'] and stream['subtype'] == 'mp4'
+            ]
+        
         for stream in video_streams:
-            if stream.resolution:
-                resolution = stream.resolution.replace('p', '')
-                if resolution in ['480', '720', '1080'] and resolution not in resolutions:
+            if stream['resolution']:
+                resolution = stream['resolution'].replace('p', '')
+                if resolution in SUPPORTED_RESOLUTIONS and resolution not in resolutions:
                     resolutions.append(resolution)
         
         # Проверяем, есть ли аудиопоток
-        audio_stream = yt.streams.filter(only_audio=True).first()
-        has_audio = audio_stream is not None
+        has_audio = select_audio_stream(manifest) is not None
         
         return {
-            'title': yt.title,
-            'author': yt.author,
-            'length': yt.length,
-            'thumbnail': yt.thumbnail_url,
-            'resolutions': resolutions,
+            'title': manifest['title'],
+            'author': manifest['author'],
+            'length': manifest['length'],
+            'thumbnail': manifest['thumbnail'],
+            'resolutions': sorted(resolutions, key=int),
             'has_audio': has_audio
         }
     except Exception as e:
-        print(f"Ошибка при получении информации о видео: {e}")
+        logger.error(f"Ошибка при получении информации о видео: {e}")
         return None
 
-def download_video(url, resolution='720'):
-    """Загрузка видео с YouTube"""
+def safe_file_name(title):
+    """Создание безопасного имени файла из названия видео"""
+    return "".join([c for c in title if c.isalpha() or c.isdigit() or c==' ']).rstrip()
+
+def output_file_name(title, resolution, clip=None):
+    """Имя итогового файла"""
+    safe_title = safe_file_name(title)
+    if clip:
+        safe_title += f"_{clip}"
+    if resolution == 'audio':
+        return f"{safe_title}.mp3"
+    return f"{safe_title}_{resolution}p.mp4"
+
+def local_file_path(video_id, resolution, clip=None):
+    """Путь к файлу в локальном хранилище.
+    
+    Имя строится по идентификатору видео, а не по названию: так файл можно
+    найти и использовать повторно до получения метаданных, а видео с
+    одинаковыми названиями не перезаписывают друг друга.
+    """
+    extension = 'mp3' if resolution == 'audio' else 'mp4'
+    name = f"{video_id}_{resolution}_{clip}" if clip else f"{video_id}_{resolution}"
+    return os.path.join(DOWNLOAD_DIR, f"{name}.{extension}")
+
+def select_progressive_stream(manifest, resolution):
+    """Прогрессивный поток (видео со звуком) точно в нужном разрешении"""
+    for stream in manifest['streams']:
+        if stream['progressive'] and stream['resolution'] == f"{resolution}p":
+            return stream
+    return None
+
+def select_best_progressive_stream(manifest):
+    """Прогрессивный поток с наибольшим разрешением"""
+    streams = [stream for stream in manifest['streams'] if stream['progressive'] and stream['resolution']]
+    return max(streams, key=lambda stream: int(stream['resolution'].replace('p', '')), default=None)
+
+def select_adaptive_streams(manifest, resolution):
+    """Адаптивные видео- и аудиопоток mp4, которые можно объединить без перекодирования"""
+    video = next((
+        stream for stream in manifest['streams']
+        if not stream['progressive'] and stream['includes_video'] and stream['subtype'] == 'mp4'
+        and stream['resolution'] == f"{resolution}p"
+    ), None)
+    audio = max((
+        stream for stream in manifest['streams']
+        if not stream['includes_video'] and stream['includes_audio'] and stream['subtype'] == 'mp4'
+    ), key=lambda stream: stream['abr'], default=None)
+    return video, audio
+
+def select_audio_stream(manifest):
+    """Аудиопоток с наилучшим битрейтом"""
+    return max((
+        stream for stream in manifest['streams']
+        if stream['includes_audio'] and not stream['includes_video']
+    ), key=lambda stream: stream['abr'], default=None)
+
+def stream_filesize(stream):
+    """Размер потока в байтах; если его нет в манифесте, запрашивается HEAD-запросом"""
+    if not stream['filesize']:
+        request = Request(stream['url'], method='HEAD', headers={'User-Agent': 'Mozilla/5.0'})
+        with urlopen(request, timeout=30) as response:
+            stream['filesize'] = int(response.headers['Content-Length'])
+    return stream['filesize']
+
+def estimate_file_size(url, resolution, clip=None):
+    """Ожидаемый размер итогового файла в байтах по манифесту; None, если он неизвестен.
+    
+    Нужен до загрузки, чтобы выбрать способ доставки: для MP3 размер
+    считается по длительности и битрейту перекодирования, для фрагмента —
+    пропорционально его доле в длительности видео.
+    """
     try:
-        yt = YouTube(url)
+        manifest = get_manifest(url)
+        file_size = estimate_manifest_size(manifest, resolution)
         
-        # Создаем безопасное имя файла
-        safe_title = "".join([c for c in yt.title if c.isalpha() or c.isdigit() or c==' ']).rstrip()
-        file_path = os.path.join(DOWNLOAD_DIR, f"{safe_title}_{resolution}p.mp4")
+        if file_size and clip and manifest['length']:
+            start, end = clip_bounds(clip)
+            return file_size * max(0, min(end, manifest['length']) - start) // manifest['length']
+        return file_size
+    except Exception as e:
+        logger.error(f"Ошибка при оценке размера файла: {e}")
+        return None
+
+def estimate_manifest_size(manifest, resolution):
+    """Размер целого видео или аудио в байтах по манифесту"""
+    if resolution == 'audio':
+        if ffmpeg_available():
+            return manifest['length'] * int(MP3_BITRATE.rstrip('k')) * 1000 // 8
+        return select_audio_stream(manifest)['filesize']
+    
+    stream = select_progressive_stream(manifest, resolution)
+    if stream:
+        return stream['filesize']
+    
+    video, audio = select_adaptive_streams(manifest, resolution) if ffmpeg_available() else (None, None)
+    if video and audio:
+        if video['filesize'] and audio['filesize']:
+            return video['filesize'] + audio['filesize']
+        return None
+    
+    return select_best_progressive_stream(manifest)['filesize']
+
+def iter_stream_chunks(url, file_size, chunk_size=STREAM_CHUNK_SIZE, range_size=STREAM_RANGE_SIZE):
+    """Чтение потока фрагментами через последовательные Range-запросы.
+    
+    YouTube ограничивает скорость длинных запросов без Range, поэтому поток
+    запрашивается частями по range_size байт, как это делает pytube.
+    """
+    downloaded = 0
+    
+    while downloaded < file_size:
+        stop = min(downloaded + range_size, file_size) - 1
+        request = Request(url, headers={'Range': f'bytes={downloaded}-{stop}', 'User-Agent': 'Mozilla/5.0'})
+        received = 0
+        
+        with urlopen(request, timeout=30) as response:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                received += len(chunk)
+                downloaded += len(chunk)
+                transfer_bytes.inc(len(chunk), direction='youtube')
+                yield chunk
         
-        # Загружаем видео нужного разрешения
+        if not received:
+            raise IOError(f"Сервер не вернул данные для диапазона {downloaded}-{stop}")
+
+def open_video_stream(url, resolution='720'):
+    """Подготовка потоковой загрузки видео без сохранения на диск.
+    
+    Возможна только для прогрессивного потока в нужном разрешении: MP3 и
+    адаптивные потоки требуют обработки ffmpeg. В остальных случаях
+    возвращает None, и используется загрузка через диск.
+    """
+    try:
         if resolution == 'audio':
-            # Загружаем только аудио в формате mp3
-            stream = yt.streams.filter(only_audio=True).first()
-            out_file = stream.download(output_path=DOWNLOAD_DIR, filename=f"{safe_title}.mp3")
-            file_path = out_file
-        else:
-            # Загружаем видео с выбранным разрешением
-            stream = yt.streams.filter(res=f"{resolution}p", progressive=True).first()
+            return None
+        
+        manifest = get_manifest(url)
+        stream = select_progressive_stream(manifest, resolution)
+        if not stream:
+            return None
+        
+        file_size = stream_filesize(stream)
+        
+        return {
+            'chunks': iter_stream_chunks(stream['url'], file_size),
+            'file_name': output_file_name(manifest['title'], resolution),
+            'file_size': file_size / (1024 * 1024),  # в МБ
+            'file_size_bytes': file_size,
+            'format': 'mp4'
+        }
+    
+    except Exception as e:
+        logger.error(f"Ошибка при подготовке потоковой загрузки: {e}")
+        return None
+
+def fetch_stream(stream, file_path, on_bytes=None):
+    """Загрузка потока частями по нескольким соединениям с возобновлением"""
+    def count_bytes(count, resumed=False):
+        if not resumed:
+            transfer_bytes.inc(count, direction='youtube')
+        if on_bytes:
+            on_bytes(count, resumed=resumed)
+    
+    with stage_seconds.time(stage='download'):
+        return download_ranges(stream['url'], file_path, stream_filesize(stream), on_bytes=count_bytes)
+
+def temp_file_paths(streams, prefix):
+    """Пути временных файлов для исходных потоков"""
+    return [
+        os.path.join(TEMP_DIR, f"{prefix}_{index}.{stream['subtype']}")
+        for index, stream in enumerate(streams)
+    ]
+
+def download_streams(streams, paths, on_bytes=None):
+    """Параллельная загрузка нескольких потоков во временные файлы"""
+    with ThreadPoolExecutor(max_workers=len(streams)) as pool:
+        futures = [pool.submit(fetch_stream, stream, path, on_bytes) for stream, path in zip(streams, paths)]
+        return [future.result() for future in futures]
+
+def process_streams(func, *args):
+    """Обработка ffmpeg в пуле процессов с записью результата во временный файл.
+    
+    Итоговый файл появляется только после успешного завершения ffmpeg,
+    поэтому существующий файл всегда можно использовать повторно.
+    """
+    *inputs, output_path = args
+    temp_path = f"{output_path}.tmp"
+    processing = run_cpu_sync(func, *inputs, temp_path)
+    os.replace(temp_path, output_path)
+    return processing
+
+def fetch_bytes(url, start, end):
+    """Загрузка небольшого диапазона байт потока одним запросом"""
+    request = Request(url, headers={'Range': f'bytes={start}-{end}', 'User-Agent': 'Mozilla/5.0'})
+    with urlopen(request, timeout=30) as response:
+        if response.status != 206:
+            raise IOError(f"Сервер вернул {response.status} вместо 206 для {start}-{end}")
+        data = response.read()
+    transfer_bytes.inc(len(data), direction='youtube')
+    return data
+
+def read_stream_index(stream):
+    """Инициализирующий сегмент и список фрагментов потока по индексу sidx.
+    
+    Положение индекса берется из манифеста, а если его там нет (старые
+    записи кэша метаданных), индекс ищется в начале потока: сначала
+    читаются CLIP_INDEX_PROBE_SIZE байт, затем, если нужно, следующие
+    боксы. Для потока без индекса возникает IndexNotFound.
+    """
+    index_range = stream.get('index_range')
+    file_size = stream_filesize(stream)
+    end = index_range[1] + 1 if index_range else CLIP_INDEX_PROBE_SIZE
+    head = b''
+    
+    # Дочитываем начало потока, пока в нем не окажется весь sidx
+    while True:
+        head += fetch_bytes(stream['url'], len(head), min(end, file_size) - 1)
+        sidx_start, end = locate_index(head)
+        if sidx_start is not None and end <= len(head):
+            return head[:sidx_start], parse_sidx(head[sidx_start:end], end)
+        if end > file_size:
+            raise IndexNotFound("Индекс sidx выходит за пределы потока")
+
+def plan_clip_stream(stream, start, end):
+    """Что скачать из потока для фрагмента [start, end] секунд.
+    
+    По индексу — инициализирующий сегмент и диапазон байт фрагментов,
+    покрывающих отрезок, и смещение start от начала первого из них. Поток
+    без индекса скачивается целиком, смещение тогда равно start.
+    """
+    try:
+        init, segments = read_stream_index(stream)
+        first_time, first_byte, last_byte = select_segments(segments, start, end)
+    except (IndexNotFound, ValueError, OSError) as e:
+        logger.info(f"Индекс потока {stream['itag']} недоступен, поток скачивается целиком: {e}")
+        return {'init': None, 'range': None, 'offset': start, 'size': stream_filesize(stream)}
+    
+    return {
+        'init': init,
+        'range': (first_byte, last_byte),
+        'offset': start - first_time,
+        'size': len(init) + last_byte - first_byte + 1
+    }
+
+def fetch_clip_stream(stream, plan, file_path, on_bytes=None):
+    """Загрузка части потока по плану plan_clip_stream.
+    
+    Фрагменты скачиваются с возобновлением в служебный файл .media, а затем
+    вместе с инициализирующим сегментом собираются в файл file_path —
+    корректный фрагментированный MP4, который понимает ffmpeg.
+    """
+    if not plan['range']:
+        return fetch_stream(stream, file_path, on_bytes)
+    if os.path.exists(file_path):
+        return file_path
+    
+    def count_bytes(count, resumed=False):
+        if not resumed:
+            transfer_bytes.inc(count, direction='youtube')
+        if on_bytes:
+            on_bytes(count, resumed=resumed)
+    
+    first_byte, last_byte = plan['range']
+    media_path = f"{file_path}.media"
+    with stage_seconds.time(stage='download'):
+        download_ranges(stream['url'], media_path, last_byte - first_byte + 1, on_bytes=count_bytes, remote_offset=first_byte)
+    
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'wb') as output, open(media_path, 'rb') as media:
+        output.write(plan['init'])
+        shutil.copyfileobj(media, output)
+    os.replace(temp_path, file_path)
+    os.remove(media_path)
+    
+    clip_skipped_bytes.inc(stream_filesize(stream) - plan['size'])
+    return file_path
+
+def download_clip(manifest, resolution, clip, file_path, prefix, stack, start_stage, on_bytes=None):
+    """Загрузка фрагмента видео: только нужные части потоков и вырезка ffmpeg без перекодирования.
+    
+    Если целое видео в этом качестве уже есть в локальном хранилище,
+    фрагмент вырезается из него. Иначе отрезок времени сопоставляется с
+    диапазонами байт по индексу каждого потока (адаптивные потоки mp4
+    выбираются потому, что индекс есть у них), и скачиваются только эти
+    диапазоны. Временные файлы отмечаются в stack как используемые.
+    Возвращает временные файлы и сведения об обработке ffmpeg.
+    """
+    if not ffmpeg_available():
+        raise RuntimeError("Для вырезки фрагмента нужен ffmpeg")
+    
+    start, end = clip_bounds(clip)
+    if manifest['length']:
+        end = min(end, manifest['length'])
+    if start >= end:
+        raise ValueError(f"Фрагмент {clip} за пределами видео длительностью {manifest['length']} с")
+    file_format = 'mp3' if resolution == 'audio' else 'mp4'
+    
+    full_path = local_file_path(manifest['video_id'], resolution)
+    stack.enter_context(file_store.use(full_path))
+    if file_store.is_complete(full_path):
+        logger.info(f"Фрагмент вырезается из файла локального хранилища: {full_path}")
+        start_stage('cut')
+        return [], process_streams(cut_streams, [(full_path, start)], end - start, file_format, file_path)
+    
+    if resolution == 'audio':
+        streams = [select_adaptive_streams(manifest, resolution)[1] or select_audio_stream(manifest)]
+    else:
+        video, audio = select_adaptive_streams(manifest, resolution)
+        streams = [video, audio] if video and audio else [
+            select_progressive_stream(manifest, resolution) or select_best_progressive_stream(manifest)
+        ]
+    
+    plans = [plan_clip_stream(stream, start, end) for stream in streams]
+    temp_files = temp_file_paths(streams, prefix)
+    for path in temp_files:
+        stack.enter_context(file_store.use(path))
+    
+    start_stage('download', total=sum(plan['size'] for plan in plans))
+    with ThreadPoolExecutor(max_workers=len(streams)) as pool:
+        futures = [
+            pool.submit(fetch_clip_stream, stream, plan, path, on_bytes)
+            for stream, plan, path in zip(streams, plans, temp_files)
+        ]
+        for future in futures:
+            future.result()
+    
+    start_stage('cut')
+    if resolution == 'audio':
+        processing = process_streams(cut_to_mp3, temp_files[0], plans[0]['offset'], end - start, file_path)
+    else:
+        inputs = [(path, plan['offset']) for path, plan in zip(temp_files, plans)]
+        processing = process_streams(cut_streams, inputs, end - start, file_format, file_path)
+    return temp_files, processing
+
+def remove_files(paths):
+    """Удаление временных файлов"""
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+# Блокировки файлов, которые сейчас скачиваются: задачи с одним и тем же
+# видео и качеством в разных слотах воркера не пишут в один файл одновременно
+download_locks = {}
+download_locks_lock = threading.Lock()
+
+@contextmanager
+def download_lock(file_path):
+    """Исключительная загрузка файла в пределах процесса"""
+    with download_locks_lock:
+        entry = download_locks.setdefault(file_path, [threading.Lock(), 0])
+        entry[1] += 1
+    
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with download_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del download_locks[file_path]
+
+def download_video(url, resolution='720', progress=None, clip=None):
+    """Загрузка видео с YouTube в локальное хранилище.
+    
+    Файл и временные файлы отмечаются в file_store как используемые, пока
+    идет загрузка и обработка; вызывающий код, которому файл нужен и после
+    возврата (например, для загрузки на MEGA), должен сам держать
+    file_store.use(local_file_path(...)). Если файл уже есть в хранилище,
+    он используется повторно без обращения к YouTube.
+    
+    progress — объект с методами start(stage, total) и advance(n), которому
+    сообщается о смене этапа (download, mux, transcode, cut) и полученных байтах.
+    
+    clip — отрезок времени «начало-конец» в секундах: тогда загружается
+    только этот фрагмент видео (download_clip).
+    
+    В результат входит 'processing' — время и процессорное время обработки
+    ffmpeg (объединение потоков или перекодирование), если она была.
+    """
+    def start_stage(stage, streams=(), total=None):
+        if progress:
+            progress.start(stage, total or sum(stream_filesize(stream) for stream in streams) or None)
+    
+    on_bytes = progress.advance if progress else None
+    
+    try:
+        manifest = get_manifest(url)
+        file_path = local_file_path(manifest['video_id'], resolution, clip)
+        # Постоянные имена временных файлов позволяют продолжить прерванную загрузку при повторе задачи
+        prefix = os.path.splitext(os.path.basename(file_path))[0]
+        temp_files = []
+        processing = None
+        
+        with ExitStack() as stack:
+            stack.enter_context(file_store.use(file_path))
+            # Вторая задача с тем же файлом дождется первой и возьмет готовый файл
+            stack.enter_context(download_lock(file_path))
+            
+            if file_store.is_complete(file_path):
+                logger.info(f"Используется файл из локального хранилища: {file_path}")
+            elif clip:
+                temp_files, processing = download_clip(
+                    manifest, resolution, clip, file_path, prefix, stack, start_stage, on_bytes
+                )
+            elif resolution == 'audio':
+                audio = select_audio_stream(manifest)
+                
+                if ffmpeg_available():
+                    # Скачиваем исходный аудиопоток и перекодируем его в MP3 в пуле процессов
+                    temp_files = temp_file_paths([audio], prefix)
+                    for path in temp_files:
+                        stack.enter_context(file_store.use(path))
+                    start_stage('download', [audio])
+                    download_streams([audio], temp_files, on_bytes)
+                    start_stage('transcode')
+                    processing = process_streams(transcode_to_mp3, temp_files[0], file_path)
+                else:
+                    # Без ffmpeg сохраняем аудиопоток как есть
+                    start_stage('download', [audio])
+                    fetch_stream(audio, file_path, on_bytes)
+            else:
+                stream = select_progressive_stream(manifest, resolution)
+                video, audio = select_adaptive_streams(manifest, resolution) if not stream and ffmpeg_available() else (None, None)
+                
+                if stream:
+                    start_stage('download', [stream])
+                    fetch_stream(stream, file_path, on_bytes)
+                elif video and audio:
+                    # Скачиваем видео и аудио параллельно и объединяем без перекодирования
+                    temp_files = temp_file_paths([video, audio], prefix)
+                    for path in temp_files:
+                        stack.enter_context(file_store.use(path))
+                    start_stage('download', [video, audio])
+                    download_streams([video, audio], temp_files, on_bytes)
+                    start_stage('mux')
+                    processing = process_streams(mux_streams, temp_files[0], temp_files[1], file_path)
+                else:
+                    # Если нет потока с нужным разрешением, пробуем найти наиболее близкое
+                    stream = select_best_progressive_stream(manifest)
+                    start_stage('download', [stream])
+                    fetch_stream(stream, file_path, on_bytes)
             
-            # Если нет прогрессивного потока с нужным разрешением, пробуем найти наиболее близкое
-            if not stream:
-                stream = yt.streams.filter(progressive=True).order_by('resolution').last()
+            if processing:
+                stage_seconds.observe(processing['wall_time'], stage=processing['stage'])
+                logger.info(
+                    f"Обработка ffmpeg ({processing['stage']}) {os.path.basename(file_path)}: "
+                    f"{processing['wall_time']:.1f} с, процессор {processing['cpu_time']:.1f} с"
+                )
             
-            out_file = stream.download(output_path=DOWNLOAD_DIR, filename=f"{safe_title}_{resolution}p.mp4")
-            file_path = out_file
+            # Исходные потоки больше не нужны; при ошибке они остаются для возобновления
+            remove_files(temp_files)
         
         # Получаем размер файла
         file_size = os.path.getsize(file_path) / (1024 * 1024)  # в МБ
         
         return {
             'file_path': file_path,
-            'file_name': os.path.basename(file_path),
+            'file_name': output_file_name(manifest['title'], resolution, clip),
             'file_size': file_size,
-            'format': 'mp3' if resolution == 'audio' else 'mp4'
+            'format': 'mp3' if resolution == 'audio' else 'mp4',
+            'processing': processing
         }
     
+    except DownloadCancelled:
+        # Частично загруженные файлы остаются для возобновления
+        raise
     except Exception as e:
-        print(f"Ошибка при загрузке видео: {e}")
-        return None 
\ No newline at end of file
+        logger.error(f"Ошибка при загрузке видео: {e}")
+        # Ссылки на потоки могли истечь: при повторе метаданные будут запрошены заново
+        invalidate_manifest(url)
+        return None